@@ -1,3 +1,4 @@
+import json
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -20,13 +21,169 @@ def create_app():
         JWT_SECRET_KEY=os.environ.get('JWT_SECRET_KEY', 'dev_jwt_secret_key'),
         SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', 'sqlite:///../instance/medai.db'),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
-        JWT_ACCESS_TOKEN_EXPIRES = 3600 # 1 hour
+        JWT_ACCESS_TOKEN_EXPIRES = 3600, # 1 hour
+        # Observability: log level/format ('text' or 'json') and the Prometheus /metrics endpoint,
+        # which requires METRICS_TOKEN as a bearer token when set, and is loopback-only otherwise
+        LOG_LEVEL=os.environ.get('LOG_LEVEL', 'INFO'),
+        LOG_FORMAT=os.environ.get('LOG_FORMAT', 'text'),
+        METRICS_ENABLED=os.environ.get('METRICS_ENABLED', '1') == '1',
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+        # Password hashing: bcrypt cost (existing hashes are upgraded on login when it changes)
+        # and the bounded thread pool it runs on
+        BCRYPT_LOG_ROUNDS=int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+        PASSWORD_HASH_THREADS=int(os.environ.get('PASSWORD_HASH_THREADS', max(1, min(4, (os.cpu_count() or 2) // 2)))),
+        PASSWORD_HASH_MAX_QUEUE=int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 64)),
+        PASSWORD_HASH_TIMEOUT=float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10)),
+        # Per-user rate limits / concurrency caps ('memory', 'sqlite' to share across
+        # worker processes, or 'none'). RATE_LIMITS / CONCURRENCY_LIMITS are JSON objects
+        # keyed by group or endpoint, merged over the defaults in services/rate_limiter.py
+        RATE_LIMIT_BACKEND=os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+        RATE_LIMIT_SQLITE_PATH=os.environ.get('RATE_LIMIT_SQLITE_PATH', os.path.join(app.instance_path, 'rate_limits.db')),
+        RATE_LIMITS=json.loads(os.environ.get('RATE_LIMITS') or '{}'),
+        CONCURRENCY_LIMITS=json.loads(os.environ.get('CONCURRENCY_LIMITS') or '{}'),
+        RATE_LIMIT_LEASE_SECONDS=int(os.environ.get('RATE_LIMIT_LEASE_SECONDS', 600)),
+        # Users resolved for JWT-protected requests (flask_jwt_extended.current_user)
+        USER_CACHE_TTL=int(os.environ.get('USER_CACHE_TTL', 60)),
+        USER_CACHE_MAX_ENTRIES=int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000)),
+        # Database performance profile (see database.py)
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 10)),
+        DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        DB_POOL_TIMEOUT=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        SQLITE_JOURNAL_MODE=os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        SQLITE_SYNCHRONOUS=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        SQLITE_BUSY_TIMEOUT_MS=int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        SQLITE_MMAP_SIZE=int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        # Optional engine for history/profile reads: a replica URL, or DB_READ_ENGINE=1 for
+        # a separate read-only pool on the same SQLite file
+        DATABASE_READ_URL=os.environ.get('DATABASE_READ_URL'),
+        DB_READ_ENGINE=os.environ.get('DB_READ_ENGINE', '0') == '1',
+        # Chat history sent to the model: newest messages within a token budget, older
+        # turns folded into a rolling summary (bounded input per summary update)
+        CHAT_HISTORY_TOKEN_BUDGET=int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', 3000)),
+        CHAT_SUMMARY_INPUT_TOKEN_BUDGET=int(os.environ.get('CHAT_SUMMARY_INPUT_TOKEN_BUDGET', 6000)),
+        # Cache of complete model responses for repeated prompts: 'memory', 'sqlite' or 'none'
+        RESPONSE_CACHE_BACKEND=os.environ.get('RESPONSE_CACHE_BACKEND', 'memory'),
+        RESPONSE_CACHE_TTL=int(os.environ.get('RESPONSE_CACHE_TTL', 3600)),
+        RESPONSE_CACHE_MAX_ENTRIES=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+        RESPONSE_CACHE_PATH=os.environ.get('RESPONSE_CACHE_PATH', os.path.join(app.instance_path, 'response_cache.db')),
+        # Model backend ('gemini' or the offline 'stub') and the cap on concurrent upstream calls
+        LLM_BACKEND=os.environ.get('LLM_BACKEND', 'gemini'),
+        LLM_MAX_IN_FLIGHT=int(os.environ.get('LLM_MAX_IN_FLIGHT', 8)),
+        LLM_MAX_QUEUE=int(os.environ.get('LLM_MAX_QUEUE', 32)),
+        LLM_QUEUE_TIMEOUT=float(os.environ.get('LLM_QUEUE_TIMEOUT', 10)),
+        # Build the model client in the background at startup instead of on the first
+        # chat request (serving workers); off for CLI commands and tests
+        LLM_PREWARM=os.environ.get('LLM_PREWARM', '0') == '1',
+        STUB_LLM_TOKEN_LATENCY=float(os.environ.get('STUB_LLM_TOKEN_LATENCY', 0.05)),
+        STUB_LLM_FIRST_TOKEN_LATENCY=float(os.environ.get('STUB_LLM_FIRST_TOKEN_LATENCY', 0.2)),
+        # Resumable SSE chat streams: buffered generations kept for reconnects
+        CHAT_STREAM_MAX_STREAMS=int(os.environ.get('CHAT_STREAM_MAX_STREAMS', 1000)),
+        CHAT_STREAM_MAX_CHUNKS=int(os.environ.get('CHAT_STREAM_MAX_CHUNKS', 2000)),
+        CHAT_STREAM_TTL=int(os.environ.get('CHAT_STREAM_TTL', 300)),
+        # Write-behind batching of chat message inserts (0 = commit inline per turn)
+        CHAT_WRITE_BEHIND=os.environ.get('CHAT_WRITE_BEHIND', '1') == '1',
+        CHAT_WRITE_BEHIND_BATCH_SIZE=int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 200)),
+        CHAT_WRITE_BEHIND_FLUSH_INTERVAL=float(os.environ.get('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.05)),
+        CHAT_WRITE_BEHIND_MAX_QUEUE=int(os.environ.get('CHAT_WRITE_BEHIND_MAX_QUEUE', 10000)),
+        # Hot/cold tiering: `flask compact-history` moves messages older than this into
+        # compressed archive segments ('gzip', or 'zstd' with the zstandard package)
+        ARCHIVE_AFTER_DAYS=int(os.environ.get('ARCHIVE_AFTER_DAYS', 90)),
+        ARCHIVE_SEGMENT_MESSAGES=int(os.environ.get('ARCHIVE_SEGMENT_MESSAGES', 1000)),
+        ARCHIVE_CODEC=os.environ.get('ARCHIVE_CODEC', 'gzip'),
+        # Rows per transaction when deleting history
+        HISTORY_DELETE_BATCH_SIZE=int(os.environ.get('HISTORY_DELETE_BATCH_SIZE', 1000)),
+        # Uploads: content-addressed blob storage and the per-upload size limit
+        BLOB_STORAGE_ROOT=os.environ.get('BLOB_STORAGE_ROOT', os.path.join(os.path.dirname(app.root_path), 'uploads', 'blobs')),
+        MAX_UPLOAD_BYTES=int(os.environ.get('MAX_UPLOAD_BYTES', 200 * 1024 * 1024)),
+        # Downloads: browser cache lifetime, and X-Sendfile to a fronting web server (Flask setting)
+        FILE_DOWNLOAD_MAX_AGE=int(os.environ.get('FILE_DOWNLOAD_MAX_AGE', 3600)),
+        USE_X_SENDFILE=os.environ.get('USE_X_SENDFILE', '0') == '1',
+        # On-disk cache of image thumbnails (requires Pillow), LRU-evicted past the byte limit
+        THUMBNAIL_CACHE_DIR=os.environ.get('THUMBNAIL_CACHE_DIR', os.path.join(os.path.dirname(app.root_path), 'uploads', 'thumbnails')),
+        THUMBNAIL_CACHE_MAX_BYTES=int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+        THUMBNAIL_SIZES=[int(s) for s in os.environ.get('THUMBNAIL_SIZES', '128,256,512').split(',')],
+        THUMBNAIL_QUALITY=int(os.environ.get('THUMBNAIL_QUALITY', 80)),
+        # Uploaded files attached to chat turns: prepared parts cached by content hash
+        ATTACHMENT_CACHE_MAX_BYTES=int(os.environ.get('ATTACHMENT_CACHE_MAX_BYTES', 128 * 1024 * 1024)),
+        ATTACHMENT_CACHE_TTL=int(os.environ.get('ATTACHMENT_CACHE_TTL', 3600)),
+        ATTACHMENT_MAX_DIMENSION=int(os.environ.get('ATTACHMENT_MAX_DIMENSION', 1536)), # Images are downscaled to this
+        ATTACHMENT_INLINE_MAX_BYTES=int(os.environ.get('ATTACHMENT_INLINE_MAX_BYTES', 15 * 1024 * 1024)),
+        ATTACHMENT_MAX_PER_MESSAGE=int(os.environ.get('ATTACHMENT_MAX_PER_MESSAGE', 5)),
+        # Background analysis of uploads (process pool; see services/analysis_worker.py).
+        # Set ANALYSIS_WORKER_IN_PROCESS=0 when running `flask analysis-worker` separately.
+        ANALYSIS_WORKER_IN_PROCESS=os.environ.get('ANALYSIS_WORKER_IN_PROCESS', '1') == '1',
+        ANALYSIS_CONCURRENCY=int(os.environ.get('ANALYSIS_CONCURRENCY', 2)),
+        ANALYSIS_MAX_ATTEMPTS=int(os.environ.get('ANALYSIS_MAX_ATTEMPTS', 3)),
+        ANALYSIS_RETRY_BASE_SECONDS=float(os.environ.get('ANALYSIS_RETRY_BASE_SECONDS', 30)),
+        ANALYSIS_POLL_INTERVAL=float(os.environ.get('ANALYSIS_POLL_INTERVAL', 5)),
+        ANALYSIS_LEASE_SECONDS=int(os.environ.get('ANALYSIS_LEASE_SECONDS', 600)),
+        ANALYSIS_ANALYZER=os.environ.get('ANALYSIS_ANALYZER', 'app.services.file_analysis:basic_analyzer'),
+        # How pool processes start: 'spawn' (default) or 'forkserver'; 'fork' copies the server's
+        # threads and open DB connections into every child
+        ANALYSIS_MP_CONTEXT=os.environ.get('ANALYSIS_MP_CONTEXT', 'spawn'),
+        # Threads used by the asyncio serving mode (asgi.py): DB work of the native chat
+        # route, and the WSGI bridge serving every other route (one per request/open stream)
+        ASGI_DB_THREADS=int(os.environ.get('ASGI_DB_THREADS', 4)),
+        ASGI_WSGI_THREADS=int(os.environ.get('ASGI_WSGI_THREADS', 32)),
+        HISTORY_CACHE_MAX_USERS=int(os.environ.get('HISTORY_CACHE_MAX_USERS', 1000)),
+        HISTORY_CACHE_MAX_BYTES=int(os.environ.get('HISTORY_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
     )
 
+    from .logging_config import configure_logging
+    configure_logging(app)
+
+    from .database import engine_options, init_database
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
     # Initialize extensions with app context
     db.init_app(app)
+    init_database(app)
     jwt.init_app(app)
     bcrypt.init_app(app)
+    # The services below are module-level singletons configured here, like the Flask
+    # extensions: import them anywhere, and they pick up this app's settings
+    from .services.password_hasher import password_hasher
+    password_hasher.init_app(app)
+    from .services.user_cache import user_cache
+    user_cache.init_app(app)
+    from .services.history_cache import history_cache
+    from .services.response_cache import response_cache
+    from .services.llm_backends import llm_pool
+    from .services.stream_buffer import stream_registry
+    from .services.chat_persister import chat_persister
+    from .services.blob_store import blob_store
+    from .services.analysis_worker import analysis_worker
+    from .services.thumbnail_cache import thumbnail_cache
+    from .services.attachment_cache import attachment_cache
+    from .services.rate_limiter import rate_limiter
+    from .services.search_service import message_search
+    from .services.history_archive import history_archive
+    history_cache.init_app(app)
+    response_cache.init_app(app)
+    llm_pool.init_app(app)
+    stream_registry.init_app(app)
+    chat_persister.init_app(app)
+    blob_store.init_app(app)
+    analysis_worker.init_app(app)
+    thumbnail_cache.init_app(app)
+    attachment_cache.init_app(app)
+    rate_limiter.init_app(app)
+    message_search.init_app(app)
+    history_archive.init_app(app)
+
+    # Request timing + GET /metrics; the services' stats() are exported as gauges
+    from .metrics import metrics
+    from .services.gemini_service import chat_flights
+    metrics.init_app(app)
+    for name, source in (
+        ('history_cache', history_cache), ('response_cache', response_cache), ('llm_pool', llm_pool),
+        ('chat_persister', chat_persister), ('thumbnail_cache', thumbnail_cache),
+        ('attachment_cache', attachment_cache), ('rate_limiter', rate_limiter),
+        ('password_hasher', password_hasher), ('user_cache', user_cache),
+        ('chat_flights', chat_flights), ('history_archive', history_archive),
+    ):
+        metrics.add_stats_source(name, source.stats)
+    metrics.add_stats_source('stream_registry', lambda: {"streams": len(stream_registry)})
     CORS(app, resources={r"/api/*": {"origins": "*"}}) # Allow frontend origin in production
 
     # Import and register Blueprints
@@ -37,9 +194,12 @@ def create_app():
         app.register_blueprint(files.files_bp, url_prefix='/api/files')
 
         # Import models here to ensure they are known to SQLAlchemy
-        # before db.create_all() is called in run.py
+        # before db.create_all() is called by `flask init-db`
         from . import models
 
+    from .cli import register_cli
+    register_cli(app)
+
     @app.route('/health')
     def health_check():
         return "Backend Healthy", 200
@@ -0,0 +1,231 @@
+# backend/app/asgi.py
+"""
+Asyncio serving mode.
+
+`POST /api/chat/` is handled natively on the event loop: the model stream is
+awaited (aget_gemini_response_stream) and database work runs on a small
+thread pool, so an in-flight generation costs a coroutine instead of a whole
+worker thread. Every other route is passed through to the regular Flask app
+(via a2wsgi's WSGIMiddleware), so the existing blueprints keep working unchanged.
+
+The bridge runs each passed-through request on its own thread from a pool of
+ASGI_WSGI_THREADS, and streams request and response bodies both ways, so
+uploads are not spooled and SSE responses (/api/chat/stream) are sent as they
+are produced. An open SSE stream or export holds one of those threads until
+it ends: size the pool for the streams you expect on top of regular traffic.
+
+Run with:  uvicorn asgi:app --port 5001   (from the backend directory)
+
+To actually serve thousands of concurrent streams, raise LLM_MAX_IN_FLIGHT /
+LLM_MAX_QUEUE to match what the provider allows.
+"""
+import asyncio
+import json
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from flask_jwt_extended import decode_token
+from app import create_app
+from app.services.gemini_service import aget_gemini_response_stream
+from app.services.chat_service import (
+    new_user_message, resolve_attachments, load_prompt_history, persist_chat_turn
+)
+from app.services.attachment_cache import AttachmentError
+from app.services.user_cache import user_cache
+from app.services.session_service import get_session
+from app.services.rate_limiter import rate_limiter, RateLimited
+from app.metrics import metrics, REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CHAT_PATHS = ('/api/chat', '/api/chat/')
+
+
+class ChatASGIApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(self._flask_wsgi, workers=flask_app.config.get('ASGI_WSGI_THREADS', 32))
+        # SQLite serializes writes anyway; a few threads keep DB calls off the event loop
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=flask_app.config.get('ASGI_DB_THREADS', 4), thread_name_prefix='asgi-db'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in CHAT_PATHS:
+            await self._timed(self.handle_chat, scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    def _flask_wsgi(self, environ, start_response):
+        # ASGI request bodies always end (the server de-chunks them), so Werkzeug may
+        # read chunked uploads without a Content-Length, as it does behind its own server
+        environ['wsgi.input_terminated'] = True
+        return self.flask_app(environ, start_response)
+
+    # --- Helpers ---
+    async def _timed(self, handler, scope, receive, send):
+        """The Flask timing middleware's measurement, for requests handled natively here."""
+        started = time.perf_counter()
+        status = []
+
+        async def send_and_note_status(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+        try:
+            await handler(scope, receive, send_and_note_status)
+        finally:
+            if metrics.enabled:
+                REQUEST_SECONDS.observe(time.perf_counter() - started, method='POST', endpoint='/api/chat/',
+                                        status=status[0] if status else 500)
+
+    def _in_app_context(self, fn, *args):
+        with self.flask_app.app_context():
+            return fn(*args)
+
+    async def run_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, self._in_app_context, fn, *args)
+
+    async def _read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    async def _send_json(self, send, status, payload, retry_after=None):
+        body = json.dumps(payload).encode('utf-8')
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'access-control-allow-origin', b'*'),
+        ]
+        if retry_after is not None:
+            headers.append((b'retry-after', str(max(1, math.ceil(retry_after))).encode('ascii')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _identity(self, scope):
+        """Returns (user_id, None) or (None, (status, message)) - mirrors flask_jwt_extended's responses."""
+        headers = dict(scope.get('headers') or [])
+        auth = headers.get(b'authorization', b'').decode('latin-1')
+        if not auth.startswith('Bearer '):
+            return None, (401, "Missing Authorization Header")
+        try:
+            with self.flask_app.app_context():
+                decoded = decode_token(auth[len('Bearer '):])
+        except Exception as e:
+            status = 401 if type(e).__name__ == 'ExpiredSignatureError' else 422
+            return None, (status, str(e))
+        if decoded.get('type') != 'access':
+            return None, (422, "Only non-refresh tokens are allowed")
+        return decoded[self.flask_app.config['JWT_IDENTITY_CLAIM']], None
+
+    async def _current_user(self, scope):
+        """
+        Like flask_jwt_extended's user loader on the WSGI side: resolves the user
+        through the shared user cache. Returns (UserSnapshot, None) or (None, error).
+        """
+        user_id, auth_error = self._identity(scope)
+        if auth_error:
+            return None, auth_error
+        user = await self.run_db(user_cache.get, user_id)
+        if user is None:
+            return None, (401, "User not found")
+        return user, None
+
+    # --- POST /api/chat/ ---
+    async def handle_chat(self, scope, receive, send):
+        user, auth_error = await self._current_user(scope)
+        if auth_error:
+            return await self._send_json(send, auth_error[0], {"msg": auth_error[1]})
+        current_user_id = user.id
+        # Same per-user admission control as @rate_limited('chat') on the WSGI routes
+        try:
+            lease = await self.run_db(rate_limiter.admit, 'chat', current_user_id, 'chat.handle_chat')
+        except RateLimited as e:
+            return await self._send_json(send, 429, {"msg": str(e)}, retry_after=e.retry_after)
+        try:
+            await self._handle_chat_turn(current_user_id, receive, send)
+        finally:
+            if lease is not None:
+                lease.release()
+
+    async def _handle_chat_turn(self, current_user_id, receive, send):
+
+        try:
+            data = json.loads(await self._read_body(receive) or b'null')
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('message'), str):
+            return await self._send_json(send, 400, {"msg": "Missing 'message' in request body"})
+        user_message_content = data['message'].strip()
+        if not user_message_content:
+            return await self._send_json(send, 400, {"msg": "Message content cannot be empty"})
+
+        logger.debug("Chat request received from user %s (async)", current_user_id)
+        session_id = data.get('session_id')
+        generate_title = False
+        if session_id is not None:
+            if not isinstance(session_id, int):
+                return await self._send_json(send, 400, {"msg": "'session_id' must be an integer"})
+            chat_session = await self.run_db(get_session, current_user_id, session_id)
+            if chat_session is None:
+                return await self._send_json(send, 404, {"msg": "Chat session not found"})
+            generate_title = chat_session.title is None
+        try:
+            # Reads (and on a cache miss, downscales) files: keep it off the event loop
+            attachments = await self.run_db(resolve_attachments, current_user_id, data.get('attachments'))
+        except AttachmentError as e:
+            return await self._send_json(send, 400, {"msg": str(e)})
+        user_message = new_user_message(current_user_id, user_message_content, attachments, session_id)
+        try:
+            formatted_history = await self.run_db(load_prompt_history, self.flask_app, current_user_id, session_id)
+        except Exception as e:
+            logger.exception("Error fetching chat history for user %s: %s", current_user_id, e)
+            return await self._send_json(send, 500, {"msg": "Failed to retrieve chat history"})
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/plain; charset=utf-8'),
+            (b'access-control-allow-origin', b'*'),
+        ]})
+
+        full_ai_response = ""
+        is_error_message = False
+        response_stream = aget_gemini_response_stream(formatted_history, user_message_content, attachments,
+                                                      user_id=current_user_id, session_id=session_id)
+        try:
+            async for chunk in response_stream:
+                if chunk.startswith("[SYSTEM:"):
+                    logger.info("Stream yielded system/error message: %s", chunk)
+                    full_ai_response = chunk
+                    is_error_message = True
+                    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+                    break # Stop if service sends error
+                full_ai_response += chunk
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        except Exception as e:
+            logger.exception("Error during async streaming/generation: %s", e)
+            is_error_message = True
+            full_ai_response = "[SYSTEM: Internal server error during response generation.]"
+            try:
+                await send({'type': 'http.response.body', 'body': full_ai_response.encode('utf-8'), 'more_body': True})
+            except Exception:
+                pass # Client already gone
+        finally:
+            # Persist off the event loop; shielded so a client disconnect doesn't lose the turn.
+            # A duplicate that followed an identical in-flight request is saved by that one.
+            if not response_stream.follower:
+                await asyncio.shield(self.run_db(
+                    persist_chat_turn, self.flask_app, current_user_id, user_message,
+                    full_ai_response, is_error_message, generate_title
+                ))
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def create_asgi_app():
+    """ASGI entry point: the async chat handler in front of the regular Flask app."""
+    return ChatASGIApp(create_app())
@@ -0,0 +1,46 @@
+# backend/app/cli.py
+# Flask CLI commands (`flask --app run <command>` from backend/).
+import click
+
+
+def register_cli(app):
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create or upgrade the database schema and search index (idempotent; data is kept)."""
+        from . import db
+        from .schema import upgrade_schema
+        changes = upgrade_schema(db.engine)
+        for change in changes:
+            click.echo(f"  {change}")
+        click.echo(f"Database schema up to date ({db.engine.url.render_as_string(hide_password=True)}).")
+
+    @app.cli.command('build-search-index')
+    @click.option('--rebuild', is_flag=True, help="Re-index every message, even if the index exists.")
+    def build_search_index_command(rebuild):
+        """Create the full-text search index and back-fill it from existing messages."""
+        from . import db
+        from .services.search_service import build_fts_index
+        if db.engine.dialect.name != 'sqlite':
+            click.echo("Full-text index is SQLite-only; search uses LIKE on this database.")
+            return
+        click.echo("Search index built." if build_fts_index(db.engine, rebuild) else "Search index already exists.")
+
+    @app.cli.command('analysis-worker')
+    @click.option('--concurrency', type=int, default=None, help="Worker processes (default: ANALYSIS_CONCURRENCY).")
+    def analysis_worker_command(concurrency):
+        """Run the upload analysis worker in the foreground."""
+        from .services.analysis_worker import analysis_worker
+        if concurrency:
+            analysis_worker.concurrency = concurrency
+        analysis_worker.run_forever()
+
+    @app.cli.command('compact-history')
+    @click.option('--older-than-days', type=int, default=None, help="Archive age (default: ARCHIVE_AFTER_DAYS).")
+    @click.option('--user-id', type=int, multiple=True, help="Only compact these users (repeatable).")
+    def compact_history_command(older_than_days, user_id):
+        """Move old chat messages into compressed archive segments."""
+        from .services.history_archive import history_archive
+        cutoff = history_archive.cutoff(older_than_days)
+        click.echo(f"Archiving messages older than {cutoff.isoformat()}Z...")
+        result = history_archive.compact(cutoff, user_ids=list(user_id) or None)
+        click.echo(f"Archived {result['messages']} messages for {result['users']} users.")
@@ -0,0 +1,79 @@
+# backend/app/database.py
+# Database performance profile: SQLite pragmas, pool sizing and optional read routing.
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from . import db
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the primary engine, from DB_* config."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {'pool_pre_ping': True}
+    if url.get_backend_name() == 'sqlite':
+        # sqlite3's own lock wait, in seconds (busy_timeout below is set in ms on every connection)
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000, 'check_same_thread': False}
+        if url.database in (None, '', ':memory:'):
+            return options # Single shared connection; pool sizing does not apply
+    options.update(
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+    )
+    return options
+
+
+def _apply_sqlite_pragmas(engine, config, read_only=False):
+    pragmas = [
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+    ]
+    if not read_only:
+        # journal_mode is persistent in the file; setting it needs a writable connection
+        pragmas.insert(0, f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def init_database(app):
+    """
+    Call after db.init_app. Installs the SQLite pragmas on the primary engine and,
+    if configured, creates the read engine used for history/profile reads:
+    DATABASE_READ_URL (e.g. a replica), or with DB_READ_ENGINE=1 on SQLite a
+    separate read-only connection pool on the same file.
+    """
+    config = app.config
+    with app.app_context():
+        primary = db.engine
+    if primary.dialect.name == 'sqlite':
+        _apply_sqlite_pragmas(primary, config)
+
+    read_engine = None
+    if config.get('DATABASE_READ_URL'):
+        read_engine = create_engine(config['DATABASE_READ_URL'], **engine_options(
+            dict(config, SQLALCHEMY_DATABASE_URI=config['DATABASE_READ_URL'])
+        ))
+    elif config.get('DB_READ_ENGINE') and primary.dialect.name == 'sqlite' and primary.url.database not in (None, '', ':memory:'):
+        read_url = f"sqlite:///file:{primary.url.database}?mode=ro&uri=true"
+        read_engine = create_engine(read_url, **engine_options(dict(config, SQLALCHEMY_DATABASE_URI=read_url)))
+    if read_engine is not None and read_engine.dialect.name == 'sqlite':
+        _apply_sqlite_pragmas(read_engine, config, read_only=True)
+    app.extensions['medai_read_engine'] = read_engine
+
+
+def read_bind():
+    """
+    `bind_arguments` for session.execute() that routes a read to the read engine
+    (falls back to the primary when none is configured). Only for reads that
+    can tolerate replica lag.
+    """
+    from flask import current_app
+    engine = current_app.extensions.get('medai_read_engine')
+    return {'bind': engine} if engine is not None else None
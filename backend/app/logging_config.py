@@ -0,0 +1,45 @@
+# backend/app/logging_config.py
+# Leveled, optionally JSON-structured logging for the `app` package.
+import json
+import logging
+import sys
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line; `extra={...}` fields become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(app):
+    """
+    Routes every `app.*` logger to stderr at LOG_LEVEL, as text or JSON
+    (LOG_FORMAT). Per-request chatter is logged at DEBUG, so the default INFO
+    level keeps it - and its formatting cost - off the hot paths.
+    """
+    logger = logging.getLogger('app')
+    logger.setLevel(app.config.get('LOG_LEVEL', 'INFO').upper())
+    if logger.handlers: # create_app may run several times in one process (tests, CLI)
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    if app.config.get('LOG_FORMAT') == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(handler)
+    logger.propagate = False
@@ -0,0 +1,222 @@
+# backend/app/metrics.py
+# Request timing, named spans and the Prometheus text endpoint (GET /metrics).
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, abort, g, request
+
+# Clients allowed to scrape /metrics when no METRICS_TOKEN is configured
+LOOPBACK_ADDRS = ('127.0.0.1', '::1')
+
+# Seconds; spans from sub-millisecond cache hits up to long model streams
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CHUNK_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels (Prometheus semantics)."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f"{self.name}_bucket{labels} {values[-1]}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics. Histograms and counters are recorded by the code they
+    time; the stats() of the caches, pools and queues are read as gauges when
+    /metrics is scraped (`add_stats_source`). With several worker processes,
+    each exposes its own numbers - scrape them per process, or aggregate in
+    Prometheus.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.token = None
+        self._metrics = []
+        self._stats_sources = {}
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def add_stats_source(self, name, stats_fn):
+        """Exports the numeric values of `stats_fn()` as gauges named medai_<name>_<key>."""
+        self._stats_sources[name] = stats_fn
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.token = app.config.get('METRICS_TOKEN') or None
+        if not self.enabled:
+            return
+
+        @app.before_request
+        def start_timer():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def record_request(response):
+            started = g.pop('metrics_started', None)
+            if started is None:
+                return response
+            endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            method, status = request.method, response.status_code
+
+            def observe():
+                REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                        method=method, endpoint=endpoint, status=status)
+            # Streamed bodies (chat, SSE, exports) are timed until the last byte is sent
+            if response.is_streamed:
+                response.call_on_close(observe)
+            else:
+                observe()
+            return response
+
+        @app.route('/metrics')
+        def metrics_endpoint():
+            if not self.scrape_allowed():
+                abort(404) # Don't advertise the endpoint to the public
+            return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def scrape_allowed(self):
+        """
+        With METRICS_TOKEN set, scrapers must send it as a bearer token. Without
+        one, only direct loopback clients may scrape: requests forwarded by a
+        reverse proxy (which connects from loopback too) are refused.
+        """
+        if self.token:
+            auth = request.headers.get('Authorization', '')
+            return auth.startswith('Bearer ') and hmac.compare_digest(
+                auth[len('Bearer '):].encode('utf-8'), self.token.encode('utf-8'))
+        if 'X-Forwarded-For' in request.headers or 'Forwarded' in request.headers:
+            return False
+        return request.remote_addr in LOOPBACK_ADDRS
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for source, stats_fn in sorted(self._stats_sources.items()):
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                lines.append(f"# {source} stats unavailable: {type(e).__name__}")
+                continue
+            for key, value in sorted(stats.items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    name = f"medai_{source}_{key}"
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+REQUEST_SECONDS = metrics.histogram(
+    'medai_http_request_duration_seconds', "HTTP request duration, until the response body is fully sent.",
+    ['method', 'endpoint', 'status']
+)
+SPAN_SECONDS = metrics.histogram(
+    'medai_span_seconds', "Duration of named steps of a chat turn (history_query, history_format, "
+    "upstream_first_chunk, upstream_stream, db_commit, ...).", ['span']
+)
+STREAM_CHUNKS = metrics.histogram(
+    'medai_stream_chunks', "Chunks per model response stream.", ['source'], buckets=CHUNK_BUCKETS
+)
+RESPONSES = metrics.counter(
+    'medai_llm_responses_total', "Chat responses by where they came from (upstream, cache, coalesced).", ['source']
+)
+
+
+def observe_span(name, seconds):
+    if metrics.enabled:
+        SPAN_SECONDS.observe(seconds, span=name)
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block into medai_span_seconds{span=name}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - started)
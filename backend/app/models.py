@@ -1,5 +1,6 @@
-from . import db, bcrypt
+from . import db
 from datetime import datetime
+from app.services.password_hasher import password_hasher
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -8,40 +9,161 @@ class User(db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Both run bcrypt on the bounded hashing pool and may raise PasswordHasherBusy
     def set_password(self, password):
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
 
     def __repr__(self):
         return f'<User {self.username}>'
 
+class ChatSession(db.Model):
+    """
+    One conversation. last_message_at and message_count are denormalized
+    (maintained on every insert), so listing sessions never touches chat_message.
+    """
+    # Session list: a user's conversations, most recently active first (keyset pagination)
+    __table_args__ = (
+        db.Index('ix_chat_session_user_id_last_message_at_id', 'user_id', 'last_message_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(100), nullable=True) # Generated after the first exchange
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow) # created_at until the first message
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+
+    user = db.relationship('User', backref=db.backref('chat_sessions', lazy=True))
+
+    def __repr__(self):
+        return f'<ChatSession {self.id} of user {self.user_id}>'
+
 class ChatMessage(db.Model):
+    # Composite indexes backing the time-ordered history reads (keyset pagination),
+    # per user and per session
+    __table_args__ = (
+        db.Index('ix_chat_message_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_chat_message_session_id_timestamp_id', 'session_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     sender = db.Column(db.String(10), nullable=False) # 'user' or 'ai'
     content_type = db.Column(db.String(20), default='text') # 'text', 'file_ref'
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    # Optional: session_id for grouping messages
+    attachment_ids = db.Column(db.Text, nullable=True) # JSON list of UploadedFile ids sent with this message
+    # Conversation this message belongs to; NULL for the default (pre-sessions) conversation
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=True)
 
     user = db.relationship('User', backref=db.backref('messages', lazy=True))
 
     def __repr__(self):
         return f'<Message {self.id} by {self.sender}>'
 
+class ChatArchiveSegment(db.Model):
+    """
+    Cold storage for old messages of one conversation: up to ARCHIVE_SEGMENT_MESSAGES
+    rows, oldest first, as one compressed JSON blob. Written by the compaction job
+    (history_archive), which deletes the archived rows from chat_message.
+    """
+    # Segment lookups by conversation and position range
+    __table_args__ = (
+        db.Index('ix_chat_archive_segment_user_id_last', 'user_id', 'last_timestamp', 'last_message_id'),
+        db.Index('ix_chat_archive_segment_session_id_last', 'session_id', 'last_timestamp', 'last_message_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=True)
+    # (timestamp, id) positions of the first and last message, for keyset reads
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    codec = db.Column(db.String(10), nullable=False) # 'gzip' or 'zstd'
+    raw_size = db.Column(db.Integer, nullable=False) # Uncompressed bytes
+    payload = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ChatArchiveSegment {self.id} of user {self.user_id} ({self.message_count} messages)>'
+
+class ConversationSummary(db.Model):
+    """Rolling summary of a conversation's older messages that no longer fit the prompt's token budget."""
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'session_id', name='uq_conversation_summary_user_id_session_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=True) # NULL: default conversation
+    content = db.Column(db.Text, nullable=False)
+    # Position (timestamp, id) of the newest message folded into the summary
+    covered_until_timestamp = db.Column(db.DateTime, nullable=False)
+    covered_until_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ConversationSummary for user {self.user_id} session {self.session_id}>'
+
+class FileBlob(db.Model):
+    """Content-addressed file body shared by every UploadedFile with the same SHA-256."""
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    storage_path = db.Column(db.String(512), nullable=False) # Relative to BLOB_STORAGE_ROOT
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<FileBlob {self.sha256[:12]} refs={self.ref_count}>'
+
+class UploadSession(db.Model):
+    """Resumable multi-part upload in progress (parts are appended to a temp file in order)."""
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    mime_type = db.Column(db.String(100))
+    total_size = db.Column(db.BigInteger, nullable=True) # Declared by the client, if known
+    received_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received_bytes}/{self.total_size}>'
+
 class UploadedFile(db.Model):
+    # Analysis job queue lookups: pending files whose retry time has come
+    __table_args__ = (
+        db.Index('ix_uploaded_file_status_next_attempt', 'ai_analysis_status', 'analysis_next_attempt_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
-    filepath = db.Column(db.String(512), nullable=False) # Store path relative to an upload folder
+    filepath = db.Column(db.String(512), nullable=False) # Absolute path of the stored body (the blob for new uploads)
+    blob_id = db.Column(db.Integer, db.ForeignKey('file_blob.id'), nullable=True, index=True) # NULL for pre-dedup uploads
+    size = db.Column(db.BigInteger, nullable=True)
     mime_type = db.Column(db.String(100))
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
     ai_analysis_status = db.Column(db.String(50), default='pending') # pending, processing, complete, failed
     ai_metadata = db.Column(db.Text, nullable=True) # Store JSON summary/results here
+    # Analysis job bookkeeping (see services/analysis_worker.py)
+    analysis_attempts = db.Column(db.Integer, nullable=False, default=0)
+    analysis_next_attempt_at = db.Column(db.DateTime, nullable=True) # Retry backoff; NULL = run now
+    analysis_claimed_at = db.Column(db.DateTime, nullable=True) # Lease start while 'processing'
+    analysis_error = db.Column(db.Text, nullable=True)
 
     user = db.relationship('User', backref=db.backref('files', lazy=True))
+    blob = db.relationship('FileBlob')
 
     def __repr__(self):
         return f'<File {self.filename}>'
\ No newline at end of file
@@ -1,13 +1,21 @@
 # backend/app/routes/auth.py
-
+import logging
 from flask import Blueprint, request, jsonify
-from app import db, bcrypt
+from app import db
 from app.models import User
-from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
+from app.services.password_hasher import PasswordHasherBusy
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, current_user
 from sqlalchemy.exc import IntegrityError
 
 # Define the Blueprint
 auth_bp = Blueprint('auth', __name__)
+logger = logging.getLogger(__name__)
+
+
+def _hasher_busy_response():
+    response = jsonify({"msg": "Too many sign-in requests right now. Please try again in a moment."})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 @auth_bp.route('/signup', methods=['POST'])
 def signup():
@@ -27,7 +35,10 @@ def signup():
 
     # Create new user instance
     new_user = User(username=username, email=email)
-    new_user.set_password(password) # Hashes the password
+    try:
+        new_user.set_password(password) # Hashes the password (on the bcrypt pool)
+    except PasswordHasherBusy:
+        return _hasher_busy_response()
 
     # Add user to database
     try:
@@ -38,11 +49,11 @@ def signup():
     except IntegrityError as e:
         db.session.rollback()
         # This might catch unique constraint violations if the first check missed a race condition
-        print(f"Database integrity error during signup: {e}")
+        logger.warning("Database integrity error during signup: %s", e)
         return jsonify({"msg": "Failed to create user due to a database conflict."}), 409
     except Exception as e:
         db.session.rollback()
-        print(f"Error during user creation: {e}") # Log the detailed error server-side
+        logger.exception("Error during user creation: %s", e) # Log the detailed error server-side
         return jsonify({"msg": "An unexpected error occurred during signup."}), 500
 
 
@@ -60,7 +71,14 @@ def login():
     user = User.query.filter_by(username=username).first()
 
     # Verify user existence and password correctness
-    if user and user.check_password(password):
+    try:
+        password_ok = user is not None and user.check_password(password)
+    except PasswordHasherBusy:
+        return _hasher_busy_response()
+
+    if password_ok:
+        if user.password_needs_rehash():
+            _upgrade_password_hash(user, password)
         # Generate JWT tokens
         access_token = create_access_token(identity=user.id)
         # Refresh tokens are good practice for extending sessions without re-login
@@ -77,6 +95,16 @@ def login():
         # Keep the error message generic for security
         return jsonify({"msg": "Bad username or password"}), 401 # 401 Unauthorized
 
+def _upgrade_password_hash(user, password):
+    """Re-hashes at the current BCRYPT_LOG_ROUNDS after the cost was changed. Best effort."""
+    try:
+        user.set_password(password)
+        db.session.commit()
+        logger.info("Upgraded password hash for user %s.", user.id)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Could not upgrade password hash for user %s: %s", user.id, e)
+
 @auth_bp.route('/refresh', methods=['POST'])
 @jwt_required(refresh=True) # Requires a valid refresh token
 def refresh():
@@ -86,26 +114,21 @@ def refresh():
     return jsonify(access_token=new_access_token), 200
 
 # Example Protected Route (demonstrates getting identity)
+# `current_user` is resolved by the JWT user loader (services/user_cache.py):
+# a cached snapshot, so these endpoints don't touch the database. Requests for a
+# deleted user are rejected with 401 before reaching the view.
 @auth_bp.route('/whoami', methods=['GET'])
 @jwt_required() # Requires a valid access token
 def whoami():
     """Example endpoint to check the current user identity from the token."""
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    if user:
-         return jsonify(logged_in_as={"userId": user.id, "username": user.username}), 200
-    else:
-         return jsonify({"msg": "User not found"}), 404 # Should ideally not happen if token is valid
+    return jsonify(logged_in_as={"userId": current_user.id, "username": current_user.username}), 200
 
 # Placeholder for Profile endpoints (could be moved to a separate profile.py blueprint)
+# (Profile updates must go through the ORM, which invalidates the cached user.)
 @auth_bp.route('/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
-     current_user_id = get_jwt_identity()
-     user = User.query.get(current_user_id)
-     if user:
-         return jsonify(id=user.id, username=user.username, email=user.email, created_at=user.created_at), 200
-     else:
-        return jsonify({"msg": "User not found"}), 404
+     return jsonify(id=current_user.id, username=current_user.username, email=current_user.email,
+                    created_at=current_user.created_at), 200
 
 # NOTE: Add endpoints for password reset, profile updates, 2FA setup/verification etc. as needed.
\ No newline at end of file
@@ -1,21 +1,58 @@
 # backend/app/routes/chat.py
-from flask import Blueprint, request, jsonify, Response, stream_with_context
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
+from flask_jwt_extended import jwt_required, current_user
 from app import db
-from app.models import ChatMessage, User
-from app.services.gemini_service import get_gemini_response_stream, format_history_for_gemini
-import datetime
+from app.models import ChatSession, ConversationSummary
+from app.services.gemini_service import get_gemini_response_stream
+from app.services.history_service import (
+    fetch_history_page, encode_cursor, serialize_message, parse_since, stream_export,
+    InvalidCursor, DEFAULT_PAGE_SIZE
+)
+from app.services.chat_service import (
+    new_user_message, resolve_attachments, load_prompt_history, persist_chat_turn, start_buffered_generation
+)
+from app.services.attachment_cache import AttachmentError
+from app.services.stream_buffer import stream_registry, StreamGone
+from app.services.history_cache import history_cache
+from app.services.chat_persister import chat_persister
+from app.services.session_service import (
+    create_session, get_session, list_sessions, delete_session, serialize_session, session_cursor,
+    DEFAULT_SESSION_PAGE_SIZE
+)
+from app.services.rate_limiter import rate_limited, take_lease
+from app.services.history_archive import purge_history
+from app.services.search_service import message_search, InvalidSearchQuery, DEFAULT_SEARCH_PAGE_SIZE
+import json
+import logging
 
 chat_bp = Blueprint('chat', __name__)
+logger = logging.getLogger(__name__)
+
+
+def _chat_session_from_request(user_id, data):
+    """
+    Resolves the optional 'session_id' of a chat request. Returns
+    (chat_session or None, error response or None); no id means the user's
+    default (sessionless) conversation.
+    """
+    session_id = data.get('session_id')
+    if session_id is None:
+        return None, None
+    if not isinstance(session_id, int):
+        return None, (jsonify({"msg": "'session_id' must be an integer"}), 400)
+    chat_session = get_session(user_id, session_id)
+    if chat_session is None:
+        return None, (jsonify({"msg": "Chat session not found"}), 404)
+    return chat_session, None
+
 
 # --- POST /api/chat/ (Handle new message) ---
 # (Keep the existing POST route as it was in the previous version)
 @chat_bp.route('/', methods=['POST'])
 @jwt_required()
+@rate_limited('chat')
 def handle_chat():
-    current_user_id = get_jwt_identity()
-    if not current_user_id:
-         return jsonify({"msg": "Authentication required"}), 401
+    current_user_id = current_user.id
 
     data = request.get_json()
     if not data or 'message' not in data:
@@ -25,43 +62,43 @@ def handle_chat():
     if not user_message_content:
         return jsonify({"msg": "Message content cannot be empty"}), 400
 
-    print(f"Chat request received from user {current_user_id}")
+    logger.debug("Chat request received from user %s", current_user_id)
+
+    # Optional 'session_id': the conversation to continue (see /api/chat/sessions)
+    chat_session, error = _chat_session_from_request(current_user_id, data)
+    if error:
+        return error
+    session_id = chat_session.id if chat_session else None
+    generate_title = chat_session is not None and chat_session.title is None
+
+    # Optional 'attachments': ids of the user's uploaded files to send with the message
+    try:
+        attachments = resolve_attachments(current_user_id, data.get('attachments'))
+    except AttachmentError as e:
+        return jsonify({"msg": str(e)}), 400
 
     # 1. Create User Message object (don't save yet)
-    user_message = ChatMessage(
-        user_id=current_user_id,
-        sender='user',
-        content=user_message_content,
-        content_type='text',
-        timestamp=datetime.datetime.utcnow()
-    )
+    user_message = new_user_message(current_user_id, user_message_content, attachments, session_id)
 
-    # 2. Get conversation history from DB
+    # 2./3. Get conversation history (cached window + rolling summary) formatted for Gemini
+    app = current_app._get_current_object()
     try:
-        MAX_HISTORY = 20 # Limit history depth
-        db_history = ChatMessage.query.filter_by(user_id=current_user_id)\
-                                    .order_by(ChatMessage.timestamp.desc())\
-                                    .limit(MAX_HISTORY).all()
-        db_history.reverse() # Chronological order
-        print(f"Fetched last {len(db_history)} messages for history.")
+        formatted_history = load_prompt_history(app, current_user_id, session_id)
     except Exception as e:
-        print(f"Error fetching chat history for user {current_user_id}: {e}")
+        logger.exception("Error fetching chat history for user %s: %s", current_user_id, e)
         return jsonify({"msg": "Failed to retrieve chat history"}), 500
 
-    # 3. Format history for the Gemini API
-    formatted_history = format_history_for_gemini(db_history)
-
     # 4. Define the streaming generator function
     def generate_ai_response_stream():
         full_ai_response = ""
-        ai_message_saved = False
         is_error_message = False
+        stream = get_gemini_response_stream(formatted_history, user_message_content, attachments,
+                                            user_id=current_user_id, session_id=session_id)
 
         try:
-            stream = get_gemini_response_stream(formatted_history, user_message_content)
             for chunk in stream:
                 if chunk.startswith("[SYSTEM:"):
-                    print(f"Stream yielded system/error message: {chunk}")
+                    logger.info("Stream yielded system/error message: %s", chunk)
                     full_ai_response = chunk
                     is_error_message = True
                     yield chunk
@@ -70,71 +107,362 @@ def handle_chat():
                     full_ai_response += chunk
                     yield chunk
         except Exception as e:
-            print(f"CRITICAL ERROR during streaming/generation: {e}")
+            logger.exception("Error during streaming/generation: %s", e)
             is_error_message = True
             full_ai_response = "[SYSTEM: Internal server error during response generation.]"
             yield full_ai_response
         finally:
-            # 5. Attempt to commit messages AFTER stream processing
-            db.session.add(user_message)
-            if full_ai_response and not is_error_message:
-                ai_message = ChatMessage(
-                    user_id=current_user_id, sender='ai', content=full_ai_response.strip(),
-                    content_type='text', timestamp=datetime.datetime.utcnow()
-                )
-                db.session.add(ai_message)
-                ai_message_saved = True
-                print("Stream finished. Added AI message to session.")
+            # 5. Attempt to commit messages AFTER stream processing (a duplicate request
+            # that followed an identical one in flight leaves that to the original)
+            if stream.follower:
+                logger.info("Duplicate chat request from user %s served from in-flight generation; not saving it again.",
+                            current_user_id)
             else:
-                print(f"Stream yielded error or empty. Not adding AI message. Content: '{full_ai_response[:100]}...'")
-
-            try:
-                db.session.commit()
-                # ... (logging) ...
-            except Exception as commit_error:
-                db.session.rollback()
-                print(f"DATABASE ERROR: Failed to commit messages: {commit_error}. Rolling back session.")
+                persist_chat_turn(app, current_user_id, user_message, full_ai_response, is_error_message,
+                                  generate_title=generate_title)
 
     # Return the streaming response
     return Response(stream_with_context(generate_ai_response_stream()), mimetype='text/plain')
 
-# --- GET /api/chat/history (Fetch history) ---
-# (Keep the existing GET route as it was)
+# --- POST /api/chat/stream (Server-Sent Events variant, resumable) ---
+# Same request body as POST /api/chat/: {"message": ..., "attachments": [fileId, ...]?, "session_id": ...?}.
+# The response is an SSE stream:
+#   event: stream  data: {"stream_id": ...}      (first event)
+#   event: chunk   data: {"text": ...}           id: <stream_id>:<seq>
+#   event: done    data: {}
+# The generation runs on the server independently of the connection and its chunks
+# are buffered. To resume after a drop, re-send the request (or GET
+# /api/chat/stream/<stream_id>) with a `Last-Event-ID` header: the buffered chunks
+# after that id are replayed and no new model call is made.
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _parse_last_event_id():
+    """Returns (stream_id, next_seq) from the Last-Event-ID header / query param, or (None, 0)."""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if not last_event_id:
+        return None, 0
+    stream_id, _, seq = last_event_id.partition(':')
+    try:
+        return stream_id, int(seq) + 1
+    except ValueError:
+        return stream_id, 0
+
+
+def _is_resume():
+    """A reconnect to a buffered stream: it starts no generation, so it isn't rate limited."""
+    return _parse_last_event_id()[0] is not None
+
+
+def _sse_response(stream, start_seq):
+    def generate_events():
+        if start_seq == 0:
+            yield _sse_event('stream', {"stream_id": stream.id})
+        seq = start_seq
+        while True:
+            try:
+                chunks, done = stream.read_from(seq, timeout=SSE_KEEPALIVE_SECONDS)
+            except StreamGone as e:
+                yield _sse_event('error', {"msg": str(e)})
+                return
+            for chunk_seq, chunk in chunks:
+                yield _sse_event('chunk', {"text": chunk}, event_id=f"{stream.id}:{chunk_seq}")
+                seq = chunk_seq + 1
+            if done and not chunks:
+                yield _sse_event('done', {})
+                return
+            if not chunks:
+                yield ": keepalive\n\n"
+
+    response = Response(generate_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Don't let nginx buffer the stream
+    return response
+
+
+@chat_bp.route('/stream', methods=['POST'])
+@jwt_required()
+@rate_limited('chat', unless=_is_resume)
+def handle_chat_sse():
+    current_user_id = current_user.id
+
+    # Reconnect: resume from the buffer instead of starting a new upstream call
+    stream_id, start_seq = _parse_last_event_id()
+    if stream_id:
+        stream = stream_registry.get(stream_id, current_user_id)
+        if stream is None:
+            return jsonify({"msg": "Stream not found or expired"}), 404
+        logger.debug("Resuming stream %s for user %s at chunk %d", stream_id, current_user_id, start_seq)
+        return _sse_response(stream, start_seq)
+
+    data = request.get_json()
+    if not data or 'message' not in data:
+        return jsonify({"msg": "Missing 'message' in request body"}), 400
+    user_message_content = data.get('message').strip()
+    if not user_message_content:
+        return jsonify({"msg": "Message content cannot be empty"}), 400
+
+    logger.debug("SSE chat request received from user %s", current_user_id)
+    chat_session, error = _chat_session_from_request(current_user_id, data)
+    if error:
+        return error
+    session_id = chat_session.id if chat_session else None
+    try:
+        attachments = resolve_attachments(current_user_id, data.get('attachments'))
+    except AttachmentError as e:
+        return jsonify({"msg": str(e)}), 400
+    user_message = new_user_message(current_user_id, user_message_content, attachments, session_id)
+    app = current_app._get_current_object()
+    try:
+        formatted_history = load_prompt_history(app, current_user_id, session_id)
+    except Exception as e:
+        logger.exception("Error fetching chat history for user %s: %s", current_user_id, e)
+        return jsonify({"msg": "Failed to retrieve chat history"}), 500
+
+    stream = stream_registry.create(current_user_id)
+    # The generation outlives this connection, so it holds the concurrency lease until it finishes
+    start_buffered_generation(app, stream, current_user_id, user_message, formatted_history, attachments,
+                              generate_title=chat_session is not None and chat_session.title is None,
+                              lease=take_lease())
+    return _sse_response(stream, 0)
+
+
+@chat_bp.route('/stream/<stream_id>', methods=['GET'])
+@jwt_required()
+def resume_chat_sse(stream_id):
+    """EventSource-friendly resume: replays buffered chunks after Last-Event-ID (or from the start)."""
+    current_user_id = current_user.id
+    stream = stream_registry.get(stream_id, current_user_id)
+    if stream is None:
+        return jsonify({"msg": "Stream not found or expired"}), 404
+    last_stream_id, start_seq = _parse_last_event_id()
+    if last_stream_id and last_stream_id != stream_id:
+        start_seq = 0
+    return _sse_response(stream, start_seq)
+
+# --- GET /api/chat/history (Fetch history, keyset-paginated) ---
+# Query params: limit (default 50, max 200), session_id (one session's messages
+# only) and at most one of before/after, where before/after are opaque cursors
+# taken from a previous response.
 @chat_bp.route('/history', methods=['GET'])
 @jwt_required()
 def get_history():
-    current_user_id = get_jwt_identity()
-    print(f"Fetching history for user {current_user_id}")
-    try:
-        messages = ChatMessage.query.filter_by(user_id=current_user_id)\
-                                    .order_by(ChatMessage.timestamp.asc()).all()
-        output = [{
-            "id": msg.id, "sender": msg.sender, "content": msg.content,
-            "content_type": msg.content_type, "timestamp": msg.timestamp.isoformat() + 'Z'
-        } for msg in messages]
-        return jsonify(output), 200
+    current_user_id = current_user.id
+    logger.debug("Fetching history for user %s", current_user_id)
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"msg": "'limit' must be an integer"}), 400
+    session_id = request.args.get('session_id', type=int)
+
+    try:
+        messages, has_more = fetch_history_page(
+            current_user_id,
+            before=request.args.get('before'),
+            after=request.args.get('after'),
+            limit=limit,
+            session_id=session_id
+        )
+    except InvalidCursor as e:
+        return jsonify({"msg": str(e)}), 400
     except Exception as e:
-         print(f"Error fetching history for user {current_user_id}: {e}")
+         logger.exception("Error fetching history for user %s: %s", current_user_id, e)
          return jsonify({"msg": "Failed to retrieve history"}), 500
 
+    return jsonify({
+        "messages": [serialize_message(msg) for msg in messages],
+        "has_more": has_more,
+        # Pass as ?before= to page back to older messages, ?after= to poll for newer ones
+        "before_cursor": encode_cursor(messages[0]) if messages else None,
+        "after_cursor": encode_cursor(messages[-1]) if messages else request.args.get('after'),
+    }), 200
+
+# --- GET /api/chat/search (Full-text search over the user's messages) ---
+# Query params: q (required), session_id (optional), limit (default 20, max 50)
+# and offset (from next_offset of the previous page). Returns ranked matches
+# with highlighted snippets - never whole messages or histories.
+@chat_bp.route('/search', methods=['GET'])
+@jwt_required()
+@rate_limited('search')
+def search_history():
+    current_user_id = current_user.id
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"msg": "Missing search query 'q'"}), 400
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SEARCH_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"msg": "'limit' and 'offset' must be integers"}), 400
+    session_id = request.args.get('session_id', type=int)
+
+    try:
+        results, has_more = message_search.search(
+            current_user_id, query, session_id=session_id, limit=limit, offset=offset
+        )
+    except InvalidSearchQuery as e:
+        return jsonify({"msg": str(e)}), 400
+    except Exception as e:
+        logger.exception("Error searching history for user %s: %s", current_user_id, e)
+        return jsonify({"msg": "Search failed"}), 500
+
+    return jsonify({
+        "results": results,
+        "has_more": has_more,
+        "next_offset": max(0, offset) + len(results) if has_more else None,
+    }), 200
+
+# --- GET /api/chat/export (Stream full history for compliance exports) ---
+# Query params: format=ndjson (default) | json, since=<ISO 8601> for incremental exports.
+# The body is generated row batch by row batch, so memory stays flat regardless of history size.
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+
+@chat_bp.route('/export', methods=['GET'])
+@jwt_required()
+@rate_limited('export')
+def export_history():
+    current_user_id = current_user.id
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({"msg": "'format' must be 'ndjson' or 'json'"}), 400
+    try:
+        since = parse_since(request.args.get('since'))
+    except InvalidCursor as e:
+        return jsonify({"msg": str(e)}), 400
+
+    logger.info("Streaming %s history export for user %s (since=%s)", fmt, current_user_id, since)
+    response = Response(
+        stream_with_context(stream_export(current_user_id, since=since, fmt=fmt)),
+        mimetype=EXPORT_MIMETYPES[fmt]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="medai-history-{current_user_id}.{fmt}"'
+    return response
+
 # --- DELETE /api/chat/history (Clear history) --- ADD THIS NEW ROUTE ---
 @chat_bp.route('/history', methods=['DELETE'])
 @jwt_required()
 def delete_history():
     """Deletes all chat messages for the currently authenticated user."""
-    current_user_id = get_jwt_identity()
-    print(f"Received request to delete ALL chat history for user {current_user_id}")
+    current_user_id = current_user.id
+    logger.info("Received request to delete ALL chat history for user %s", current_user_id)
 
     try:
+        # Let queued write-behind inserts land first so none reappear after the delete
+        chat_persister.flush()
         # Perform the delete operation
-        num_deleted = ChatMessage.query.filter_by(user_id=current_user_id).delete()
+        # Messages (hot and archived) go in bounded batches so other writers aren't locked out
+        num_deleted = purge_history(current_user_id, batch_size=current_app.config['HISTORY_DELETE_BATCH_SIZE'])
+        ConversationSummary.query.filter_by(user_id=current_user_id).delete()
+        ChatSession.query.filter_by(user_id=current_user_id).delete()
         # Commit the changes to the database
         db.session.commit()
-        print(f"Deleted {num_deleted} messages for user {current_user_id}.")
+        history_cache.invalidate_user(current_user_id)
+        logger.info("Deleted %d messages for user %s.", num_deleted, current_user_id)
         return jsonify({"msg": f"Successfully deleted {num_deleted} messages."}), 200
     except Exception as e:
         # Rollback in case of error during delete or commit
         db.session.rollback()
-        print(f"Error deleting history for user {current_user_id}: {e}")
+        logger.exception("Error deleting history for user %s: %s", current_user_id, e)
         return jsonify({"msg": "Failed to delete chat history due to a server error."}), 500
-# --- END OF NEW ROUTE ---
\ No newline at end of file
+# --- END OF NEW ROUTE ---
+
+
+# --- /api/chat/sessions (Conversations) ---
+# A session groups the messages of one conversation; send its id as 'session_id'
+# with POST /api/chat/ or /api/chat/stream to continue it. Listing reads only the
+# chat_session table: last_message_at and message_count are kept up to date as
+# messages are saved, and the title is generated in the background after the
+# first exchange.
+@chat_bp.route('/sessions', methods=['GET'])
+@jwt_required()
+def get_sessions():
+    """Lists the user's sessions, most recently active first. Query params: limit, before (cursor)."""
+    current_user_id = current_user.id
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SESSION_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"msg": "'limit' must be an integer"}), 400
+    try:
+        sessions, has_more = list_sessions(current_user_id, before=request.args.get('before'), limit=limit)
+    except InvalidCursor as e:
+        return jsonify({"msg": str(e)}), 400
+    return jsonify({
+        "sessions": [serialize_session(s) for s in sessions],
+        "has_more": has_more,
+        "before_cursor": session_cursor(sessions[-1]) if sessions else None,
+    }), 200
+
+
+@chat_bp.route('/sessions', methods=['POST'])
+@jwt_required()
+def post_session():
+    """Starts a new session. Optional body: {"title": ...} (otherwise generated after the first reply)."""
+    current_user_id = current_user.id
+    data = request.get_json(silent=True) or {}
+    title = data.get('title')
+    if title is not None and (not isinstance(title, str) or not title.strip()):
+        return jsonify({"msg": "'title' must be a non-empty string"}), 400
+    try:
+        chat_session = create_session(current_user_id, title.strip()[:100] if title else None)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error creating chat session for user %s: %s", current_user_id, e)
+        return jsonify({"msg": "Failed to create chat session"}), 500
+    return jsonify(serialize_session(chat_session)), 201
+
+
+@chat_bp.route('/sessions/<int:session_id>', methods=['GET'])
+@jwt_required()
+def get_session_detail(session_id):
+    chat_session = get_session(current_user.id, session_id)
+    if chat_session is None:
+        return jsonify({"msg": "Chat session not found"}), 404
+    return jsonify(serialize_session(chat_session)), 200
+
+
+@chat_bp.route('/sessions/<int:session_id>', methods=['PATCH'])
+@jwt_required()
+def rename_session(session_id):
+    chat_session = get_session(current_user.id, session_id)
+    if chat_session is None:
+        return jsonify({"msg": "Chat session not found"}), 404
+    data = request.get_json(silent=True) or {}
+    title = data.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return jsonify({"msg": "'title' must be a non-empty string"}), 400
+    chat_session.title = title.strip()[:100]
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error renaming chat session %s: %s", session_id, e)
+        return jsonify({"msg": "Failed to rename chat session"}), 500
+    return jsonify(serialize_session(chat_session)), 200
+
+
+@chat_bp.route('/sessions/<int:session_id>', methods=['DELETE'])
+@jwt_required()
+def delete_session_route(session_id):
+    """Deletes one session and its messages."""
+    current_user_id = current_user.id
+    if get_session(current_user_id, session_id) is None:
+        return jsonify({"msg": "Chat session not found"}), 404
+    try:
+        chat_persister.flush() # Queued inserts for this session must not land after the delete
+        num_deleted = delete_session(current_user_id, session_id,
+                                     batch_size=current_app.config['HISTORY_DELETE_BATCH_SIZE'])
+        history_cache.invalidate(current_user_id, session_id=session_id)
+        logger.info("Deleted chat session %s (%d messages) for user %s.", session_id, num_deleted, current_user_id)
+        return jsonify({"msg": f"Successfully deleted session with {num_deleted} messages."}), 200
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error deleting chat session %s for user %s: %s", session_id, current_user_id, e)
+        return jsonify({"msg": "Failed to delete chat session due to a server error."}), 500
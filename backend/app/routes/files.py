@@ -1,14 +1,25 @@
+import logging
 import os
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+import mimetypes
+from flask import Blueprint, request, jsonify, send_file, current_app
+from flask_jwt_extended import jwt_required, current_user
 from werkzeug.utils import secure_filename
 from app import db
-from app.models import UploadedFile, ChatMessage
+from app.models import UploadedFile, UploadSession, ChatMessage
+from app.services.gemini_service import format_history_for_gemini
+from app.services.history_cache import history_cache
+from app.services.blob_store import blob_store, UploadTooLarge
+from app.services.analysis_worker import analysis_worker
+from app.services.thumbnail_cache import thumbnail_cache
+from app.services.rate_limiter import rate_limited
 import datetime
+import json
 
 files_bp = Blueprint('files', __name__)
+logger = logging.getLogger(__name__)
 
 # Configure basic upload folder - Make sure this exists or is created
+# (legacy per-user files live here; new uploads go to the content-addressed blob store under it)
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'uploads')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -19,10 +30,65 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+def _register_upload(user_id, filename, mime_type, sha256, size, tmp_path):
+    """
+    Points a new UploadedFile row at the (possibly shared) blob, moving the
+    written body at `tmp_path` into the store if it is new, records the upload
+    in the chat and commits. tmp_path is removed once committed; if anything
+    fails it is left in place (the caller rolls back). Returns the JSON
+    response tuple.
+    """
+    blob = blob_store.acquire(sha256, size)
+    placed = blob_store.place(tmp_path, blob)
+    new_file = UploadedFile(
+        user_id=user_id,
+        filename=filename,
+        filepath=blob_store.absolute_path(blob.storage_path), # Store path for potential future processing
+        blob_id=blob.id,
+        size=size,
+        mime_type=mime_type
+    )
+    db.session.add(new_file) # ai_analysis_status='pending' queues it for the analysis worker
+
+    # Optionally, add a chat message indicating upload.
+    upload_message = ChatMessage(
+         user_id=user_id,
+         sender='system', # Or 'user' if user confirms sending the file for analysis
+         content=f"File uploaded: {filename}",
+         content_type='file_ref', # Indicate this message refers to a file
+         timestamp=datetime.datetime.utcnow()
+     )
+    db.session.add(upload_message)
+    try:
+        db.session.commit()
+    except Exception:
+        if placed:
+            blob_store.unplace(tmp_path, blob) # No orphaned body without a row
+        raise
+    blob_store.discard(tmp_path)
+    # The upload notice is part of the model's history window too
+    history_cache.append(user_id, format_history_for_gemini([upload_message]))
+    # Analysis runs in the background; clients poll GET /api/files/<id>/status
+    analysis_worker.notify()
+
+    return jsonify({
+        "msg": "File uploaded successfully",
+        "filename": filename,
+        "fileId": new_file.id,
+        "sha256": sha256,
+        "size": size,
+        "analysisStatus": new_file.ai_analysis_status,
+         "chatMessageId": upload_message.id # Link chat message to the upload event
+        }), 201
+
+
+# --- POST /api/files/upload (multipart form, as before) ---
 @files_bp.route('/upload', methods=['POST'])
 @jwt_required()
+@rate_limited('upload')
 def upload_file():
-    current_user_id = get_jwt_identity()
+    current_user_id = current_user.id
 
     if 'file' not in request.files:
         return jsonify({"msg": "No file part"}), 400
@@ -32,50 +98,284 @@ def upload_file():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        # Create user-specific subfolder to avoid filename collisions
-        user_upload_folder = os.path.join(UPLOAD_FOLDER, str(current_user_id))
-        if not os.path.exists(user_upload_folder):
-            os.makedirs(user_upload_folder)
-
-        filepath = os.path.join(user_upload_folder, filename)
-
+        tmp_path = None
         try:
-            file.save(filepath)
-
-            # Save metadata to DB
-            new_file = UploadedFile(
-                user_id=current_user_id,
-                filename=filename,
-                filepath=filepath, # Store path for potential future processing
-                mime_type=file.mimetype
-            )
-            db.session.add(new_file)
-            db.session.commit()
-
-            # *** AI Processing / Speech-to-Text would be triggered here (async recommended) ***
-            # For this example, we just acknowledge the upload.
-            # Optionally, add a chat message indicating upload.
-            upload_message = ChatMessage(
-                 user_id=current_user_id,
-                 sender='system', # Or 'user' if user confirms sending the file for analysis
-                 content=f"File uploaded: {filename}",
-                 content_type='file_ref', # Indicate this message refers to a file
-                 timestamp=datetime.datetime.utcnow()
-             )
-            db.session.add(upload_message)
-            db.session.commit()
-
-
-            return jsonify({
-                "msg": "File uploaded successfully",
-                "filename": filename,
-                "fileId": new_file.id,
-                 "chatMessageId": upload_message.id # Link chat message to the upload event
-                }), 201
-
+            sha256, size, tmp_path = blob_store.write_stream(file.stream)
+            return _register_upload(current_user_id, filename, file.mimetype, sha256, size, tmp_path)
+        except UploadTooLarge as e:
+            return jsonify({"msg": str(e)}), 413
         except Exception as e:
             db.session.rollback()
-            print(f"Error uploading file: {e}")
+            logger.exception("Error uploading file: %s", e)
             return jsonify({"msg": "Failed to upload file", "error": str(e)}), 500
+        finally:
+            blob_store.discard(tmp_path)
     else:
-        return jsonify({"msg": "File type not allowed"}), 400
\ No newline at end of file
+        return jsonify({"msg": "File type not allowed"}), 400
+
+
+# --- POST /api/files/upload/stream?filename=<name> (raw request body) ---
+# The body is read straight off the socket in chunks, hashed and written as it
+# arrives - nothing is buffered by Werkzeug's form parser first.
+@files_bp.route('/upload/stream', methods=['POST', 'PUT'])
+@jwt_required()
+@rate_limited('upload')
+def upload_file_stream():
+    current_user_id = current_user.id
+    filename = secure_filename(request.args.get('filename', ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({"msg": "A 'filename' with an allowed extension is required"}), 400
+    mime_type = request.mimetype if request.mimetype != 'application/octet-stream' else None
+    mime_type = mime_type or mimetypes.guess_type(filename)[0]
+
+    tmp_path = None
+    try:
+        sha256, size, tmp_path = blob_store.write_stream(request.stream)
+        if size == 0:
+            return jsonify({"msg": "Empty upload"}), 400
+        return _register_upload(current_user_id, filename, mime_type, sha256, size, tmp_path)
+    except UploadTooLarge as e:
+        return jsonify({"msg": str(e)}), 413
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error uploading file stream: %s", e)
+        return jsonify({"msg": "Failed to upload file", "error": str(e)}), 500
+    finally:
+        blob_store.discard(tmp_path)
+
+
+# --- Resumable multi-part uploads (large audio files) ---
+#   POST   /api/files/uploads                   {filename, mime_type?, size?} -> {uploadId, offset}
+#   PUT    /api/files/uploads/<id>              raw part body, header Upload-Offset: <bytes already sent>
+#   GET    /api/files/uploads/<id>              -> {offset, size} (where to resume)
+#   POST   /api/files/uploads/<id>/complete     -> same response as /upload
+#   DELETE /api/files/uploads/<id>              abort
+def _upload_session_payload(session):
+    return {"uploadId": session.id, "filename": session.filename,
+            "offset": session.received_bytes, "size": session.total_size}
+
+
+def _get_upload_session(upload_id, user_id):
+    session = UploadSession.query.filter_by(id=upload_id, user_id=user_id).first()
+    if session is None:
+        return None
+    stored = blob_store.part_size(upload_id)
+    if session.received_bytes != stored:
+        # The part file is the source of truth: a worker that died between writing a
+        # part and committing its offset must not leave the upload stuck on a 409
+        session.received_bytes = stored
+        db.session.commit()
+    return session
+
+
+@files_bp.route('/uploads', methods=['POST'])
+@jwt_required()
+@rate_limited('upload')
+def create_upload_session():
+    current_user_id = current_user.id
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not filename or not allowed_file(filename):
+        return jsonify({"msg": "File type not allowed"}), 400
+    total_size = data.get('size')
+    if total_size is not None and (not isinstance(total_size, int) or total_size > blob_store.max_bytes):
+        return jsonify({"msg": f"'size' must be an integer up to {blob_store.max_bytes} bytes"}), 400
+
+    session = UploadSession(
+        id=blob_store.new_upload_id(), user_id=current_user_id, filename=filename,
+        mime_type=data.get('mime_type') or mimetypes.guess_type(filename)[0], total_size=total_size
+    )
+    db.session.add(session)
+    db.session.commit()
+    return jsonify(_upload_session_payload(session)), 201
+
+
+@files_bp.route('/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload_session(upload_id):
+    session = _get_upload_session(upload_id, current_user.id)
+    if session is None:
+        return jsonify({"msg": "Upload not found"}), 404
+    return jsonify(_upload_session_payload(session)), 200
+
+
+@files_bp.route('/uploads/<upload_id>', methods=['PUT'])
+@jwt_required()
+@rate_limited('upload_part')
+def upload_part(upload_id):
+    session = _get_upload_session(upload_id, current_user.id)
+    if session is None:
+        return jsonify({"msg": "Upload not found"}), 404
+    try:
+        offset = int(request.headers.get('Upload-Offset', session.received_bytes))
+    except ValueError:
+        return jsonify({"msg": "Invalid Upload-Offset header"}), 400
+    if offset != session.received_bytes:
+        # Client and server disagree (e.g. a part was lost); tell it where to resume
+        return jsonify({"msg": "Offset mismatch", **_upload_session_payload(session)}), 409
+
+    try:
+        session.received_bytes = blob_store.append_part(upload_id, request.stream, offset)
+    except UploadTooLarge as e:
+        return jsonify({"msg": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"msg": str(e), **_upload_session_payload(session)}), 409
+    db.session.commit()
+    return jsonify(_upload_session_payload(session)), 200
+
+
+@files_bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+@jwt_required()
+@rate_limited('upload')
+def complete_upload_session(upload_id):
+    current_user_id = current_user.id
+    session = _get_upload_session(upload_id, current_user_id)
+    if session is None:
+        return jsonify({"msg": "Upload not found"}), 404
+    if session.received_bytes == 0:
+        return jsonify({"msg": "No data uploaded"}), 400
+    if session.total_size is not None and session.received_bytes != session.total_size:
+        return jsonify({"msg": "Upload incomplete", **_upload_session_payload(session)}), 409
+
+    try:
+        part_path = blob_store.part_path(upload_id)
+        sha256, size = blob_store.hash_file(part_path)
+        db.session.delete(session)
+        # On failure the parts stay, so the client can retry completing
+        return _register_upload(current_user_id, session.filename, session.mime_type, sha256, size, part_path)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Error completing upload %s: %s", upload_id, e)
+        return jsonify({"msg": "Failed to complete upload", "error": str(e)}), 500
+
+
+@files_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload_session(upload_id):
+    session = _get_upload_session(upload_id, current_user.id)
+    if session is None:
+        return jsonify({"msg": "Upload not found"}), 404
+    blob_store.discard_part(upload_id)
+    db.session.delete(session)
+    db.session.commit()
+    return jsonify({"msg": "Upload aborted"}), 200
+
+
+# --- GET /api/files/<id>/download and /thumbnail ---
+# send_file handles Range (206 partial content, for audio seeking), ETag /
+# If-None-Match (304) and hands the open file to the server's wsgi.file_wrapper,
+# which gunicorn/uWSGI serve with sendfile(). USE_X_SENDFILE delegates the body
+# to a fronting web server instead.
+def _get_owned_file(file_id, user_id):
+    return UploadedFile.query.filter_by(id=file_id, user_id=user_id).first()
+
+
+def _file_etag(uploaded):
+    if uploaded.blob is not None:
+        return uploaded.blob.sha256 # Content-addressed: the hash is the strong validator
+    stat = os.stat(uploaded.filepath) # Legacy file outside the blob store
+    return f"{uploaded.id}-{int(stat.st_mtime)}-{stat.st_size}"
+
+
+def _private_cacheable(response):
+    # Per-user content: browsers may cache it, shared proxies may not
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def _send_original(uploaded):
+    """The stored file itself, as a conditional, privately cacheable response."""
+    response = send_file(
+        uploaded.filepath,
+        mimetype=uploaded.mime_type or mimetypes.guess_type(uploaded.filename)[0] or 'application/octet-stream',
+        as_attachment=request.args.get('attachment') == '1',
+        download_name=uploaded.filename,
+        conditional=True,
+        etag=_file_etag(uploaded),
+        max_age=current_app.config['FILE_DOWNLOAD_MAX_AGE']
+    )
+    return _private_cacheable(response)
+
+
+@files_bp.route('/<int:file_id>/download', methods=['GET'])
+@jwt_required()
+@rate_limited('download')
+def download_file(file_id):
+    uploaded = _get_owned_file(file_id, current_user.id)
+    if uploaded is None or not os.path.exists(uploaded.filepath):
+        return jsonify({"msg": "File not found"}), 404
+    return _send_original(uploaded)
+
+
+@files_bp.route('/<int:file_id>/thumbnail', methods=['GET'])
+@jwt_required()
+@rate_limited('download')
+def download_thumbnail(file_id):
+    uploaded = _get_owned_file(file_id, current_user.id)
+    if uploaded is None or not os.path.exists(uploaded.filepath):
+        return jsonify({"msg": "File not found"}), 404
+    mime_type = uploaded.mime_type or mimetypes.guess_type(uploaded.filename)[0] or ''
+    if not mime_type.startswith('image/'):
+        return jsonify({"msg": "Thumbnails are only available for images"}), 415
+    if not thumbnail_cache.available:
+        return _send_original(uploaded) # No Pillow: previews fall back to the original
+
+    try:
+        requested = int(request.args.get('size', 256))
+    except ValueError:
+        return jsonify({"msg": "'size' must be an integer"}), 400
+    size = thumbnail_cache.nearest_size(requested)
+    etag = _file_etag(uploaded)
+    try:
+        path = thumbnail_cache.get(etag, size, uploaded.filepath)
+    except Exception as e:
+        logger.error("Error building thumbnail for file %s: %s", file_id, e)
+        return jsonify({"msg": "Could not build thumbnail"}), 422
+    response = send_file(
+        path, mimetype='image/jpeg', conditional=True, etag=f"{etag}-{size}",
+        download_name=f"thumb_{size}_{uploaded.filename.rsplit('.', 1)[0]}.jpg",
+        max_age=current_app.config['FILE_DOWNLOAD_MAX_AGE']
+    )
+    return _private_cacheable(response)
+
+
+# --- GET /api/files/<id>/status (poll background analysis) ---
+@files_bp.route('/<int:file_id>/status', methods=['GET'])
+@jwt_required()
+def get_file_status(file_id):
+    uploaded = _get_owned_file(file_id, current_user.id)
+    if uploaded is None:
+        return jsonify({"msg": "File not found"}), 404
+    return jsonify({
+        "fileId": uploaded.id,
+        "filename": uploaded.filename,
+        "status": uploaded.ai_analysis_status,
+        "attempts": uploaded.analysis_attempts,
+        "nextAttemptAt": uploaded.analysis_next_attempt_at.isoformat() + 'Z' if uploaded.analysis_next_attempt_at else None,
+        "metadata": json.loads(uploaded.ai_metadata) if uploaded.ai_metadata else None,
+        "error": uploaded.analysis_error if uploaded.ai_analysis_status != 'complete' else None
+    }), 200
+
+
+# --- DELETE /api/files/<id> (drop one reference to the shared blob) ---
+@files_bp.route('/<int:file_id>', methods=['DELETE'])
+@jwt_required()
+def delete_file(file_id):
+    current_user_id = current_user.id
+    uploaded = UploadedFile.query.filter_by(id=file_id, user_id=current_user_id).first()
+    if uploaded is None:
+        return jsonify({"msg": "File not found"}), 404
+    orphaned_path = None
+    try:
+        orphaned_path = blob_store.release(uploaded.blob) if uploaded.blob is not None else None
+        db.session.delete(uploaded)
+        db.session.commit()
+    except Exception as e:
+        if orphaned_path:
+            blob_store.restore(orphaned_path)
+        db.session.rollback()
+        logger.exception("Error deleting file %s: %s", file_id, e)
+        return jsonify({"msg": "Failed to delete file"}), 500
+    blob_store.discard(orphaned_path) # Last reference gone
+    return jsonify({"msg": "File deleted"}), 200
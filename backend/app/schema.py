@@ -0,0 +1,106 @@
+# backend/app/schema.py
+# Schema creation and in-place upgrades (`flask init-db`).
+import logging
+from sqlalchemy import inspect, literal
+from . import db
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_schema(engine):
+    """
+    Brings a database up to the current models, creating it if empty:
+      - creates missing tables;
+      - adds missing columns (ALTER TABLE ... ADD COLUMN) - new columns are
+        nullable or have a scalar default, which existing rows get;
+      - rebuilds tables whose unique constraints changed (rows are copied);
+      - creates missing indexes;
+      - builds and back-fills the full-text search index (SQLite).
+    Idempotent: a second run changes nothing. Returns a list of the changes made.
+    """
+    from . import models # noqa: F401 - register every table on db.metadata
+    from .services.search_service import build_fts_index
+    changes = []
+    with engine.begin() as connection:
+        existing = set(inspect(connection).get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(connection)
+                changes.append(f"created table {table.name}")
+                continue
+            changes += _add_missing_columns(connection, table)
+            if _unique_sets(inspect(connection), table.name) - _model_unique_sets(table):
+                _rebuild_table(connection, table)
+                changes.append(f"rebuilt table {table.name} (unique constraints changed)")
+            changes += _create_missing_indexes(connection, table)
+    if build_fts_index(engine):
+        changes.append("built full-text search index")
+    for change in changes:
+        logger.info("Schema upgrade: %s", change)
+    return changes
+
+
+def _column_ddl(column, dialect):
+    ddl = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"
+    default = column.server_default.arg if column.server_default is not None else None
+    if default is None and column.default is not None and column.default.is_scalar:
+        default = literal(column.default.arg, column.type).compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True})
+    if default is not None:
+        ddl += f" DEFAULT {default}"
+    if not column.nullable:
+        if default is None:
+            raise RuntimeError(f"Cannot add NOT NULL column {column.table.name}.{column.name} "
+                               "without a scalar default")
+        ddl += " NOT NULL"
+    for fk in column.foreign_keys:
+        ddl += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+    return ddl
+
+
+def _add_missing_columns(connection, table):
+    present = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    changes = []
+    for column in table.columns:
+        if column.name not in present:
+            connection.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, connection.dialect)}"
+            )
+            changes.append(f"added column {table.name}.{column.name}")
+    return changes
+
+
+def _unique_sets(inspector, table_name):
+    sets = {frozenset(c['column_names']) for c in inspector.get_unique_constraints(table_name)}
+    sets |= {frozenset(i['column_names']) for i in inspector.get_indexes(table_name) if i['unique']}
+    return sets
+
+
+def _model_unique_sets(table):
+    sets = {frozenset(c.name for c in constraint.columns) for constraint in table.constraints
+            if isinstance(constraint, db.UniqueConstraint)}
+    sets |= {frozenset(c.name for c in index.columns) for index in table.indexes if index.unique}
+    sets |= {frozenset([column.name]) for column in table.columns if column.unique}
+    return sets
+
+
+def _rebuild_table(connection, table):
+    """Recreates `table` from the model and copies its rows over (SQLite cannot ALTER constraints)."""
+    old_name = f"{table.name}__old"
+    for index in inspect(connection).get_indexes(table.name):
+        connection.exec_driver_sql(f"DROP INDEX {index['name']}") # Recreated with the new table
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} RENAME TO {old_name}")
+    table.create(connection)
+    columns = ', '.join(c.name for c in table.columns) # Every model column exists by now
+    connection.exec_driver_sql(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}")
+    connection.exec_driver_sql(f"DROP TABLE {old_name}")
+
+
+def _create_missing_indexes(connection, table):
+    present = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    changes = []
+    for index in table.indexes:
+        if index.name not in present:
+            index.create(connection)
+            changes.append(f"created index {index.name}")
+    return changes
@@ -0,0 +1,286 @@
+# backend/app/services/analysis_worker.py
+import datetime
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from sqlalchemy import and_, or_, select, update
+from app import db
+from app.models import UploadedFile
+from app.services.file_analysis import run_analysis
+
+logger = logging.getLogger(__name__)
+
+
+# --- Job queue (the uploaded_file table itself) ---
+def claim_next_job(lease_seconds):
+    """
+    Atomically claims one due job: a 'pending' file whose retry time has come,
+    or a 'processing' one whose lease expired (its worker died). The conditional
+    UPDATE means two workers can never claim the same row. Returns the claimed
+    UploadedFile or None.
+    """
+    now = datetime.datetime.utcnow()
+    lease_expired = now - datetime.timedelta(seconds=lease_seconds)
+    due = or_(
+        and_(UploadedFile.ai_analysis_status == 'pending',
+             or_(UploadedFile.analysis_next_attempt_at.is_(None), UploadedFile.analysis_next_attempt_at <= now)),
+        and_(UploadedFile.ai_analysis_status == 'processing', UploadedFile.analysis_claimed_at < lease_expired),
+    )
+    candidates = db.session.execute(
+        select(UploadedFile.id).where(due).order_by(UploadedFile.id).limit(5)
+    ).scalars().all()
+    for file_id in candidates:
+        result = db.session.execute(
+            update(UploadedFile)
+            .where(UploadedFile.id == file_id, due)
+            .values(ai_analysis_status='processing', analysis_claimed_at=now,
+                    analysis_attempts=UploadedFile.analysis_attempts + 1)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(UploadedFile, file_id, populate_existing=True)
+    return None
+
+
+def release_job(file_id):
+    """Puts a claimed job back in the queue as if it had never been claimed (it never ran)."""
+    db.session.execute(
+        update(UploadedFile)
+        .where(UploadedFile.id == file_id, UploadedFile.ai_analysis_status == 'processing')
+        .values(ai_analysis_status='pending', analysis_claimed_at=None,
+                analysis_attempts=UploadedFile.analysis_attempts - 1)
+    )
+    db.session.commit()
+
+
+def renew_claims(file_ids):
+    """Moves the lease of jobs that are still running forward, so they aren't claimed a second time."""
+    db.session.execute(
+        update(UploadedFile)
+        .where(UploadedFile.id.in_(file_ids), UploadedFile.ai_analysis_status == 'processing')
+        .values(analysis_claimed_at=datetime.datetime.utcnow())
+    )
+    db.session.commit()
+
+
+def record_success(file_id, result):
+    uploaded = db.session.get(UploadedFile, file_id)
+    uploaded.ai_analysis_status = 'complete'
+    uploaded.ai_metadata = json.dumps(result)
+    uploaded.analysis_error = None
+    uploaded.analysis_claimed_at = None
+    db.session.commit()
+
+
+def record_failure(file_id, error, max_attempts, retry_base_seconds):
+    """Schedules a retry with exponential backoff, or marks the file failed after max_attempts."""
+    uploaded = db.session.get(UploadedFile, file_id)
+    uploaded.analysis_error = str(error)[:2000]
+    uploaded.analysis_claimed_at = None
+    if uploaded.analysis_attempts >= max_attempts:
+        uploaded.ai_analysis_status = 'failed'
+        uploaded.analysis_next_attempt_at = None
+    else:
+        delay = retry_base_seconds * (2 ** (uploaded.analysis_attempts - 1))
+        uploaded.ai_analysis_status = 'pending'
+        uploaded.analysis_next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    db.session.commit()
+
+
+# --- Worker service ---
+class AnalysisWorkerService:
+    """
+    Processes uploads off the request path. A dispatcher thread claims due jobs
+    from the database (at most `concurrency` at a time) and runs metadata
+    extraction + the configured analyzer in a process pool, then writes the
+    results back. Uploads only insert a 'pending' row and notify().
+
+    Runs inside the web process (ANALYSIS_WORKER_IN_PROCESS=1, started on the
+    first request, so jobs left over from a restart are picked up without a new
+    upload) or standalone via `flask analysis-worker`. Several workers can share
+    one database; claims are atomic, and the claims of running jobs are renewed
+    every lease_seconds / 3.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.concurrency = 2
+        self.max_attempts = 3
+        self.retry_base_seconds = 30
+        self.poll_interval = 5.0
+        self.lease_seconds = 600
+        self.analyzer = 'app.services.file_analysis:basic_analyzer'
+        self.in_process = True
+        self.mp_context = 'spawn'
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._slots = None
+        self._running = set() # File ids submitted and not finished yet
+        self._renew_at = 0.0
+
+    def init_app(self, app):
+        self.stop()
+        self.app = app
+        self.concurrency = app.config.get('ANALYSIS_CONCURRENCY', self.concurrency)
+        self.max_attempts = app.config.get('ANALYSIS_MAX_ATTEMPTS', self.max_attempts)
+        self.retry_base_seconds = app.config.get('ANALYSIS_RETRY_BASE_SECONDS', self.retry_base_seconds)
+        self.poll_interval = app.config.get('ANALYSIS_POLL_INTERVAL', self.poll_interval)
+        self.lease_seconds = app.config.get('ANALYSIS_LEASE_SECONDS', self.lease_seconds)
+        self.analyzer = app.config.get('ANALYSIS_ANALYZER', self.analyzer)
+        self.in_process = app.config.get('ANALYSIS_WORKER_IN_PROCESS', self.in_process)
+        self.mp_context = app.config.get('ANALYSIS_MP_CONTEXT') or self.mp_context
+        if self.in_process:
+            @app.before_request
+            def start_analysis_worker():
+                if self._thread is None:
+                    self.start()
+
+    def notify(self):
+        """Called after an upload commits: wakes the dispatcher (starting it if in-process)."""
+        if self.in_process:
+            self.start()
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._executor = self._new_executor()
+            self._slots = threading.BoundedSemaphore(self.concurrency)
+            self._thread = threading.Thread(target=self._dispatch_loop, name="analysis-dispatcher", daemon=True)
+            self._thread.start()
+            logger.info("Analysis worker started (concurrency=%d, analyzer=%s).", self.concurrency, self.analyzer)
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=30)
+        with self._lock:
+            executor = self._executor # Read after _stopping is set: it can't be replaced any more
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        self._thread = self._executor = None
+
+    def run_forever(self):
+        """Blocking entry point for a dedicated worker process (`flask analysis-worker`)."""
+        self.in_process = True
+        self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(timeout=1)
+        except KeyboardInterrupt:
+            logger.info("Analysis worker stopping...")
+        finally:
+            self.stop()
+
+    def _new_executor(self):
+        context = multiprocessing.get_context(self.mp_context) if self.mp_context else None
+        return ProcessPoolExecutor(max_workers=self.concurrency, mp_context=context)
+
+    def _replace_executor(self, broken):
+        """
+        Swaps in a fresh process pool for `broken`. A child that dies (OOM kill,
+        segfault in a parser) breaks the whole pool: every later submit raises
+        BrokenProcessPool, so without this the worker would stall for good.
+        """
+        with self._lock:
+            if self._executor is not broken or self._stopping.is_set():
+                return # Already replaced, or shutting down
+            self._executor = self._new_executor()
+        logger.warning("Analysis process pool broke; started a new one.")
+        broken.shutdown(wait=False)
+
+    def _release_job(self, file_id):
+        try:
+            with self.app.app_context():
+                release_job(file_id)
+        except Exception as e:
+            # The claim's lease expires and the job is picked up again then
+            logger.exception("Error releasing file %s: %s", file_id, e)
+
+    def _renew_claims(self):
+        now = time.monotonic()
+        if now < self._renew_at:
+            return
+        self._renew_at = now + self.lease_seconds / 3
+        with self._lock:
+            file_ids = list(self._running)
+        if not file_ids:
+            return
+        try:
+            with self.app.app_context():
+                renew_claims(file_ids)
+        except Exception as e:
+            logger.exception("Error renewing analysis claims: %s", e)
+
+    # --- Dispatcher thread ---
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            self._renew_claims()
+            claimed_any = False
+            # Only claim when a process slot is free, so claimed jobs never sit waiting
+            while not self._stopping.is_set() and self._slots.acquire(blocking=False):
+                try:
+                    with self.app.app_context():
+                        job = claim_next_job(self.lease_seconds)
+                        job_args = (job.id, job.filepath, job.mime_type) if job else None
+                except Exception as e:
+                    logger.exception("Error claiming job: %s", e)
+                    job_args = None
+                if job_args is None:
+                    self._slots.release()
+                    break
+                executor = self._executor
+                try:
+                    self._submit(executor, *job_args)
+                except Exception as e:
+                    logger.exception("Error submitting file %s: %s", job_args[0], e)
+                    self._release_job(job_args[0])
+                    self._slots.release()
+                    self._replace_executor(executor)
+                    break # Back off for a poll interval in case the new pool fails too
+                claimed_any = True
+            if not claimed_any:
+                self._wake.wait(min(self.poll_interval, self.lease_seconds / 3))
+                self._wake.clear()
+
+    def _submit(self, executor, file_id, path, mime_type):
+        logger.debug("Processing file %s", file_id)
+        future = executor.submit(run_analysis, path, mime_type, self.analyzer)
+        with self._lock:
+            self._running.add(file_id)
+        future.add_done_callback(lambda f: self._finish(executor, file_id, f))
+
+    def _finish(self, executor, file_id, future):
+        try:
+            with self.app.app_context():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("File %s failed: %s", file_id, e)
+                    if isinstance(e, BrokenProcessPool):
+                        self._replace_executor(executor)
+                    record_failure(file_id, e, self.max_attempts, self.retry_base_seconds)
+                else:
+                    record_success(file_id, result)
+                    logger.debug("File %s complete", file_id)
+        except Exception as e:
+            logger.exception("Error saving result for file %s: %s", file_id, e)
+        finally:
+            with self._lock:
+                self._running.discard(file_id)
+            self._slots.release()
+            self._wake.set() # A slot freed up; look for more work
+
+
+analysis_worker = AnalysisWorkerService()
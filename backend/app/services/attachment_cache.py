@@ -0,0 +1,161 @@
+# backend/app/services/attachment_cache.py
+import io
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None # Images are sent at their original resolution
+
+from app.services.llm_backends import llm_pool
+
+# A file ready to go into a model request. `key` identifies the content and the
+# way it was prepared (used in response cache keys); `part` is what the backend
+# receives: {'mime_type', 'data'} inline bytes, or a provider file handle.
+# Cached entries are shared across users; file_id/filename are per request.
+PreparedAttachment = namedtuple('PreparedAttachment', 'key file_id filename mime_type part size')
+
+
+class AttachmentError(ValueError):
+    """A chat turn referenced a file that can't be attached (missing, wrong type, too large)."""
+
+
+def content_key(uploaded):
+    """Identity of an UploadedFile's bytes: the blob hash, or path stat for legacy files."""
+    if uploaded.blob is not None:
+        return uploaded.blob.sha256
+    stat = os.stat(uploaded.filepath)
+    return f"file-{uploaded.id}-{int(stat.st_mtime)}-{stat.st_size}"
+
+
+def prepare_payload(path, mime_type, max_dimension, inline_max_bytes):
+    """
+    Returns (mime_type, bytes) to send inline for a file, or None if it is
+    larger than `inline_max_bytes` (it is not read then). Images larger than
+    `max_dimension` are downscaled and re-encoded as JPEG, which is far
+    cheaper to upload (and tokenize) than a full-resolution scan.
+    """
+    if Image is not None and mime_type.startswith('image/'):
+        with Image.open(path) as img:
+            if max(img.size) > max_dimension:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((max_dimension, max_dimension))
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                out = io.BytesIO()
+                img.save(out, format='JPEG', quality=85)
+                data = out.getvalue()
+                return ('image/jpeg', data) if len(data) <= inline_max_bytes else None
+    if os.path.getsize(path) > inline_max_bytes:
+        return None
+    with open(path, 'rb') as f:
+        return mime_type, f.read()
+
+
+class AttachmentCache:
+    """
+    Prepared model-request parts for uploaded files, keyed by backend, content
+    hash and preparation settings. Asking about the same scan again reuses the
+    decoded/downscaled bytes (or the provider file handle) instead of reading
+    and re-encoding the file on every turn. LRU bounded by total bytes, with a
+    TTL so provider-side handles are dropped before they expire upstream.
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, ttl=3600, max_dimension=1536,
+                 inline_max_bytes=15 * 1024 * 1024, max_per_message=5):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_dimension = max_dimension
+        self.inline_max_bytes = inline_max_bytes
+        self.max_per_message = max_per_message
+        self._entries = OrderedDict() # key -> (expires_at, PreparedAttachment)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._building = {}
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get('ATTACHMENT_CACHE_MAX_BYTES', self.max_bytes)
+        self.ttl = app.config.get('ATTACHMENT_CACHE_TTL', self.ttl)
+        self.max_dimension = app.config.get('ATTACHMENT_MAX_DIMENSION', self.max_dimension)
+        self.inline_max_bytes = app.config.get('ATTACHMENT_INLINE_MAX_BYTES', self.inline_max_bytes)
+        self.max_per_message = app.config.get('ATTACHMENT_MAX_PER_MESSAGE', self.max_per_message)
+        self.clear()
+
+    def get(self, uploaded, backend=None):
+        """Returns the PreparedAttachment for an UploadedFile, preparing it on a miss."""
+        backend = backend or llm_pool.backend
+        mime_type = uploaded.mime_type or 'application/octet-stream'
+        key = f"{getattr(backend, 'model_name', None)}:{content_key(uploaded)}:{self.max_dimension}"
+
+        prepared = self._lookup(key)
+        if prepared is not None:
+            return prepared._replace(file_id=uploaded.id, filename=uploaded.filename)
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            prepared = self._lookup(key, count=False) # Prepared by the request we waited on
+            if prepared is None:
+                try:
+                    prepared = self._prepare(key, uploaded, mime_type, backend)
+                finally:
+                    with self._lock:
+                        self._building.pop(key, None)
+                self._store(key, prepared)
+        return prepared._replace(file_id=uploaded.id, filename=uploaded.filename)
+
+    def _prepare(self, key, uploaded, mime_type, backend):
+        payload = prepare_payload(uploaded.filepath, mime_type, self.max_dimension, self.inline_max_bytes)
+        if payload is not None:
+            send_type, data = payload
+            part = {'mime_type': send_type, 'data': data}
+            return PreparedAttachment(key, None, None, send_type, part, len(data))
+        # Too big to inline: hand it to the provider's file store if the backend has one
+        handle = backend.upload_attachment(uploaded.filepath, mime_type) if backend is not None else None
+        if handle is None:
+            raise AttachmentError(f"'{uploaded.filename}' is too large to attach")
+        return PreparedAttachment(key, None, None, mime_type, handle, 0)
+
+    def _lookup(self, key, count=True):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    self._remove_locked(key)
+                self.misses += count
+                return None
+            self._entries.move_to_end(key)
+            self.hits += count
+            return item[1]
+
+    def _store(self, key, prepared):
+        if prepared.size > self.max_bytes:
+            return # Larger than the whole cache; use it once
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (time.monotonic() + self.ttl, prepared)
+            self._total_bytes += prepared.size
+            while self._total_bytes > self.max_bytes:
+                self._remove_locked(next(iter(self._entries)))
+
+    def _remove_locked(self, key):
+        _, prepared = self._entries.pop(key)
+        self._total_bytes -= prepared.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+attachment_cache = AttachmentCache()
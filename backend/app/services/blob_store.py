@@ -0,0 +1,195 @@
+# backend/app/services/blob_store.py
+import hashlib
+import os
+import tempfile
+import uuid
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import FileBlob
+
+CHUNK_SIZE = 1024 * 1024 # 1 MiB per read/write/hash step
+
+
+class UploadTooLarge(Exception):
+    """Raised when a streamed body exceeds MAX_UPLOAD_BYTES."""
+
+
+class BlobStore:
+    """
+    Content-addressed storage for uploaded file bodies.
+
+    A body is streamed to a temp file while being hashed, then moved to
+    `<root>/<sha[0:2]>/<sha[2:4]>/<sha>`. If that blob already exists the temp
+    file is dropped, so identical scans uploaded by many users are stored once.
+    FileBlob rows track how many UploadedFile rows reference each blob.
+
+    Bodies only appear and disappear inside the transaction that changes their
+    row's ref_count: acquire() + place() on upload, release() on delete. The
+    ref_count update holds the row's write lock until commit, so a body can't be
+    removed between an upload finding it and committing its reference to it.
+    """
+
+    def __init__(self, root=None, max_bytes=200 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def init_app(self, app):
+        self.root = app.config['BLOB_STORAGE_ROOT']
+        self.max_bytes = app.config.get('MAX_UPLOAD_BYTES', self.max_bytes)
+        for directory in (self.root, self.tmp_dir, self.parts_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def tmp_dir(self):
+        return os.path.join(self.root, 'tmp')
+
+    @property
+    def parts_dir(self):
+        return os.path.join(self.root, 'tmp', 'parts')
+
+    @staticmethod
+    def relative_path(sha256):
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def absolute_path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    # --- Writing ---
+    def write_stream(self, stream):
+        """
+        Streams `stream` to a temp file, hashing it on the way. Returns
+        (sha256, size, tmp_path); the caller hands tmp_path to place() and
+        discard()s it afterwards.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            self.discard(tmp_path)
+            raise
+        return digest.hexdigest(), size, tmp_path
+
+    def hash_file(self, path):
+        """Returns (sha256, size) of a file already on disk (e.g. assembled upload parts)."""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def place(self, tmp_path, blob):
+        """
+        Moves a written body to `blob`'s path unless it is already there. Call
+        after acquire() and before commit. Returns True if the body was moved
+        (undo with unplace() if the transaction fails); otherwise tmp_path is
+        left for the caller to discard().
+        """
+        final_path = self.absolute_path(blob.storage_path)
+        if os.path.exists(final_path):
+            return False
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+        return True
+
+    def unplace(self, tmp_path, blob):
+        """Moves a body placed by a failed transaction back to tmp_path, before the rollback."""
+        os.replace(self.absolute_path(blob.storage_path), tmp_path)
+
+    def discard(self, path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    # --- Resumable upload parts ---
+    def new_upload_id(self):
+        return uuid.uuid4().hex
+
+    def part_path(self, upload_id):
+        return os.path.join(self.parts_dir, f"{upload_id}.part")
+
+    def append_part(self, upload_id, stream, offset):
+        """
+        Appends a part at `offset` (must equal the bytes received so far). Returns
+        the new size. A part that fails midway (client disconnect, too large) is
+        dropped, so the file stays at `offset` and the client can retry it.
+        """
+        path = self.part_path(upload_id)
+        with open(path, 'ab') as out:
+            if out.tell() != offset:
+                raise ValueError(f"Expected offset {out.tell()}, got {offset}")
+            try:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if out.tell() + len(chunk) > self.max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+                    out.write(chunk)
+            except BaseException:
+                out.truncate(offset) # Drop this part
+                raise
+            return out.tell()
+
+    def part_size(self, upload_id):
+        """Bytes actually stored for an upload's parts (0 before the first part)."""
+        path = self.part_path(upload_id)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def discard_part(self, upload_id):
+        path = self.part_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # --- Reference counting (caller commits) ---
+    def acquire(self, sha256, size):
+        """Returns the FileBlob for this content with its ref_count incremented."""
+        while True:
+            # Increment in SQL so concurrent uploads of the same content don't lose counts. The
+            # UPDATE also opens the transaction, so the savepoint below can't commit on its own
+            if FileBlob.query.filter_by(sha256=sha256).update({FileBlob.ref_count: FileBlob.ref_count + 1}):
+                return FileBlob.query.filter_by(sha256=sha256).populate_existing().one()
+            try:
+                with db.session.begin_nested():
+                    blob = FileBlob(sha256=sha256, size=size, storage_path=self.relative_path(sha256),
+                                    ref_count=1)
+                    db.session.add(blob)
+                return blob
+            except IntegrityError:
+                pass # Another request registered the same content first; increment theirs
+
+    def release(self, blob):
+        """
+        Drops one reference. When none remain, deletes the row and moves the body
+        aside; returns the moved-aside path, which the caller discard()s once the
+        transaction has committed, or restore()s if it fails. Otherwise returns None.
+        """
+        FileBlob.query.filter_by(id=blob.id).update({FileBlob.ref_count: FileBlob.ref_count - 1})
+        db.session.refresh(blob)
+        if blob.ref_count > 0:
+            return None
+        db.session.delete(blob)
+        path = self.absolute_path(blob.storage_path)
+        if not os.path.exists(path):
+            return None
+        deleted_path = f"{path}.{uuid.uuid4().hex}.deleted" # Same directory: renames are atomic
+        os.replace(path, deleted_path)
+        return deleted_path
+
+    def restore(self, deleted_path):
+        """Puts back a body moved aside by release() when its transaction was rolled back."""
+        os.replace(deleted_path, deleted_path.rsplit('.', 2)[0])
+
+
+blob_store = BlobStore()
@@ -0,0 +1,215 @@
+# backend/app/services/chat_persister.py
+import atexit
+import logging
+import queue
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.services.history_cache import history_cache
+from app.services.session_service import bump_session_counters
+from app.metrics import observe_span
+
+logger = logging.getLogger(__name__)
+
+# A turn retried on its own after its batch failed gets this many extra tries when
+# the database is locked, LOCK_RETRY_BACKOFF seconds apart (doubling)
+LOCK_RETRIES = 3
+LOCK_RETRY_BACKOFF = 0.05
+
+
+def _is_lock_error(error):
+    return isinstance(error, OperationalError) and 'locked' in str(error).lower()
+
+
+class WriteBehindPersister:
+    """
+    Background writer for chat messages.
+
+    Request threads hand finished turns to submit() and return immediately; a
+    single writer thread drains the bounded queue and inserts everything that
+    arrived within `flush_interval` (up to `batch_size` turns) in one
+    transaction, so concurrent streams no longer contend on per-turn SQLite
+    commits. submit() returns False when the persister is disabled, stopped or
+    its queue is full - callers then commit synchronously as before. If a
+    batch fails, its turns are retried one transaction each, so only a turn
+    that cannot be written on its own is dropped (counted in dropped_turns).
+
+    Messages become visible to DB readers shortly after the response ends
+    (within flush_interval under normal load); call flush() where a read must
+    observe every accepted write, e.g. before deleting a user's history.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=200, flush_interval=0.05, enabled=True):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.app = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._reset_metrics()
+        atexit.register(self.shutdown)
+
+    def init_app(self, app):
+        self.shutdown() # Flush anything queued for a previous app
+        self.app = app
+        self.enabled = app.config.get('CHAT_WRITE_BEHIND', self.enabled)
+        self.batch_size = app.config.get('CHAT_WRITE_BEHIND_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', self.flush_interval)
+        self.max_queue = app.config.get('CHAT_WRITE_BEHIND_MAX_QUEUE', self.max_queue)
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._stopping.clear()
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.metrics = {
+            "submitted": 0, "written": 0, "batches": 0, "failed_batches": 0, "dropped_turns": 0,
+            "sync_fallbacks": 0, "max_batch_size": 0,
+            "commit_seconds_total": 0.0, "commit_seconds_max": 0.0,
+            "queue_wait_seconds_total": 0.0, "queue_wait_seconds_max": 0.0,
+        }
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+                    self._thread.start()
+
+    # --- Producer side ---
+    def submit(self, user_id, messages):
+        """Queues one turn's ChatMessage objects. Returns False if the caller must commit itself."""
+        if not self.enabled or self.app is None or self._stopping.is_set():
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((user_id, messages, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.metrics["sync_fallbacks"] += 1
+            return False
+        with self._lock:
+            self.metrics["submitted"] += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Blocks until every turn queued so far has been written (or failed)."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        if timeout is None:
+            self._queue.join()
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def shutdown(self, timeout=10):
+        """Stops accepting work, writes what is queued and stops the writer thread."""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self._thread = None
+
+    # --- Writer thread ---
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        started = time.monotonic()
+        with self.app.app_context():
+            dropped = []
+            if self._commit(batch) is not None:
+                # One bad turn (or a lock timeout) must not take the rest of the batch down
+                # with it: retry each turn in its own transaction and drop only those that
+                # fail on their own
+                dropped = [turn for turn in batch if not self._commit_turn(turn)]
+        finished = time.monotonic()
+        observe_span('db_commit', finished - started)
+
+        dropped_ids = {id(turn) for turn in dropped}
+        written = [turn for turn in batch if id(turn) not in dropped_ids]
+        with self._lock:
+            m = self.metrics
+            commit_seconds = finished - started
+            m["commit_seconds_total"] += commit_seconds
+            m["commit_seconds_max"] = max(m["commit_seconds_max"], commit_seconds)
+            m["batches"] += 1
+            m["written"] += len(written)
+            m["dropped_turns"] += len(dropped)
+            m["max_batch_size"] = max(m["max_batch_size"], len(batch))
+            for _, _, enqueued_at in written:
+                wait = finished - enqueued_at
+                observe_span('write_behind_wait', wait)
+                m["queue_wait_seconds_total"] += wait
+                m["queue_wait_seconds_max"] = max(m["queue_wait_seconds_max"], wait)
+
+        # The cached windows were rolled forward optimistically; make them re-read the DB
+        for user_id, messages, _ in dropped:
+            history_cache.invalidate(user_id, session_id=messages[0].session_id)
+
+    def _commit(self, turns):
+        """Inserts the turns in one transaction. Returns None, or the exception it rolled back on."""
+        try:
+            for _, messages, _ in turns:
+                db.session.add_all(messages)
+            bump_session_counters([msg for _, messages, _ in turns for msg in messages])
+            db.session.commit()
+            return None
+        except Exception as e:
+            db.session.rollback()
+            if len(turns) > 1:
+                with self._lock:
+                    self.metrics["failed_batches"] += 1
+                logger.warning("Write-behind batch of %d turns failed: %s. Retrying turn by turn.", len(turns), e)
+            return e
+
+    def _commit_turn(self, turn):
+        """Commits one turn, retrying lock timeouts with backoff. Returns False if it was dropped."""
+        for attempt in range(LOCK_RETRIES + 1):
+            error = self._commit([turn])
+            if error is None:
+                return True
+            if not _is_lock_error(error) or attempt == LOCK_RETRIES:
+                break
+            time.sleep(LOCK_RETRY_BACKOFF * 2 ** attempt)
+        user_id, messages, _ = turn
+        logger.error("Dropping chat turn of user %s (%d messages): %s", user_id, len(messages), error)
+        return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_batch_size"] = stats["written"] / stats["batches"] if stats["batches"] else 0.0
+        stats["avg_queue_wait_seconds"] = (
+            stats["queue_wait_seconds_total"] / stats["written"] if stats["written"] else 0.0
+        )
+        return stats
+
+
+chat_persister = WriteBehindPersister()
@@ -0,0 +1,182 @@
+# backend/app/services/chat_service.py
+# Chat-turn steps shared by the WSGI route (routes/chat.py) and the ASGI mode (app/asgi.py).
+import datetime
+import json
+import logging
+import threading
+from app import db
+from app.models import ChatMessage, UploadedFile
+from app.services.gemini_service import (
+    get_gemini_response_stream, format_history_for_gemini, format_summary_for_gemini
+)
+from app.services.history_service import build_context_window, schedule_summary_update
+from app.services.history_cache import history_cache
+from app.services.chat_persister import chat_persister
+from app.services.session_service import bump_session_counters, schedule_title_generation
+from app.services.attachment_cache import attachment_cache, AttachmentError
+from app.metrics import span
+
+logger = logging.getLogger(__name__)
+
+ATTACHABLE_MIME_PREFIXES = ('image/', 'audio/', 'application/pdf')
+
+
+def new_user_message(user_id, content, attachments=None, session_id=None):
+    """Creates the user's ChatMessage for this turn (not saved until the response is done)."""
+    return ChatMessage(
+        user_id=user_id,
+        session_id=session_id,
+        sender='user',
+        content=content,
+        content_type='text',
+        timestamp=datetime.datetime.utcnow(),
+        attachment_ids=json.dumps([a.file_id for a in attachments]) if attachments else None
+    )
+
+
+def resolve_attachments(user_id, file_ids):
+    """
+    Turns the `attachments` list from a chat request (UploadedFile ids owned by
+    the user) into prepared request parts, via the attachment cache. Returns
+    [] for none; raises AttachmentError with a client-facing message.
+    """
+    if not file_ids:
+        return []
+    if not isinstance(file_ids, list) or not all(isinstance(i, int) for i in file_ids):
+        raise AttachmentError("'attachments' must be a list of file ids")
+    if len(file_ids) > attachment_cache.max_per_message:
+        raise AttachmentError(f"At most {attachment_cache.max_per_message} attachments per message")
+
+    files = {f.id: f for f in UploadedFile.query.filter(
+        UploadedFile.id.in_(file_ids), UploadedFile.user_id == user_id
+    )}
+    attachments = []
+    for file_id in dict.fromkeys(file_ids): # De-duplicated, request order kept
+        uploaded = files.get(file_id)
+        if uploaded is None:
+            raise AttachmentError(f"File {file_id} not found")
+        if not (uploaded.mime_type or '').startswith(ATTACHABLE_MIME_PREFIXES):
+            raise AttachmentError(f"'{uploaded.filename}' can't be sent to the model")
+        try:
+            prepared = attachment_cache.get(uploaded)
+        except OSError as e:
+            logger.error("Error preparing attachment %s: %s", file_id, e)
+            raise AttachmentError(f"'{uploaded.filename}' could not be read")
+        attachments.append(prepared)
+    return attachments
+
+
+def load_prompt_history(app, user_id, session_id=None):
+    """
+    Returns the formatted history to send with this turn - from the
+    per-conversation window cache, or the DB on a miss. The window is bounded
+    by a token budget; older turns live in a rolling summary. DB errors
+    propagate to the caller.
+    """
+    formatted_history = history_cache.get(user_id, session_id=session_id)
+    if formatted_history is not None:
+        return formatted_history
+
+    with span('history_query'):
+        summary, db_history, overflowed = build_context_window(
+            user_id, app.config['CHAT_HISTORY_TOKEN_BUDGET'], session_id=session_id
+        ) # Chronological order
+    logger.debug("Fetched last %d messages for history (summary: %s).", len(db_history), 'yes' if summary else 'no')
+
+    # Format history for the Gemini API and seed the cache
+    with span('history_format'):
+        window = format_history_for_gemini(db_history)
+    history_cache.put(user_id, window, summary=summary, overflowed=overflowed, session_id=session_id)
+    return format_summary_for_gemini(summary) + window
+
+
+def persist_chat_turn(app, user_id, user_message, full_ai_response, is_error_message, generate_title=False):
+    """
+    Saves the user's message and (unless the stream failed) the AI reply, then
+    rolls the cached history window forward. The insert normally goes through
+    the write-behind persister; if it can't take the turn, it is committed here.
+    With `generate_title` (an untitled session), a successful turn also queues
+    the session's title. Returns True unless the synchronous commit failed.
+    """
+    session_id = user_message.session_id
+    messages = [user_message]
+    if full_ai_response and not is_error_message:
+        messages.append(ChatMessage(
+            user_id=user_id, session_id=session_id, sender='ai', content=full_ai_response.strip(),
+            content_type='text', timestamp=datetime.datetime.utcnow()
+        ))
+        logger.debug("Stream finished. Queued AI message for saving.")
+    else:
+        logger.info("Stream yielded error or empty; not adding AI message. Content: '%.100s...'", full_ai_response)
+
+    # Everything read from the messages below is taken now: once the persister's
+    # thread commits them and closes its session, they are expired and detached
+    formatted = format_history_for_gemini(messages)
+    texts = [msg.content for msg in messages]
+    if not chat_persister.submit(user_id, messages):
+        db.session.add_all(messages)
+        try:
+            with span('db_commit'):
+                bump_session_counters(messages)
+                db.session.commit()
+        except Exception as commit_error:
+            db.session.rollback()
+            history_cache.invalidate(user_id, session_id=session_id)
+            logger.error("Failed to commit messages: %s. Rolled back session.", commit_error)
+            return False
+
+    # Roll the cached window forward instead of re-reading it next turn; if
+    # messages fell out of the token budget, fold them into the summary off-thread
+    if history_cache.append(user_id, formatted, session_id=session_id):
+        schedule_summary_update(app, user_id, session_id=session_id)
+    if generate_title and session_id is not None and len(texts) > 1:
+        schedule_title_generation(app, session_id, texts[0], texts[1])
+    return True
+
+
+def start_buffered_generation(app, stream, user_id, user_message, formatted_history, attachments=None,
+                              generate_title=False, lease=None):
+    """
+    Runs one generation on a background thread, appending chunks to `stream`
+    (a stream_buffer.ChatStream) and persisting the turn when it ends. The
+    generation is decoupled from any HTTP connection, so a client that drops
+    can reconnect and resume instead of paying for a second model call.
+    `lease` (a rate_limiter.Lease) is released when the generation ends.
+    """
+    def run():
+        full_ai_response = ""
+        is_error_message = False
+        response_stream = get_gemini_response_stream(formatted_history, user_message.content, attachments,
+                                                     user_id=user_id, session_id=user_message.session_id)
+        with app.app_context():
+            try:
+                for chunk in response_stream:
+                    if chunk.startswith("[SYSTEM:"):
+                        logger.info("Stream yielded system/error message: %s", chunk)
+                        full_ai_response = chunk
+                        is_error_message = True
+                        stream.append(chunk)
+                        break # Stop if service sends error
+                    full_ai_response += chunk
+                    stream.append(chunk)
+            except Exception as e:
+                logger.exception("Error during buffered streaming/generation: %s", e)
+                is_error_message = True
+                full_ai_response = "[SYSTEM: Internal server error during response generation.]"
+                stream.append(full_ai_response)
+            finally:
+                try:
+                    if not response_stream.follower: # Duplicates are saved once, by the original
+                        persist_chat_turn(app, user_id, user_message, full_ai_response, is_error_message,
+                                          generate_title=generate_title)
+                finally:
+                    stream.finish()
+
+    def run_and_release():
+        try:
+            run()
+        finally:
+            if lease is not None:
+                lease.release()
+
+    threading.Thread(target=run_and_release, name=f"chat-stream-{stream.id[:8]}", daemon=True).start()
@@ -0,0 +1,146 @@
+# backend/app/services/file_analysis.py
+# Metadata extraction and analyzers for uploaded files. Everything here runs in
+# the analysis worker's child processes, so it must stay free of Flask/DB state.
+import importlib
+import os
+import re
+import struct
+import wave
+
+try:
+    from PIL import Image # Optional: more formats and robust header parsing
+except ImportError:
+    Image = None
+
+try:
+    from pypdf import PdfReader # Optional: PDF text extraction
+except ImportError:
+    PdfReader = None
+
+try:
+    import mutagen # Optional: MP3/M4A durations
+except ImportError:
+    mutagen = None
+
+PDF_TEXT_LIMIT = 20000 # Characters of extracted text kept in ai_metadata
+PDF_SCAN_BYTES = 16 * 1024 * 1024 # Bytes scanned for the page-count fallback
+
+
+# --- Images ---
+def _image_size_from_header(path):
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            width, height = struct.unpack('>II', head[16:24])
+            return width, height
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', head[6:10])
+            return width, height
+        if head.startswith(b'\xff\xd8'):
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                    f.read(3) # Segment length + precision
+                    height, width = struct.unpack('>HH', f.read(4))
+                    return width, height
+                (length,) = struct.unpack('>H', f.read(2))
+                f.seek(length - 2, os.SEEK_CUR)
+    return None
+
+
+def extract_image_metadata(path):
+    if Image is not None:
+        with Image.open(path) as img:
+            return {"width": img.width, "height": img.height, "format": img.format}
+    size = _image_size_from_header(path)
+    return {"width": size[0], "height": size[1]} if size else {}
+
+
+# --- PDFs ---
+def extract_pdf_metadata(path):
+    if PdfReader is not None:
+        reader = PdfReader(path)
+        text, pages = [], len(reader.pages)
+        length = 0
+        for page in reader.pages:
+            page_text = page.extract_text() or ''
+            text.append(page_text)
+            length += len(page_text)
+            if length >= PDF_TEXT_LIMIT:
+                break
+        return {"pages": pages, "text": ''.join(text)[:PDF_TEXT_LIMIT]}
+    # Fallback without a PDF library: page count only
+    with open(path, 'rb') as f:
+        data = f.read(PDF_SCAN_BYTES)
+    return {"pages": len(re.findall(rb'/Type\s*/Page(?!s)', data)), "text": None}
+
+
+# --- Audio ---
+def extract_audio_metadata(path):
+    if path.lower().endswith('.wav') or _sniff(path, b'RIFF'):
+        with wave.open(path, 'rb') as w:
+            return {
+                "duration_seconds": w.getnframes() / float(w.getframerate()),
+                "sample_rate": w.getframerate(), "channels": w.getnchannels()
+            }
+    if mutagen is not None:
+        audio = mutagen.File(path)
+        if audio is not None and audio.info is not None:
+            return {"duration_seconds": audio.info.length}
+    return {"duration_seconds": None}
+
+
+def _sniff(path, prefix):
+    with open(path, 'rb') as f:
+        return f.read(len(prefix)) == prefix
+
+
+def extract_metadata(path, mime_type):
+    """Dispatches on MIME type (falling back to the extension). Returns a JSON-ready dict."""
+    mime_type = mime_type or ''
+    extension = path.rsplit('.', 1)[-1].lower() if '.' in os.path.basename(path) else ''
+    metadata = {"size": os.path.getsize(path), "mime_type": mime_type or None}
+    if mime_type.startswith('image/') or extension in ('png', 'jpg', 'jpeg', 'gif'):
+        metadata["kind"] = 'image'
+        metadata.update(extract_image_metadata(path))
+    elif mime_type == 'application/pdf' or extension == 'pdf':
+        metadata["kind"] = 'pdf'
+        metadata.update(extract_pdf_metadata(path))
+    elif mime_type.startswith('audio/') or extension in ('mp3', 'wav', 'm4a'):
+        metadata["kind"] = 'audio'
+        metadata.update(extract_audio_metadata(path))
+    else:
+        metadata["kind"] = 'other'
+    return metadata
+
+
+# --- Analyzers ---
+# An analyzer is any importable `function(path, mime_type, metadata) -> dict`,
+# selected with ANALYSIS_ANALYZER='package.module:function'.
+def basic_analyzer(path, mime_type, metadata):
+    """Default analyzer: a short human-readable description built from the metadata."""
+    kind = metadata.get("kind")
+    if kind == 'image' and metadata.get("width"):
+        summary = f"Image, {metadata['width']}x{metadata['height']} pixels"
+    elif kind == 'pdf':
+        summary = f"PDF document, {metadata.get('pages') or 'unknown number of'} pages"
+    elif kind == 'audio' and metadata.get("duration_seconds"):
+        summary = f"Audio recording, {metadata['duration_seconds']:.1f} seconds"
+    else:
+        summary = f"{(kind or 'unknown').capitalize()} file, {metadata.get('size', 0)} bytes"
+    return {"summary": summary}
+
+
+def resolve_analyzer(dotted_path):
+    module_name, _, attr = dotted_path.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def run_analysis(path, mime_type, analyzer_path):
+    """Worker-process entry point: metadata extraction followed by the configured analyzer."""
+    metadata = extract_metadata(path, mime_type)
+    analysis = resolve_analyzer(analyzer_path)(path, mime_type, metadata)
+    return {"metadata": metadata, "analysis": analysis}
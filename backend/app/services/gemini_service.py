@@ -1,35 +1,194 @@
 # backend/app/services/gemini_service.py
+import asyncio
+import hashlib
+import logging
 import os
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+import threading
+import time
+from app.services.response_cache import response_cache, make_cache_key
+from app.services.llm_backends import LLMBackend, PoolSaturated, llm_pool
+from app.services.single_flight import FlightRegistry, CallRegistry, follow, afollow
+from app.metrics import observe_span, STREAM_CHUNKS, RESPONSES
+
+logger = logging.getLogger(__name__)
 
-# --- Configuration (Keep as before, ensure MODEL_NAME is set) ---
-GOOGLE_API_KEY = None
-gemini_model = None
 MODEL_NAME = "gemini-1.5-flash"
-# ... (rest of config: safety_settings, generation_config, system_instruction) ...
-# --- Initialization Block (Keep as before) ---
-try:
-    GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
-    if not GOOGLE_API_KEY:
-        print("***************************************************************")
-        print("Gemini Service WARNING: GOOGLE_API_KEY environment variable not set.")
-        # ... (rest of warning) ...
-    else:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        print(f"Gemini Service: Configured using API Key.")
-        # ... (generation_config, safety_settings, system_instruction definitions) ...
+# Generation parameters for chat responses (empty = provider defaults). Part of the response cache key.
+GENERATION_CONFIG = {}
+# After a failed model initialization, wait this long before trying again
+MODEL_INIT_RETRY_SECONDS = 30
+
+# --- Lazy model initialization ---
+# Importing google.generativeai (and its gRPC stack) and configuring the client
+# is slow and can fail when the provider is unreachable, so it happens on first
+# use - or in the background with LLM_PREWARM - never when this module is imported.
+_model_lock = threading.Lock()
+_gemini_model = None
+_model_retry_at = 0.0 # time.monotonic() before which initialization is not retried
+
+
+def _genai():
+    import google.generativeai as genai
+    return genai
+
+
+def get_gemini_model():
+    """
+    Returns the Gemini model, configuring the SDK and building it on the first
+    call. Thread-safe: concurrent first callers wait for a single
+    initialization. Returns None when GOOGLE_API_KEY is not set or
+    initialization failed; a failure is retried after MODEL_INIT_RETRY_SECONDS,
+    not on every request.
+    """
+    global _gemini_model, _model_retry_at
+    if _gemini_model is not None:
+        return _gemini_model
+    with _model_lock:
+        if _gemini_model is not None or time.monotonic() < _model_retry_at:
+            return _gemini_model
+        api_key = os.environ.get('GOOGLE_API_KEY')
+        if not api_key:
+            logger.warning("GOOGLE_API_KEY environment variable not set; the Gemini backend is unavailable.")
+            _model_retry_at = float('inf')
+            return None
         try:
-            gemini_model = genai.GenerativeModel(
-                 model_name=MODEL_NAME,
-                 # ... (configs and instruction) ...
+            genai = _genai()
+            genai.configure(api_key=api_key)
+            _gemini_model = genai.GenerativeModel(
+                model_name=MODEL_NAME,
+                generation_config=GENERATION_CONFIG or None,
             )
-            print(f"Gemini Service: Model '{gemini_model.model_name}' initialized.")
-        except Exception as model_e:
-             print(f"Gemini Service ERROR during model initialization: {model_e}")
+            logger.info("Model '%s' initialized.", _gemini_model.model_name)
+        except Exception as e:
+            logger.error("Error during model initialization: %s", e)
+            _model_retry_at = time.monotonic() + MODEL_INIT_RETRY_SECONDS
+        return _gemini_model
+
+
+# --- Gemini backend (the default LLMBackend, see llm_backends) ---
+class GeminiBackend(LLMBackend):
+    """Google Gemini; the model is built on first use (see get_gemini_model)."""
+    model_name = MODEL_NAME
+
+    @property
+    def available(self):
+        return get_gemini_model() is not None
+
+    def prewarm(self):
+        threading.Thread(target=get_gemini_model, name='gemini-prewarm', daemon=True).start()
+
+    def stream(self, formatted_history, new_prompt, attachments=None):
+        gemini_model = get_gemini_model()
+        if not gemini_model: # Check if model is available
+             logger.error("stream() called but model not initialized.")
+             yield "[SYSTEM: AI model is currently unavailable.]"
+             return
+        logger.debug("Preparing request - history len: %d, attachments: %d, prompt: '%.50s...'",
+                     len(formatted_history), len(attachments or []), new_prompt)
+        try:
+            full_conversation = formatted_history + [_user_turn(new_prompt, attachments)]
+            response_stream = gemini_model.generate_content(full_conversation, stream=True)
+            logger.debug("Streaming response from model '%s'...", MODEL_NAME)
+            any_text_yielded = False
+            for chunk in response_stream:
+                chunk_text, stop_message = _read_chunk(chunk)
+                if stop_message:
+                    yield stop_message
+                    return
+                if chunk_text:
+                    any_text_yielded = True
+                    yield chunk_text
+
+            if any_text_yielded: logger.debug("Stream processing finished normally.")
+            else: logger.warning("Stream finished, but no text content was yielded.")
+
+        except Exception as e: # Catch general exceptions during API call
+            logger.error("Error during API call: %s - %s", type(e).__name__, e)
+            yield "[SYSTEM: Unexpected error contacting AI service.]"
+
+    async def astream(self, formatted_history, new_prompt, attachments=None):
+        """Same as stream(), on the SDK's native async client (no thread held while waiting)."""
+        # A first-use initialization (SDK import, client setup) must not block the event loop
+        gemini_model = _gemini_model or await asyncio.get_running_loop().run_in_executor(None, get_gemini_model)
+        if not gemini_model:
+             logger.error("astream() called but model not initialized.")
+             yield "[SYSTEM: AI model is currently unavailable.]"
+             return
+        try:
+            full_conversation = formatted_history + [_user_turn(new_prompt, attachments)]
+            response_stream = await gemini_model.generate_content_async(full_conversation, stream=True)
+            async for chunk in response_stream:
+                chunk_text, stop_message = _read_chunk(chunk)
+                if stop_message:
+                    yield stop_message
+                    return
+                if chunk_text:
+                    yield chunk_text
+        except Exception as e:
+            logger.error("Error during async API call: %s - %s", type(e).__name__, e)
+            yield "[SYSTEM: Unexpected error contacting AI service.]"
+
+    def generate(self, prompt, temperature=None):
+        gemini_model = get_gemini_model()
+        if not gemini_model:
+            logger.error("generate() called but model not initialized.")
+            return None
+        # Use generate_content without streaming for a simple request/response
+        response = gemini_model.generate_content(
+            prompt,
+            generation_config=_genai().types.GenerationConfig(temperature=temperature)
+        )
+        text = (response.text or '').strip()
+        if not text:
+            # Check for blocking or finish reasons if empty
+            if response.prompt_feedback and response.prompt_feedback.block_reason:
+                logger.warning("Generation blocked: %s", response.prompt_feedback.block_reason)
+            if response.candidates and response.candidates[0].finish_reason != 'STOP':
+                logger.warning("Generation finished abnormally: %s", response.candidates[0].finish_reason)
+        return text or None
+
+    def upload_attachment(self, path, mime_type):
+        """Large files go through the Gemini File API; the returned handle is valid for ~48h."""
+        if not get_gemini_model():
+            return None
+        logger.info("Uploading attachment '%s' to the File API...", os.path.basename(path))
+        return _genai().upload_file(path=path, mime_type=mime_type)
+
+
+def _user_turn(new_prompt, attachments=None):
+    """The new user message: attached file parts first, then the question about them."""
+    return {'role': 'user', 'parts': list(attachments or []) + [{'text': new_prompt}]}
+
+
+def _read_chunk(chunk):
+    """Returns (text, stop_message) for one streamed chunk; stop_message ends the stream."""
+    chunk_text = None
+    try: chunk_text = chunk.text
+    except ValueError: logger.debug("Non-text chunk - %s, %s", chunk.prompt_feedback, chunk.candidates)
+    except Exception as e_text: logger.error("Error accessing chunk.text: %s", e_text)
+
+    if not chunk_text: # Check safety/finish reason if no text
+        if chunk.prompt_feedback and chunk.prompt_feedback.block_reason: # Handle blocks
+            reason = chunk.prompt_feedback.block_reason or "Safety Filter"
+            logger.warning("Blocked - reason: %s", reason)
+            return None, f"[SYSTEM: Request blocked ({reason}). Rephrase query.]"
+        if chunk.candidates and chunk.candidates[0].finish_reason != 'STOP' and chunk.candidates[0].finish_reason is not None: # Handle non-stop finishes
+            finish_reason = chunk.candidates[0].finish_reason or "Unknown"
+            logger.warning("Generation stopped abnormally - reason: %s", finish_reason)
+    return chunk_text, None
+
+
+def _active_backend():
+    return llm_pool.backend or GeminiBackend()
+
+
+def _generate_text(prompt, backend=None, temperature=0.2):
+    """One non-streamed completion through the bounded pool (or directly on an explicit backend)."""
+    if backend is not None:
+        return backend.generate(prompt, temperature=temperature)
+    with llm_pool.slot() as pooled_backend:
+        return (pooled_backend or GeminiBackend()).generate(prompt, temperature=temperature)
 
-except Exception as e:
-    print(f"Gemini Service CRITICAL ERROR during initial configuration: {e}")
 
 # --- format_history_for_gemini (Keep as before) ---
 def format_history_for_gemini(db_messages):
@@ -42,86 +201,273 @@ def format_history_for_gemini(db_messages):
     return gemini_history
 
 
-# --- get_gemini_response_stream (Keep as before) ---
-def get_gemini_response_stream(formatted_history, new_prompt):
-    # ... (no changes needed to the streaming logic itself) ...
-    if not gemini_model: # Check if model is available
-         print("Gemini Service ERROR: get_gemini_response_stream called but model not initialized.")
-         yield "[SYSTEM: AI model is currently unavailable.]"
-         return
-    print(f"Gemini Service: Preparing request - History len: {len(formatted_history)}, Prompt: '{new_prompt[:50]}...'")
+# --- Token estimation ---
+# Cheap heuristic (~4 characters per token for English text). Counting exactly via
+# the API would cost a round trip per message, which defeats the point of budgeting.
+def estimate_tokens(text):
+    return len(text or '') // 4 + 1
+
+
+def format_summary_for_gemini(summary):
+    """Turns a rolling conversation summary into a history prefix (empty if there is none)."""
+    if not summary:
+        return []
+    return [
+        {'role': 'user', 'parts': [{'text': f"Summary of our earlier conversation, for context:\n{summary}"}]},
+        {'role': 'model', 'parts': [{'text': "Thank you, I'll keep that earlier context in mind."}]},
+    ]
+
+
+# --- Rolling summary of older turns ---
+def summarize_conversation(previous_summary, formatted_messages, backend=None, max_words=200):
+    """
+    Folds `formatted_messages` (Gemini history format) into `previous_summary`.
+
+    `backend` defaults to the pooled, configured LLM backend; any LLMBackend
+    (e.g. llm_backends.StubBackend in tests) can be passed instead. Returns the
+    new summary, or None if it could not be generated (callers keep the previous one).
+    """
+    transcript = "\n".join(
+        f"{'Assistant' if msg['role'] == 'model' else 'User'}: {msg['parts'][0]['text']}"
+        for msg in formatted_messages
+    )
+    prompt = f"""You maintain a running summary of a conversation between a user and a health assistant.
+Update the summary with the new messages below. Keep medically relevant facts (symptoms, conditions,
+medications, advice given) and drop small talk. Reply with the summary only, at most {max_words} words.
+
+Current summary:
+{previous_summary or '(none yet)'}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+
     try:
-        full_conversation = formatted_history + [{'role': 'user', 'parts': [{'text': new_prompt}]}]
-        response_stream = gemini_model.generate_content(full_conversation, stream=True)
-        print(f"Gemini Service: Streaming response from model '{MODEL_NAME}'...")
-        any_text_yielded = False
-        for chunk in response_stream:
-            # ... (stream processing logic, checking for text, safety, stop reasons - keep as before) ...
-             chunk_text = None
-             try: chunk_text = chunk.text
-             except ValueError: print(f"Gemini Service: Non-text chunk - {chunk.prompt_feedback}, {chunk.candidates}")
-             except Exception as e_text: print(f"Gemini Service ERROR accessing chunk.text: {e_text}")
-
-             if chunk_text:
-                  any_text_yielded = True
-                  yield chunk_text
-             else: # Check safety/finish reason if no text
-                 if chunk.prompt_feedback and chunk.prompt_feedback.block_reason: # Handle blocks
-                     reason = chunk.prompt_feedback.block_reason or "Safety Filter"
-                     print(f"Gemini Service WARNING: Blocked - Reason: {reason}")
-                     yield f"[SYSTEM: Request blocked ({reason}). Rephrase query.]"
-                     return
-                 if chunk.candidates and chunk.candidates[0].finish_reason != 'STOP' and chunk.candidates[0].finish_reason is not None: # Handle non-stop finishes
-                      finish_reason = chunk.candidates[0].finish_reason or "Unknown"
-                      print(f"Gemini Service WARNING: Generation stopped abnormally - Reason: {finish_reason}")
-
-        if any_text_yielded: print("Gemini Service: Stream processing finished normally.")
-        else: print("Gemini Service WARNING: Stream finished, but no text content was yielded.")
-
-    except Exception as e: # Catch general exceptions during API call
-        print(f"Gemini Service CRITICAL ERROR during API call: {type(e).__name__} - {e}")
-        yield "[SYSTEM: Unexpected error contacting AI service.]"
+        summary = _generate_text(prompt, backend=backend, temperature=0.2)
+        if summary:
+            logger.info("Updated conversation summary (%d new messages folded in).", len(formatted_messages))
+            return summary
+        logger.warning("Summary generation returned empty response.")
+        return None
+    except Exception as e:
+        logger.error("Error generating conversation summary: %s", e)
+        return None
 
 
-# --- NEW FUNCTION: Generate Chat Title ---
-def generate_chat_title(first_user_msg, first_ai_msg):
-    """Generates a concise title for a chat session using Gemini."""
-    if not gemini_model:
-        print("Gemini Service ERROR: Cannot generate title, model not initialized.")
-        return None # Return None if model isn't available
+# --- get_gemini_response_stream (response-cached, single-flight) ---
+# Identical concurrent requests from one user (double-clicks, client retries)
+# share one upstream generation: the first becomes the leader, later ones
+# follow its chunks. Callers check `.follower` on the returned stream and skip
+# persisting the turn, so only one pair of messages is saved.
+chat_flights = FlightRegistry()
+title_calls = CallRegistry()
+
+
+class ResponseStream:
+    """Iterable (sync or async, per the function that made it) of reply chunks."""
+
+    def __init__(self, chunks_fn, *args):
+        self.follower = False # Set once iteration attaches to another request's generation
+        self._chunks = chunks_fn(self, *args)
+
+    def __iter__(self):
+        return self._chunks
+
+    def __aiter__(self):
+        return self._chunks
+
+
+def get_gemini_response_stream(formatted_history, new_prompt, attachments=None, user_id=None, session_id=None):
+    """
+    Streams the model's reply as text chunks from the active LLM backend.
+    `attachments` is a list of attachment_cache.PreparedAttachment sent with the prompt.
+    Complete, successful replies are cached (see response_cache); a hit replays
+    the stored chunks without contacting the model. `[SYSTEM: ...]` outcomes
+    and interrupted streams are never cached. Upstream calls are capped by llm_pool.
+    With `user_id`, identical in-flight requests in one conversation (`session_id`)
+    are coalesced (see above).
+    """
+    return ResponseStream(_response_chunks, formatted_history, new_prompt, attachments, user_id, session_id)
+
+
+def _response_chunks(state, formatted_history, new_prompt, attachments, user_id, session_id):
+    backend = _active_backend()
+    cache_key = make_cache_key(backend.model_name, GENERATION_CONFIG, formatted_history, new_prompt,
+                               attachment_keys=[a.key for a in attachments or []])
+    cached_chunks = response_cache.get(cache_key)
+    if cached_chunks is not None:
+        logger.debug("Response cache hit for prompt '%.50s...'", new_prompt)
+        _record_cache_hit(cached_chunks)
+        yield from cached_chunks
+        return
+
+    upstream = _upstream_chunks(backend, cache_key, formatted_history, new_prompt, attachments)
+    if user_id is None:
+        yield from upstream
+        return
+    flight_key = f"{user_id}:{session_id or ''}:{cache_key}"
+    flight, leader = chat_flights.join(flight_key)
+    if not leader:
+        state.follower = True
+        logger.debug("Coalesced duplicate request from user %s onto generation in flight.", user_id)
+        RESPONSES.inc(source='coalesced')
+        yield from follow(flight)
+        return
+    try:
+        for chunk in upstream:
+            flight.append(chunk)
+            yield chunk
+    finally:
+        if flight.followers:
+            for chunk in upstream: # Our client left; finish the generation for the followers
+                flight.append(chunk)
+        chat_flights.land(flight_key, flight)
+
+
+class _UpstreamTimer:
+    """Spans of one upstream stream: pool slot wait, time to first chunk, total duration, chunk count."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stream_started = None
+        self.chunks = 0
+
+    def slot_acquired(self):
+        self.stream_started = time.perf_counter()
+        observe_span('upstream_slot_wait', self.stream_started - self.started)
+
+    def chunk(self):
+        self.chunks += 1
+        if self.chunks == 1:
+            observe_span('upstream_first_chunk', time.perf_counter() - self.stream_started)
+
+    def finished(self):
+        observe_span('upstream_stream', time.perf_counter() - self.stream_started)
+        STREAM_CHUNKS.observe(self.chunks, source='upstream')
+        RESPONSES.inc(source='upstream')
+
+
+def _record_cache_hit(cached_chunks):
+    STREAM_CHUNKS.observe(len(cached_chunks), source='cache')
+    RESPONSES.inc(source='cache')
 
+
+def _upstream_chunks(backend, cache_key, formatted_history, new_prompt, attachments):
+    # Hold one bounded upstream slot for the whole stream; fail fast when saturated
+    chunks = []
+    timer = _UpstreamTimer()
+    try:
+        with llm_pool.slot():
+            timer.slot_acquired()
+            try:
+                for chunk in backend.stream(formatted_history, new_prompt, [a.part for a in attachments or []]):
+                    timer.chunk()
+                    if chunk.startswith("[SYSTEM:"):
+                        yield chunk
+                        return
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                timer.finished()
+    except PoolSaturated as e:
+        logger.warning("Rejecting request, upstream pool saturated (%s).", e)
+        yield "[SYSTEM: The AI service is busy right now. Please try again in a moment.]"
+        return
+    response_cache.set(cache_key, chunks)
+
+
+def aget_gemini_response_stream(formatted_history, new_prompt, attachments=None, user_id=None, session_id=None):
+    """Async version of get_gemini_response_stream (same cache, pool limits and coalescing)."""
+    return ResponseStream(_aresponse_chunks, formatted_history, new_prompt, attachments, user_id, session_id)
+
+
+async def _aresponse_chunks(state, formatted_history, new_prompt, attachments, user_id, session_id):
+    backend = _active_backend()
+    cache_key = make_cache_key(backend.model_name, GENERATION_CONFIG, formatted_history, new_prompt,
+                               attachment_keys=[a.key for a in attachments or []])
+    cached_chunks = response_cache.get(cache_key)
+    if cached_chunks is not None:
+        logger.debug("Response cache hit for prompt '%.50s...'", new_prompt)
+        _record_cache_hit(cached_chunks)
+        for chunk in cached_chunks:
+            yield chunk
+        return
+
+    upstream = _aupstream_chunks(backend, cache_key, formatted_history, new_prompt, attachments)
+    if user_id is None:
+        async for chunk in upstream:
+            yield chunk
+        return
+    flight_key = f"{user_id}:{session_id or ''}:{cache_key}"
+    flight, leader = chat_flights.join(flight_key)
+    if not leader:
+        state.follower = True
+        logger.debug("Coalesced duplicate request from user %s onto generation in flight.", user_id)
+        RESPONSES.inc(source='coalesced')
+        async for chunk in afollow(flight):
+            yield chunk
+        return
+    try:
+        async for chunk in upstream:
+            flight.append(chunk)
+            yield chunk
+    finally:
+        if flight.followers:
+            async for chunk in upstream:
+                flight.append(chunk)
+        chat_flights.land(flight_key, flight)
+
+
+async def _aupstream_chunks(backend, cache_key, formatted_history, new_prompt, attachments):
+    chunks = []
+    timer = _UpstreamTimer()
+    try:
+        async with llm_pool.aslot():
+            timer.slot_acquired()
+            try:
+                async for chunk in backend.astream(formatted_history, new_prompt, [a.part for a in attachments or []]):
+                    timer.chunk()
+                    if chunk.startswith("[SYSTEM:"):
+                        yield chunk
+                        return
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                timer.finished()
+    except PoolSaturated as e:
+        logger.warning("Rejecting request, upstream pool saturated (%s).", e)
+        yield "[SYSTEM: The AI service is busy right now. Please try again in a moment.]"
+        return
+    response_cache.set(cache_key, chunks)
+
+
+# --- NEW FUNCTION: Generate Chat Title ---
+def generate_chat_title(first_user_msg, first_ai_msg, backend=None):
+    """Generates a concise title for a chat session using the active LLM backend."""
     # Keep the title prompt concise and clear
     prompt = f"""Create a very short, concise title (max 5 words) for the following conversation start:
 User: {first_user_msg[:200]}  # Limit input length
 Assistant: {first_ai_msg[:300]} # Limit input length
 Title:""" # The "Title:" acts as a prompt for the desired output format
 
-    print(f"Gemini Service: Generating title based on:\nUser: {first_user_msg[:50]}...\nAI: {first_ai_msg[:50]}...")
+    logger.debug("Generating title based on: user '%.50s...', AI '%.50s...'", first_user_msg, first_ai_msg)
 
     try:
-        # Use generate_content without streaming for a simple request/response
-        response = gemini_model.generate_content(
-            prompt,
-            # Use stricter temp for deterministic title, adjust if needed
-            generation_config=genai.types.GenerationConfig(temperature=0.2)
-        )
-
-        # Access generated text safely
-        generated_title = response.text.strip().replace('"', '') # Remove quotes if AI adds them
+        # Use stricter temp for deterministic title, adjust if needed. Concurrent
+        # requests for the same conversation start share one model call.
+        title_key = hashlib.sha256(f"{getattr(backend, 'model_name', None)}|{prompt}".encode('utf-8')).hexdigest()
+        generated_title = title_calls.do(title_key, lambda: _generate_text(prompt, backend=backend, temperature=0.2))
         if generated_title:
-             print(f"Gemini Service: Generated Title - '{generated_title}'")
+             generated_title = generated_title.replace('"', '') # Remove quotes if AI adds them
+             logger.info("Generated title '%s'", generated_title)
              return generated_title[:100] # Limit title length just in case
         else:
-            print("Gemini Service WARNING: Title generation returned empty response.")
-            # Check for blocking or finish reasons if empty
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                print(f"Title gen blocked: {response.prompt_feedback.block_reason}")
-            if response.candidates and response.candidates[0].finish_reason != 'STOP':
-                print(f"Title gen finished abnormally: {response.candidates[0].finish_reason}")
+            logger.warning("Title generation returned empty response.")
             return None
 
     except Exception as e:
-        print(f"Gemini Service ERROR generating chat title: {e}")
+        logger.error("Error generating chat title: %s", e)
         return None # Return None on error
 
-# --- END NEW FUNCTION ---
\ No newline at end of file
+# --- END NEW FUNCTION ---
@@ -0,0 +1,290 @@
+# backend/app/services/history_archive.py
+# Hot/cold tiering of chat history: compaction into compressed archive segments.
+import datetime
+import gzip
+import json
+import logging
+from collections import namedtuple
+from sqlalchemy import select, delete, tuple_
+from app import db
+from app.database import read_bind
+from app.models import User, ChatMessage, ChatArchiveSegment
+from app.services.search_service import index_archived_messages, unindex_archived_messages
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard # Optional: smaller and faster than gzip when installed
+except ImportError:
+    zstandard = None
+
+# Archived rows come back with the same attributes as ChatMessage, so
+# serialize_message / encode_cursor work on both tiers.
+ArchivedMessage = namedtuple('ArchivedMessage', 'id sender content content_type timestamp attachment_ids session_id')
+
+_ARCHIVED_COLUMNS = (ChatMessage.id, ChatMessage.sender, ChatMessage.content, ChatMessage.content_type,
+                     ChatMessage.timestamp, ChatMessage.attachment_ids, ChatMessage.session_id)
+_SEGMENT_METADATA = (ChatArchiveSegment.id, ChatArchiveSegment.codec,
+                     ChatArchiveSegment.first_timestamp, ChatArchiveSegment.first_message_id,
+                     ChatArchiveSegment.last_timestamp, ChatArchiveSegment.last_message_id)
+
+
+def _position(msg):
+    return (msg.timestamp, msg.id)
+
+
+# --- Segment encoding ---
+def compress(codec, raw):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Archive segment is zstd-compressed but the 'zstandard' package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def encode_messages(messages):
+    return json.dumps([
+        [m.id, m.sender, m.content, m.content_type, m.timestamp.isoformat(), m.attachment_ids, m.session_id]
+        for m in messages
+    ], separators=(',', ':')).encode('utf-8')
+
+
+def decode_messages(raw):
+    return [
+        ArchivedMessage(msg_id, sender, content, content_type, datetime.datetime.fromisoformat(ts),
+                        attachment_ids, session_id)
+        for msg_id, sender, content, content_type, ts, attachment_ids, session_id in json.loads(raw)
+    ]
+
+
+def _load_segment(segment_id, codec):
+    payload = db.session.execute(
+        select(ChatArchiveSegment.payload).where(ChatArchiveSegment.id == segment_id),
+        bind_arguments=read_bind()
+    ).scalar_one()
+    return decode_messages(decompress(codec, payload))
+
+
+# --- Reads ---
+def iter_archived(user_id, session_id=None, before=None, after=None, since=None, newest_first=False, stop_at=None):
+    """
+    Yields a user's archived messages in (timestamp, id) order - oldest first,
+    or newest first with `newest_first` - optionally limited to one session,
+    to positions strictly before/after the given (timestamp, id) tuples, or to
+    timestamps after `since`. Segments are decompressed one at a time, only
+    when the walk reaches them; with `stop_at`, segments lying entirely past
+    that position (in walk order) are not opened at all.
+    """
+    stmt = select(*_SEGMENT_METADATA).where(ChatArchiveSegment.user_id == user_id)
+    if session_id is not None:
+        stmt = stmt.where(ChatArchiveSegment.session_id == session_id)
+    first = tuple_(ChatArchiveSegment.first_timestamp, ChatArchiveSegment.first_message_id)
+    last = tuple_(ChatArchiveSegment.last_timestamp, ChatArchiveSegment.last_message_id)
+    if before is not None:
+        stmt = stmt.where(first < tuple_(*before))
+    if after is not None:
+        stmt = stmt.where(last > tuple_(*after))
+    if since is not None:
+        stmt = stmt.where(ChatArchiveSegment.last_timestamp > since)
+    if newest_first:
+        stmt = stmt.order_by(ChatArchiveSegment.last_timestamp.desc(), ChatArchiveSegment.last_message_id.desc())
+    else:
+        stmt = stmt.order_by(ChatArchiveSegment.first_timestamp.asc(), ChatArchiveSegment.first_message_id.asc())
+    segments = db.session.execute(stmt, bind_arguments=read_bind()).all()
+
+    def in_range(msg):
+        position = _position(msg)
+        return ((before is None or position < before) and (after is None or position > after)
+                and (since is None or msg.timestamp > since))
+
+    # Segments of different sessions may overlap in time, so merge through a
+    # buffer kept in reverse walk order (the next message to yield is last).
+    # Before opening a segment, everything that sorts ahead of its edge is final.
+    buffer = []
+    for segment_id, codec, first_ts, first_id, last_ts, last_id in segments:
+        edge = (last_ts, last_id) if newest_first else (first_ts, first_id)
+        while buffer and (_position(buffer[-1]) > edge if newest_first else _position(buffer[-1]) < edge):
+            yield buffer.pop()
+        if stop_at is not None and (edge < stop_at if newest_first else edge > stop_at):
+            break
+        buffer.extend(m for m in _load_segment(segment_id, codec) if in_range(m))
+        buffer.sort(key=_position, reverse=not newest_first)
+    while buffer:
+        yield buffer.pop()
+
+
+# --- Bounded deletes ---
+def purge_history(user_id, session_id=None, batch_size=1000):
+    """
+    Deletes a user's messages (hot and archived; one session's with `session_id`)
+    in transactions of at most `batch_size` rows, so a large account never holds
+    the SQLite write lock for long. Returns the number of messages deleted.
+    """
+    deleted = 0
+    while True:
+        stmt = select(ChatMessage.id).where(ChatMessage.user_id == user_id)
+        if session_id is not None:
+            stmt = stmt.where(ChatMessage.session_id == session_id)
+        ids = db.session.execute(stmt.limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        db.session.execute(delete(ChatMessage).where(ChatMessage.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+
+    # Unsearchable first: a purge interrupted midway must not leave deleted text findable
+    unindex_archived_messages(user_id, session_id)
+    db.session.commit()
+    # Segments are big rows; a few at a time
+    segment_batch = max(1, batch_size // 100)
+    while True:
+        stmt = select(ChatArchiveSegment.id, ChatArchiveSegment.message_count)\
+            .where(ChatArchiveSegment.user_id == user_id)
+        if session_id is not None:
+            stmt = stmt.where(ChatArchiveSegment.session_id == session_id)
+        segments = db.session.execute(stmt.limit(segment_batch)).all()
+        if not segments:
+            break
+        db.session.execute(delete(ChatArchiveSegment).where(ChatArchiveSegment.id.in_([s.id for s in segments])))
+        db.session.commit()
+        deleted += sum(s.message_count for s in segments)
+    return deleted
+
+
+# --- Compaction ---
+class HistoryArchive:
+    """
+    Moves messages older than ARCHIVE_AFTER_DAYS out of chat_message into
+    compressed per-conversation segments (ChatArchiveSegment), keeping the hot
+    table and its indexes (including the search index) small so inserts and
+    recent-history reads stay fast. History pages and exports merge both tiers
+    (see history_service). Run it from cron with `flask compact-history`.
+
+    Each segment is written in one short transaction together with the delete
+    of its source rows; the delete must remove exactly the rows that were
+    archived, so two compactors racing on the same conversation can't archive a
+    message twice. A conversation's newest segment is topped up until full
+    before a new one is started, so daily runs don't leave a trail of tiny segments.
+    """
+
+    def __init__(self):
+        self.after_days = 90
+        self.segment_messages = 1000
+        self.codec = 'gzip'
+        self.delete_batch_size = 1000
+        self.archived = 0
+        self.segments_written = 0
+
+    def init_app(self, app):
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS', self.after_days)
+        self.segment_messages = app.config.get('ARCHIVE_SEGMENT_MESSAGES', self.segment_messages)
+        self.delete_batch_size = app.config.get('HISTORY_DELETE_BATCH_SIZE', self.delete_batch_size)
+        codec = app.config.get('ARCHIVE_CODEC', self.codec)
+        if codec == 'zstd' and zstandard is None:
+            logger.warning("ARCHIVE_CODEC=zstd but 'zstandard' is not installed; using gzip.")
+            codec = 'gzip'
+        self.codec = codec
+
+    def cutoff(self, older_than_days=None):
+        days = self.after_days if older_than_days is None else older_than_days
+        return datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    def compact(self, cutoff=None, user_ids=None):
+        """Compacts every user (or the given ones). Returns {"users": n, "messages": n}."""
+        cutoff = cutoff or self.cutoff()
+        if user_ids is None:
+            user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+        users = messages = 0
+        for user_id in user_ids:
+            archived = self.compact_user(user_id, cutoff)
+            if archived:
+                users += 1
+                messages += archived
+        return {"users": users, "messages": messages}
+
+    def compact_user(self, user_id, cutoff=None):
+        """Archives one user's messages older than `cutoff`. Returns the number archived."""
+        cutoff = cutoff or self.cutoff()
+        session_ids = db.session.execute(
+            select(ChatMessage.session_id).distinct()
+            .where(ChatMessage.user_id == user_id, ChatMessage.timestamp < cutoff)
+        ).scalars().all()
+        archived = 0
+        for session_id in session_ids:
+            while True:
+                written = self._write_segment(user_id, session_id, cutoff)
+                archived += written
+                if not written:
+                    break
+        return archived
+
+    def _write_segment(self, user_id, session_id, cutoff):
+        """Archives up to one segment's worth of old messages. Returns how many were archived."""
+        rows = db.session.execute(
+            select(*_ARCHIVED_COLUMNS).where(
+                ChatMessage.user_id == user_id, ChatMessage.timestamp < cutoff,
+                ChatMessage.session_id.is_(None) if session_id is None else ChatMessage.session_id == session_id
+            ).order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc()).limit(self.segment_messages)
+        ).all()
+        if not rows:
+            return 0
+        messages = [ArchivedMessage(*row) for row in rows]
+
+        tail = ChatArchiveSegment.query.filter(
+            ChatArchiveSegment.user_id == user_id,
+            ChatArchiveSegment.session_id.is_(None) if session_id is None
+            else ChatArchiveSegment.session_id == session_id
+        ).order_by(ChatArchiveSegment.last_timestamp.desc(), ChatArchiveSegment.last_message_id.desc()).first()
+        # Top up the newest segment if it has room and these messages follow it
+        # (rows that sort before it, e.g. late inserts, start a segment of their own)
+        if (tail is not None and tail.message_count < self.segment_messages
+                and _position(messages[0]) > (tail.last_timestamp, tail.last_message_id)):
+            messages = messages[:self.segment_messages - tail.message_count]
+            segment = tail
+            self._fill(segment, decode_messages(decompress(tail.codec, tail.payload)) + messages)
+        else:
+            segment = ChatArchiveSegment(user_id=user_id, session_id=session_id)
+            db.session.add(segment)
+            self._fill(segment, messages)
+        index_archived_messages(user_id, messages) # Committed (or rolled back) with the segment
+        return self._delete_archived(user_id, [m.id for m in messages])
+
+    def _fill(self, segment, messages):
+        raw = encode_messages(messages)
+        segment.codec = self.codec
+        segment.payload = compress(self.codec, raw)
+        segment.raw_size = len(raw)
+        segment.message_count = len(messages)
+        segment.first_timestamp, segment.first_message_id = messages[0].timestamp, messages[0].id
+        segment.last_timestamp, segment.last_message_id = messages[-1].timestamp, messages[-1].id
+
+    def _delete_archived(self, user_id, ids):
+        try:
+            result = db.session.execute(
+                delete(ChatMessage).where(ChatMessage.id.in_(ids), ChatMessage.user_id == user_id)
+            )
+            if result.rowcount != len(ids):
+                # Another compactor (or a history delete) got to some of these rows first
+                db.session.rollback()
+                logger.warning("Rows for user %s changed during compaction; skipping.", user_id)
+                return 0
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Failed to write archive segment for user %s: %s", user_id, e)
+            return 0
+        self.archived += len(ids)
+        self.segments_written += 1
+        return len(ids)
+
+    def stats(self):
+        return {"archived": self.archived, "segments_written": self.segments_written, "codec": self.codec}
+
+
+history_archive = HistoryArchive()
@@ -0,0 +1,161 @@
+# backend/app/services/history_cache.py
+import threading
+from collections import OrderedDict, deque
+from app.services.gemini_service import estimate_tokens, format_summary_for_gemini
+
+
+class _Window:
+    """One conversation's cached state: the rolling summary plus the token-budgeted message window."""
+    __slots__ = ('summary', 'entries', 'tokens', 'bytes', 'overflowed')
+
+    def __init__(self, summary=None):
+        self.summary = summary
+        self.entries = deque() # (formatted entry, token estimate, byte size)
+        self.tokens = 0
+        self.bytes = len(summary or '')
+        # Set when messages have fallen out of the window and are not yet in the summary
+        self.overflowed = False
+
+
+class HistoryWindowCache:
+    """
+    Per-conversation ring buffer of already-formatted Gemini history, keyed by
+    (user, session); session None is the user's default conversation.
+
+    Each chat turn only adds two messages to the window, so instead of
+    re-querying and re-formatting recent rows every time, handle_chat keeps
+    the formatted window here and appends to it after each commit. The window
+    holds as many of the newest messages as fit `token_budget` (the newest one
+    is always kept), preceded by the conversation's rolling summary of older
+    turns. Conversations are evicted least-recently-used first once either
+    `max_users` or the approximate `max_bytes` of cached text is exceeded.
+
+    The cache is per process: with several workers each keeps its own copy,
+    and a miss simply falls back to the database.
+    """
+
+    def __init__(self, token_budget=3000, max_users=1000, max_bytes=32 * 1024 * 1024):
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._windows = OrderedDict() # 'user_id:session_id' -> _Window
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.token_budget = app.config.get('CHAT_HISTORY_TOKEN_BUDGET', self.token_budget)
+        self.max_users = app.config.get('HISTORY_CACHE_MAX_USERS', self.max_users)
+        self.max_bytes = app.config.get('HISTORY_CACHE_MAX_BYTES', self.max_bytes)
+        self.clear()
+
+    def _key(self, user_id, session_id=None):
+        # JWT identities may arrive as str or int depending on the token
+        return f"{user_id}:{session_id or ''}"
+
+    def get(self, user_id, session_id=None):
+        """Returns the cached prompt history (summary prefix + window), or None on a miss."""
+        key = self._key(user_id, session_id)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                self.misses += 1
+                return None
+            self._windows.move_to_end(key)
+            self.hits += 1
+            return format_summary_for_gemini(window.summary) + [entry for entry, _, _ in window.entries]
+
+    def put(self, user_id, formatted_history, summary=None, overflowed=False, session_id=None):
+        """Seeds (or replaces) a conversation's window, e.g. after a cache miss."""
+        key = self._key(user_id, session_id)
+        with self._lock:
+            self._drop(key)
+            window = self._windows[key] = _Window(summary)
+            self._total_bytes += window.bytes
+            self._extend(window, formatted_history)
+            window.overflowed = window.overflowed or overflowed
+            self._evict()
+
+    def append(self, user_id, formatted_entries, session_id=None):
+        """
+        Adds newly committed messages. No-op if the conversation is not cached.
+        Returns True if older messages are waiting to be folded into the summary.
+        """
+        key = self._key(user_id, session_id)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return False
+            self._windows.move_to_end(key)
+            self._extend(window, formatted_entries)
+            overflowed = window.overflowed
+            self._evict()
+            return overflowed
+
+    def set_summary(self, user_id, summary, session_id=None):
+        """Swaps in a freshly updated rolling summary for a cached conversation."""
+        key = self._key(user_id, session_id)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return
+            delta = len(summary or '') - len(window.summary or '')
+            window.summary = summary
+            window.bytes += delta
+            self._total_bytes += delta
+            window.overflowed = False
+            self._evict()
+
+    def invalidate(self, user_id, session_id=None):
+        with self._lock:
+            self._drop(self._key(user_id, session_id))
+
+    def invalidate_user(self, user_id):
+        """Drops every cached conversation of a user."""
+        prefix = self._key(user_id)
+        with self._lock:
+            for key in [k for k in self._windows if k.startswith(prefix)]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._windows), "bytes": self._total_bytes,
+                "hits": self.hits, "misses": self.misses
+            }
+
+    # --- Internal helpers (caller holds the lock) ---
+    def _extend(self, window, entries):
+        for entry in entries:
+            text = ''.join(part.get('text', '') for part in entry['parts'])
+            tokens, size = estimate_tokens(text), len(text) + 64
+            window.entries.append((entry, tokens, size))
+            window.tokens += tokens
+            window.bytes += size
+            self._total_bytes += size
+        # Drop the oldest messages until the window fits the budget again
+        while window.tokens > self.token_budget and len(window.entries) > 1:
+            _, tokens, size = window.entries.popleft()
+            window.tokens -= tokens
+            window.bytes -= size
+            self._total_bytes -= size
+            window.overflowed = True
+
+    def _drop(self, key):
+        window = self._windows.pop(key, None)
+        if window is not None:
+            self._total_bytes -= window.bytes
+
+    def _evict(self):
+        while self._windows and (len(self._windows) > self.max_users or self._total_bytes > self.max_bytes):
+            oldest_key = next(iter(self._windows))
+            self._drop(oldest_key)
+
+
+history_cache = HistoryWindowCache()
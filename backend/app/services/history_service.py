@@ -0,0 +1,318 @@
+# backend/app/services/history_service.py
+import base64
+import datetime
+import heapq
+import json
+import logging
+import threading
+from itertools import islice
+from sqlalchemy import select, tuple_
+from app import db
+from app.database import read_bind
+from app.models import ChatMessage, ConversationSummary
+from app.services.gemini_service import estimate_tokens, format_history_for_gemini, summarize_conversation
+from app.services.history_cache import history_cache
+from app.services.history_archive import iter_archived
+
+logger = logging.getLogger(__name__)
+
+# --- Pagination limits for GET /api/chat/history ---
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Rows pulled from the DB cursor per round trip while streaming an export
+EXPORT_BATCH_SIZE = 500
+# Rows pulled per round trip while walking back through history to fill a token budget
+WINDOW_BATCH_SIZE = 50
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client supplies a cursor we did not issue (or cannot parse)."""
+
+
+# --- Opaque cursor helpers ---
+# A cursor is the (timestamp, id) position of a row, base64url encoded so
+# clients treat it as an opaque token and never depend on its layout.
+def encode_position(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def encode_cursor(msg):
+    return encode_position(msg.timestamp, msg.id)
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        ts_part, id_part = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(ts_part), int(id_part)
+    except Exception:
+        raise InvalidCursor("Malformed cursor")
+
+
+def serialize_message(msg):
+    """JSON-ready dict for a ChatMessage (shared by history and export endpoints)."""
+    return {
+        "id": msg.id, "sender": msg.sender, "content": msg.content,
+        "content_type": msg.content_type, "timestamp": msg.timestamp.isoformat() + 'Z',
+        "attachments": json.loads(msg.attachment_ids) if msg.attachment_ids else [],
+        "session_id": msg.session_id
+    }
+
+
+def _in_conversation(session_id):
+    """Filter for one conversation's messages; session None is the default (sessionless) one."""
+    if session_id is None:
+        return ChatMessage.session_id.is_(None)
+    return ChatMessage.session_id == session_id
+
+
+# --- Keyset queries (served by ix_chat_message_user_id_timestamp_id / ix_chat_message_session_id_timestamp_id) ---
+def fetch_history_page(user_id, before=None, after=None, limit=DEFAULT_PAGE_SIZE, session_id=None):
+    """
+    Returns (messages, has_more) for one page of a user's history, oldest first.
+    With `session_id`, only that session's messages are paged.
+
+    `before` / `after` are cursors previously returned by this function. With
+    neither, the newest page is returned; `has_more` then tells whether older
+    messages exist (walk back with `before`). With `after`, `has_more` tells
+    whether newer messages exist beyond this page.
+
+    Messages compacted into archive segments are merged in transparently; a
+    segment is only decompressed when the page actually reaches into it.
+    """
+    if before and after:
+        raise InvalidCursor("Use either 'before' or 'after', not both")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    position = tuple_(ChatMessage.timestamp, ChatMessage.id)
+    before = decode_cursor(before) if before else None
+    after = decode_cursor(after) if after else None
+
+    stmt = select(ChatMessage).where(ChatMessage.user_id == user_id)
+    if session_id is not None:
+        stmt = stmt.where(ChatMessage.session_id == session_id)
+    if after:
+        stmt = stmt.where(position > tuple_(*after))\
+                   .order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc())
+    else:
+        if before:
+            stmt = stmt.where(position < tuple_(*before))
+        stmt = stmt.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+
+    # Fetch one extra row to learn whether another page exists without a COUNT(*)
+    # Served by the read engine when one is configured
+    rows = db.session.execute(stmt.limit(limit + 1), bind_arguments=read_bind()).scalars().all()
+    # Archived rows can only matter if they sort ahead of the last hot row we'd keep
+    stop_at = _message_position(rows[limit]) if len(rows) > limit else None
+    archived = islice(iter_archived(user_id, session_id, before=before, after=after,
+                                    newest_first=not after, stop_at=stop_at), limit + 1)
+    rows = list(islice(heapq.merge(rows, archived, key=_message_position, reverse=not after), limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after:
+        rows.reverse()
+    return rows, has_more
+
+
+def _message_position(msg):
+    return (msg.timestamp, msg.id)
+
+
+# --- Token-budgeted context window + rolling summary ---
+def _iter_uncovered_newest_first(user_id, covered_until=None, batch_size=WINDOW_BATCH_SIZE, session_id=None):
+    """Yields a conversation's messages newer than the summary's covered position, newest first, batch by batch."""
+    position = tuple_(ChatMessage.timestamp, ChatMessage.id)
+    cursor = None
+    while True:
+        query = ChatMessage.query.filter(ChatMessage.user_id == user_id, _in_conversation(session_id))
+        if covered_until is not None:
+            query = query.filter(position > tuple_(*covered_until))
+        if cursor is not None:
+            query = query.filter(position < tuple_(*cursor))
+        batch = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())\
+                     .limit(batch_size).all()
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        cursor = (batch[-1].timestamp, batch[-1].id)
+
+
+def _split_window(messages_newest_first, token_budget):
+    """
+    Consumes messages (newest first) until `token_budget` is spent.
+    Returns (window, rest): the window in chronological order and the iterator
+    positioned at the first message that did not fit. The newest message is
+    always kept, mirroring HistoryWindowCache.
+    """
+    messages = iter(messages_newest_first)
+    window, used = [], 0
+    for msg in messages:
+        tokens = estimate_tokens(msg.content)
+        if window and used + tokens > token_budget:
+            return list(reversed(window)), _prepend(msg, messages)
+        window.append(msg)
+        used += tokens
+    window.reverse()
+    return window, iter(())
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def _covered_position(summary_row):
+    if summary_row is None:
+        return None
+    return (summary_row.covered_until_timestamp, summary_row.covered_until_id)
+
+
+def build_context_window(user_id, token_budget, session_id=None):
+    """
+    Loads what a chat turn sends as history: the conversation's persisted
+    rolling summary and the newest messages that fit `token_budget`.
+    Returns (summary_text, window_messages, overflowed), where `overflowed` means
+    older messages exist that the summary does not cover yet.
+    """
+    summary_row = ConversationSummary.query.filter_by(user_id=user_id, session_id=session_id).first()
+    window, rest = _split_window(
+        _iter_uncovered_newest_first(user_id, _covered_position(summary_row), session_id=session_id),
+        token_budget
+    )
+    overflowed = next(rest, None) is not None
+    return (summary_row.content if summary_row else None), window, overflowed
+
+
+def update_rolling_summary(user_id, token_budget, input_token_budget, backend=None, session_id=None):
+    """
+    Folds messages that fell out of the token window into the conversation's persisted summary.
+
+    Only messages between the summary's covered position and the window are
+    summarized, newest first up to `input_token_budget`, so each update is a
+    single bounded model call (on a first run over a long history, anything
+    older than that is skipped rather than summarized). Returns the current
+    summary text (unchanged if there was nothing to fold or generation failed).
+    """
+    summary_row = ConversationSummary.query.filter_by(user_id=user_id, session_id=session_id).first()
+    _, rest = _split_window(
+        _iter_uncovered_newest_first(user_id, _covered_position(summary_row), session_id=session_id),
+        token_budget
+    )
+    evicted, used = [], 0
+    for msg in rest:
+        used += estimate_tokens(msg.content)
+        if evicted and used > input_token_budget:
+            break
+        evicted.append(msg)
+
+    previous = summary_row.content if summary_row else None
+    if not evicted:
+        return previous
+    evicted.reverse()
+
+    summary = summarize_conversation(previous, format_history_for_gemini(evicted), backend=backend)
+    if not summary:
+        return previous
+
+    if summary_row is None:
+        summary_row = ConversationSummary(user_id=user_id, session_id=session_id)
+        db.session.add(summary_row)
+    summary_row.content = summary
+    summary_row.covered_until_timestamp = evicted[-1].timestamp
+    summary_row.covered_until_id = evicted[-1].id
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Failed to save conversation summary for user %s: %s", user_id, e)
+        return previous
+    return summary
+
+
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+def schedule_summary_update(app, user_id, session_id=None):
+    """
+    Runs update_rolling_summary for a conversation on a background thread, at
+    most one per conversation at a time, and pushes the result into the history
+    window cache. Keeps summarization off the streaming response path.
+    """
+    key = f"{user_id}-{session_id or 0}"
+    with _summaries_lock:
+        if key in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(key)
+
+    def run():
+        try:
+            with app.app_context():
+                summary = update_rolling_summary(
+                    user_id,
+                    app.config['CHAT_HISTORY_TOKEN_BUDGET'],
+                    app.config['CHAT_SUMMARY_INPUT_TOKEN_BUDGET'],
+                    session_id=session_id
+                )
+                history_cache.set_summary(user_id, summary, session_id=session_id)
+        except Exception as e:
+            logger.exception("Error updating conversation summary for user %s: %s", user_id, e)
+        finally:
+            with _summaries_lock:
+                _summaries_in_flight.discard(key)
+
+    threading.Thread(target=run, name=f"summary-{key}", daemon=True).start()
+
+
+# --- Streaming export ---
+def parse_since(value):
+    """Parses the `since` export filter (ISO 8601, optional trailing 'Z'). None if absent."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value.rstrip('Z'))
+    except ValueError:
+        raise InvalidCursor("'since' must be an ISO 8601 timestamp")
+    # Timestamps are stored as naive UTC
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def iter_export_rows(user_id, since=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields a user's messages oldest first, straight off a server-side cursor,
+    merged with the archived ones (one decompressed segment at a time).
+
+    Plain column rows are selected (not ORM entities) so nothing accumulates in
+    the session identity map, and `yield_per` keeps at most one batch in memory.
+    """
+    stmt = select(ChatMessage.id, ChatMessage.sender, ChatMessage.content,
+                  ChatMessage.content_type, ChatMessage.timestamp, ChatMessage.attachment_ids,
+                  ChatMessage.session_id)\
+        .where(ChatMessage.user_id == user_id)
+    if since is not None:
+        stmt = stmt.where(ChatMessage.timestamp > since)
+    stmt = stmt.order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc())\
+               .execution_options(yield_per=batch_size)
+    result = db.session.execute(stmt, bind_arguments=read_bind())
+    try:
+        yield from heapq.merge(iter_archived(user_id, since=since), result, key=_message_position)
+    finally:
+        result.close()
+
+
+def stream_export(user_id, since=None, fmt='ndjson'):
+    """Yields the serialized export body chunk by chunk ('ndjson' or 'json' array)."""
+    rows = iter_export_rows(user_id, since=since)
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(serialize_message(row)) + '\n'
+        return
+
+    yield '['
+    first = True
+    for row in rows:
+        yield ('' if first else ',') + json.dumps(serialize_message(row))
+        first = False
+    yield ']'
@@ -0,0 +1,244 @@
+# backend/app/services/llm_backends.py
+import asyncio
+import hashlib
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+
+class LLMBackend:
+    """
+    Interface for the model provider behind gemini_service.
+
+    stream()   yields text chunks for a chat turn; failures are reported as a
+               single `[SYSTEM: ...]` chunk, never raised. `attachments` are
+               prepared request parts (see attachment_cache) sent with the prompt.
+    astream()  async version of stream() for the ASGI serving mode.
+    generate() returns a complete (non-streamed) text reply, or None on failure.
+    upload_attachment() stores a file too large to inline with the provider and
+               returns a handle usable as a part, or None if unsupported.
+    prewarm()  starts any slow client setup in the background (LLM_PREWARM), so
+               the first request doesn't pay for it; must not block.
+    """
+    model_name = None
+
+    @property
+    def available(self):
+        return True
+
+    def stream(self, formatted_history, prompt, attachments=None):
+        raise NotImplementedError
+
+    async def astream(self, formatted_history, prompt, attachments=None):
+        """
+        Fallback for backends without a native async client: runs stream() on a
+        worker thread and hands chunks to the event loop as they arrive.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in self.stream(formatted_history, prompt, attachments):
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        loop.run_in_executor(None, pump)
+        while True:
+            chunk = await queue.get()
+            if chunk is done:
+                return
+            yield chunk
+
+    def generate(self, prompt, temperature=None):
+        raise NotImplementedError
+
+    def upload_attachment(self, path, mime_type):
+        return None
+
+    def prewarm(self):
+        pass
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic local stand-in for the real model: streams canned tokens with
+    configurable latency and never touches the network. Used for offline
+    development and load tests (LLM_BACKEND=stub).
+    """
+    model_name = 'stub'
+
+    def __init__(self, token_latency=0.05, first_token_latency=0.2, num_tokens=40):
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.num_tokens = num_tokens
+
+    def _reply_words(self, prompt):
+        # Same prompt -> same reply, so runs are reproducible
+        seed = hashlib.sha256((prompt or '').encode('utf-8')).hexdigest()
+        words = ["This", "is", "a", "stub", "response", "for", f"request-{seed[:8]}."]
+        filler = ["Please", "consult", "a", "healthcare", "professional", "for", "medical", "advice."]
+        while len(words) < self.num_tokens:
+            words.append(filler[len(words) % len(filler)])
+        return words[:self.num_tokens]
+
+    def stream(self, formatted_history, prompt, attachments=None):
+        time.sleep(self.first_token_latency)
+        for i, word in enumerate(self._reply_words(prompt)):
+            if i:
+                time.sleep(self.token_latency)
+            yield word + ' '
+
+    async def astream(self, formatted_history, prompt, attachments=None):
+        await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(self._reply_words(prompt)):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield word + ' '
+
+    def generate(self, prompt, temperature=None):
+        time.sleep(self.first_token_latency)
+        return ' '.join(self._reply_words(prompt)[:5])
+
+
+class PoolSaturated(Exception):
+    """Raised when no upstream slot frees up: the wait queue is full or the wait timed out."""
+
+
+class BackendPool:
+    """
+    Holds the active LLMBackend and caps concurrent upstream calls.
+
+    At most `max_in_flight` calls run at once; up to `max_queue` more wait up to
+    `queue_timeout` seconds for a slot. Beyond that callers fail fast with
+    PoolSaturated instead of piling more requests onto the provider.
+    """
+
+    def __init__(self, backend=None, max_in_flight=8, max_queue=32, queue_timeout=10.0):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.configure(
+            backend=self._backend_from_config(app.config),
+            max_in_flight=app.config.get('LLM_MAX_IN_FLIGHT', self.max_in_flight),
+            max_queue=app.config.get('LLM_MAX_QUEUE', self.max_queue),
+            queue_timeout=app.config.get('LLM_QUEUE_TIMEOUT', self.queue_timeout),
+        )
+        if app.config.get('LLM_PREWARM'):
+            self.backend.prewarm()
+
+    @staticmethod
+    def _backend_from_config(config):
+        name = config.get('LLM_BACKEND', 'gemini')
+        if name == 'stub':
+            return StubBackend(
+                token_latency=config.get('STUB_LLM_TOKEN_LATENCY', 0.05),
+                first_token_latency=config.get('STUB_LLM_FIRST_TOKEN_LATENCY', 0.2),
+            )
+        if name == 'gemini':
+            from app.services.gemini_service import GeminiBackend # Avoid import cycle
+            return GeminiBackend()
+        raise ValueError(f"Unknown LLM_BACKEND '{name}'")
+
+    def configure(self, backend=None, max_in_flight=None, max_queue=None, queue_timeout=None):
+        with self._lock:
+            if backend is not None:
+                self.backend = backend
+            if max_in_flight is not None and max_in_flight != self.max_in_flight:
+                self.max_in_flight = max_in_flight
+                self._semaphore = threading.BoundedSemaphore(max_in_flight)
+            if max_queue is not None:
+                self.max_queue = max_queue
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+
+    @contextmanager
+    def slot(self):
+        """Holds one upstream slot for the duration of the block (e.g. a whole stream)."""
+        semaphore = self._semaphore
+        if not semaphore.acquire(blocking=False):
+            self._enter_queue()
+            try:
+                acquired = semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                self._leave_queue()
+            if not acquired:
+                self._reject("Timed out waiting for an LLM slot")
+        try:
+            yield self._start()
+        finally:
+            self._finish(semaphore)
+
+    @asynccontextmanager
+    async def aslot(self):
+        """
+        Async version of slot() sharing the same limits. Waiting polls with a short
+        backoff rather than blocking, so queued requests don't tie up threads.
+        """
+        semaphore = self._semaphore
+        if not semaphore.acquire(blocking=False):
+            self._enter_queue()
+            acquired = False
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                delay = 0.005
+                while not acquired and time.monotonic() < deadline:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+                    acquired = semaphore.acquire(blocking=False)
+            finally:
+                self._leave_queue()
+            if not acquired:
+                self._reject("Timed out waiting for an LLM slot")
+        try:
+            yield self._start()
+        finally:
+            self._finish(semaphore)
+
+    # --- Slot bookkeeping shared by slot() and aslot() ---
+    def _enter_queue(self):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise PoolSaturated("LLM request queue is full")
+            self.waiting += 1
+
+    def _leave_queue(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected += 1
+        raise PoolSaturated(reason)
+
+    def _start(self):
+        with self._lock:
+            self.in_flight += 1
+        return self.backend
+
+    def _finish(self, semaphore):
+        with self._lock:
+            self.in_flight -= 1
+        semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": getattr(self.backend, 'model_name', None),
+                "in_flight": self.in_flight, "waiting": self.waiting, "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight, "max_queue": self.max_queue
+            }
+
+
+llm_pool = BackendPool()
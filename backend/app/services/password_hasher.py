@@ -0,0 +1,85 @@
+# backend/app/services/password_hasher.py
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from app import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash/verify jobs are already queued; callers answer 503."""
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a small dedicated thread pool instead of on whichever request
+    thread happens to need it. bcrypt releases the GIL, so up to `threads`
+    hashes run in parallel while other requests keep being served; at most
+    `max_queue` more wait, and beyond that callers fail fast with
+    PasswordHasherBusy rather than letting a login burst stall the worker.
+
+    The cost factor comes from BCRYPT_LOG_ROUNDS (also read by Flask-Bcrypt).
+    Hashes made with a different cost are upgraded on the next successful login
+    (see needs_rehash).
+    """
+
+    def __init__(self, threads=2, max_queue=64, timeout=10.0, rounds=12):
+        self.threads = threads
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rounds = rounds
+        self._executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.threads = app.config.get('PASSWORD_HASH_THREADS', self.threads)
+            self.max_queue = app.config.get('PASSWORD_HASH_MAX_QUEUE', self.max_queue)
+            self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+            self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.threads + self.max_queue:
+                self.rejected += 1
+                raise PasswordHasherBusy("Too many password operations in progress")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='bcrypt')
+            self.pending += 1
+            future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout: # Not the builtin TimeoutError before Python 3.11
+            raise PasswordHasherBusy("Timed out waiting for a password hashing thread")
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, password):
+        """Returns a bcrypt hash (str) of `password` at the configured cost."""
+        return self._submit(
+            lambda: bcrypt.generate_password_hash(password, self.rounds).decode('utf-8')
+        )
+
+    def verify(self, password_hash, password):
+        return self._submit(bcrypt.check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if `password_hash` was made with a different cost factor than the configured one."""
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds # "$2b$<cost>$<salt+hash>"
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"threads": self.threads, "rounds": self.rounds, "pending": self.pending,
+                    "max_queue": self.max_queue, "rejected": self.rejected}
+
+
+password_hasher = PasswordHasher()
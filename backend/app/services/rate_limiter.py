@@ -0,0 +1,321 @@
+# backend/app/services/rate_limiter.py
+import functools
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from flask import request, jsonify, current_app, g
+from flask_jwt_extended import current_user
+
+logger = logging.getLogger(__name__)
+
+# Per-user limits, by group name (or by endpoint, e.g. 'chat.handle_chat', to
+# override a single route). Rates are requests per minute; `burst` is the
+# bucket size. Overridden / extended with the RATE_LIMITS config (JSON in env).
+DEFAULT_RATE_LIMITS = {
+    'chat': {'per_minute': 20, 'burst': 5},
+    'export': {'per_minute': 2, 'burst': 2},
+    'search': {'per_minute': 60, 'burst': 20},
+    'upload': {'per_minute': 30, 'burst': 10},
+    'upload_part': {'per_minute': 600, 'burst': 60}, # Resumable upload parts
+    'download': {'per_minute': 600, 'burst': 100},
+}
+# Requests of a group one user may have open at once (streams held open count
+# until the response closes, buffered chat generations until they finish).
+# Overridden with the CONCURRENCY_LIMITS config.
+DEFAULT_CONCURRENCY_LIMITS = {
+    'chat': 2,
+    'upload': 2,
+}
+
+
+# --- Stores ---
+class MemoryRateLimitStore:
+    """Per-process token buckets and concurrency leases."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict() # key -> (tokens, updated_at)
+        self._leases = {} # key -> {lease_id: expires_at}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """Takes one token. Returns 0 if allowed, else seconds until a token is available."""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False) # Idle users; their buckets would be full anyway
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def acquire(self, key, limit, lease_seconds, now):
+        """Opens a lease if fewer than `limit` are open for `key`. Returns a lease id or None."""
+        with self._lock:
+            leases = self._leases.setdefault(key, {})
+            for lease_id in [i for i, expires_at in leases.items() if expires_at < now]:
+                del leases[lease_id]
+            if len(leases) >= limit:
+                return None
+            lease_id = uuid.uuid4().hex
+            leases[lease_id] = now + lease_seconds
+            return lease_id
+
+    def release(self, key, lease_id):
+        with self._lock:
+            leases = self._leases.get(key)
+            if leases is not None:
+                leases.pop(lease_id, None)
+                if not leases:
+                    del self._leases[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._leases.clear()
+
+
+class SQLiteRateLimitStore:
+    """
+    Token buckets and leases in a SQLite file, shared by every worker process
+    on the host - so a user can't multiply their limit by landing on different
+    workers. Leases expire on their own if a worker dies holding one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+            key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS rate_limit_lease (
+            lease_id TEXT PRIMARY KEY, key TEXT NOT NULL, expires_at REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_rate_limit_lease_key ON rate_limit_lease (key)')
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so the read-modify-write
+        # below is atomic across processes
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn()
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    def take(self, key, rate, burst, now):
+        def run():
+            row = self._conn.execute(
+                'SELECT tokens, updated_at FROM rate_limit_bucket WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, updated_at = row if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            self._conn.execute(
+                'INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                (key, tokens - 1 if allowed else tokens, now)
+            )
+            return 0 if allowed else (1 - tokens) / rate
+        return self._transaction(run)
+
+    def acquire(self, key, limit, lease_seconds, now):
+        def run():
+            self._conn.execute('DELETE FROM rate_limit_lease WHERE key = ? AND expires_at < ?', (key, now))
+            (open_leases,) = self._conn.execute(
+                'SELECT COUNT(*) FROM rate_limit_lease WHERE key = ?', (key,)
+            ).fetchone()
+            if open_leases >= limit:
+                return None
+            lease_id = uuid.uuid4().hex
+            self._conn.execute(
+                'INSERT INTO rate_limit_lease (lease_id, key, expires_at) VALUES (?, ?, ?)',
+                (lease_id, key, now + lease_seconds)
+            )
+            return lease_id
+        return self._transaction(run)
+
+    def release(self, key, lease_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM rate_limit_lease WHERE lease_id = ?', (lease_id,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM rate_limit_bucket')
+            self._conn.execute('DELETE FROM rate_limit_lease')
+
+
+# --- Facade used by the blueprints ---
+class RateLimited(Exception):
+    """Raised by check()/acquire(); `retry_after` is in seconds."""
+
+    def __init__(self, msg, retry_after):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class Lease:
+    """An open concurrency slot; release() is idempotent."""
+
+    def __init__(self, store, key, lease_id):
+        self._store, self._key, self._lease_id = store, key, lease_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._store.release(self._key, self._lease_id)
+
+
+class RateLimiter:
+    """
+    Per-user admission control: a token bucket per (user, group) smooths the
+    request rate, and a lease count caps how many requests of a group a user
+    has in flight. Rejections become 429 responses with Retry-After, so one
+    noisy client can't tie up workers and upstream model slots everyone shares.
+    """
+
+    def __init__(self):
+        self.store = MemoryRateLimitStore()
+        self.enabled = True
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self.concurrency_limits = dict(DEFAULT_CONCURRENCY_LIMITS)
+        self.lease_seconds = 600
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def init_app(self, app):
+        backend = app.config.get('RATE_LIMIT_BACKEND', 'memory')
+        self.enabled = backend != 'none'
+        if backend == 'sqlite':
+            self.store = SQLiteRateLimitStore(app.config['RATE_LIMIT_SQLITE_PATH'])
+        else:
+            self.store = MemoryRateLimitStore()
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(app.config.get('RATE_LIMITS') or {})}
+        self.concurrency_limits = {**DEFAULT_CONCURRENCY_LIMITS, **(app.config.get('CONCURRENCY_LIMITS') or {})}
+        self.lease_seconds = app.config.get('RATE_LIMIT_LEASE_SECONDS', self.lease_seconds)
+        self.rejected = 0
+
+    def _rule(self, rules, group, endpoint):
+        if endpoint and endpoint in rules:
+            return rules[endpoint]
+        return rules.get(group)
+
+    def _reject(self, msg, retry_after):
+        with self._lock:
+            self.rejected += 1
+        raise RateLimited(msg, retry_after)
+
+    def check(self, group, user_id, endpoint=None):
+        """Takes one token from the user's bucket for `group`; raises RateLimited when empty."""
+        rule = self._rule(self.rate_limits, group, endpoint)
+        if not self.enabled or not rule:
+            return
+        rate = rule['per_minute'] / 60.0
+        wait = self.store.take(f"{group}:{user_id}", rate, rule.get('burst', 1), time.time())
+        if wait:
+            self._reject("Too many requests. Please slow down.", wait)
+
+    def acquire(self, group, user_id, endpoint=None):
+        """Opens a concurrency lease for `group`; returns a Lease (or None if uncapped)."""
+        limit = self._rule(self.concurrency_limits, group, endpoint)
+        if not self.enabled or not limit:
+            return None
+        key = f"{group}:{user_id}"
+        lease_id = self.store.acquire(key, limit, self.lease_seconds, time.time())
+        if lease_id is None:
+            self._reject(f"At most {limit} concurrent requests of this kind are allowed.", 1)
+        return Lease(self.store, key, lease_id)
+
+    def admit(self, group, user_id, endpoint=None):
+        """
+        Both checks for one request: opens the concurrency lease first, so a
+        request refused for concurrency doesn't also spend a rate token. Returns
+        the Lease (or None); raises RateLimited.
+        """
+        lease = self.acquire(group, user_id, endpoint)
+        try:
+            self.check(group, user_id, endpoint)
+        except RateLimited:
+            if lease is not None:
+                lease.release()
+            raise
+        return lease
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "backend": type(self.store).__name__, "rejected": self.rejected}
+
+
+rate_limiter = RateLimiter()
+
+
+def too_many_requests(error):
+    response = jsonify({"msg": str(error)})
+    response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response, 429
+
+
+def rate_limited(group, unless=None):
+    """
+    View decorator (place below @jwt_required()): applies the group's rate limit
+    and concurrency cap for the current user. For streamed responses the lease
+    is held until the response is closed, unless the view takes it over with
+    take_lease(). Requests for which `unless()` is true (e.g. resuming a stream,
+    which starts no new work) are not limited.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if unless is not None and unless():
+                return view(*args, **kwargs)
+            user_id = current_user.id
+            try:
+                lease = rate_limiter.admit(group, user_id, request.endpoint)
+            except RateLimited as e:
+                logger.info("Rate limit: rejected %s for user %s (%s)", request.endpoint, user_id, e)
+                return too_many_requests(e)
+            if lease is None:
+                return view(*args, **kwargs)
+            g.rate_limit_lease = lease
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                if g.pop('rate_limit_lease', None) is not None:
+                    lease.release()
+                raise
+            if g.pop('rate_limit_lease', None) is None:
+                return response # Taken over by the view
+            response = current_app.make_response(response)
+            if response.is_streamed:
+                response.call_on_close(lease.release)
+            else:
+                lease.release()
+            return response
+        return wrapper
+    return decorator
+
+
+def take_lease():
+    """
+    Hands the current request's concurrency lease (from @rate_limited) to the
+    caller, who must release() it - e.g. for work that outlives the response.
+    Returns None if the request holds no lease.
+    """
+    return g.pop('rate_limit_lease', None)
@@ -0,0 +1,186 @@
+# backend/app/services/response_cache.py
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+# --- Key normalization ---
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text):
+    """Case/whitespace/trailing-punctuation insensitive form, so trivially different prompts share a key."""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return _WHITESPACE_RE.sub(' ', text).strip().rstrip('?!.').strip()
+
+
+def make_cache_key(model_name, generation_config, formatted_history, prompt, attachment_keys=None):
+    payload = {
+        'model': model_name,
+        'config': generation_config or {},
+        'history': [
+            [msg['role'], [normalize_text(part.get('text', '')) for part in msg['parts']]]
+            for msg in formatted_history
+        ],
+        'prompt': normalize_text(prompt),
+    }
+    if attachment_keys:
+        payload['attachments'] = list(attachment_keys) # Content hashes, not the bytes
+    raw = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+# --- Backends ---
+class MemoryCacheBackend:
+    """In-process LRU with per-entry expiry."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, chunks)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, chunks = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return list(chunks)
+
+    def set(self, key, chunks, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, tuple(chunks))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """
+    SQLite-file LRU, shared by every worker process on the host and kept
+    across restarts. Recency is tracked in `last_access`; the least recently
+    used rows are pruned when `max_entries` is exceeded.
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY, chunks TEXT NOT NULL,
+            expires_at REAL NOT NULL, last_access REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache (last_access)')
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT chunks, expires_at FROM response_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE response_cache SET last_access = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, chunks, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO response_cache (key, chunks, expires_at, last_access) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(list(chunks)), now + ttl, now)
+            )
+            self._conn.execute('DELETE FROM response_cache WHERE expires_at < ?', (now,))
+            self._conn.execute(
+                '''DELETE FROM response_cache WHERE key IN (
+                       SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)''',
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM response_cache')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+
+
+# --- Facade used by gemini_service ---
+class ResponseCache:
+    """
+    Cache of complete streamed model responses, keyed by a normalized hash of
+    (model name, generation config, formatted history, prompt). Hits are replayed
+    chunk by chunk through the normal streaming generator.
+    """
+
+    def __init__(self, backend=None, ttl=3600, enabled=True):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        backend = app.config.get('RESPONSE_CACHE_BACKEND', 'memory')
+        max_entries = app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)
+        self.enabled = backend != 'none'
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        if backend == 'sqlite':
+            self.backend = SQLiteCacheBackend(app.config['RESPONSE_CACHE_PATH'], max_entries=max_entries)
+        else:
+            self.backend = MemoryCacheBackend(max_entries=max_entries)
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        chunks = self.backend.get(key)
+        with self._lock:
+            if chunks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return chunks
+
+    def set(self, key, chunks):
+        if self.enabled and chunks:
+            self.backend.set(key, chunks, self.ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "enabled": self.enabled, "backend": type(self.backend).__name__,
+            "entries": len(self.backend), "hits": hits, "misses": misses
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,278 @@
+# backend/app/services/search_service.py
+# Full-text search over chat messages (GET /api/chat/search).
+import logging
+import re
+from sqlalchemy import event, text
+from app import db
+from app.database import read_bind
+from app.models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_OFFSET = 1000 # Ranked results are paged by offset; deep pages are not worth their cost
+MAX_QUERY_TERMS = 12
+SNIPPET_TOKENS = 16
+SNIPPET_MARKERS = ('[', ']') # Around matched terms; the client renders them as highlights
+
+# SQLite FTS5 index over chat_message.content. It is an external-content table
+# reading from a view, so message text is not stored twice: the index holds only
+# tokens, and snippet() reads the text back from chat_message by rowid. The
+# `owner` column ('u<user_id>') lets FTS5 intersect a user's postings with the
+# query terms inside the index instead of matching every user's messages and
+# filtering afterwards. Triggers keep it in sync with every insert, update and
+# delete - including bulk query.delete() calls that bypass ORM events.
+FTS_DDL = [
+    """CREATE VIEW IF NOT EXISTS chat_message_fts_source AS
+       SELECT id, content, 'u' || user_id AS owner FROM chat_message""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+       content, owner, content='chat_message_fts_source', content_rowid='id',
+       tokenize='porter unicode61 remove_diacritics 2')""",
+    # bm25 weights: (content, owner) - the owner filter must not affect ranking
+    "INSERT INTO chat_message_fts(chat_message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN
+       INSERT INTO chat_message_fts(rowid, content, owner) VALUES (new.id, new.content, 'u' || new.user_id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN
+       INSERT INTO chat_message_fts(chat_message_fts, rowid, content, owner)
+       VALUES ('delete', old.id, old.content, 'u' || old.user_id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content, user_id ON chat_message BEGIN
+       INSERT INTO chat_message_fts(chat_message_fts, rowid, content, owner)
+       VALUES ('delete', old.id, old.content, 'u' || old.user_id);
+       INSERT INTO chat_message_fts(rowid, content, owner) VALUES (new.id, new.content, 'u' || new.user_id);
+       END""",
+    # Archived messages (history_archive) leave chat_message, so they are indexed
+    # here instead, with their text: it lives only in compressed segments otherwise.
+    # rowid is the message id. Written and deleted together with the segments.
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_archive_fts USING fts5(
+       content, owner, session_id UNINDEXED, sender UNINDEXED, timestamp UNINDEXED,
+       tokenize='porter unicode61 remove_diacritics 2')""",
+    "INSERT INTO chat_archive_fts(chat_archive_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+]
+FTS_TABLES = ('chat_message_fts', 'chat_archive_fts')
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class InvalidSearchQuery(ValueError):
+    """Raised when a search query has no searchable terms."""
+
+
+def create_fts_index(connection, rebuild=False):
+    """
+    Creates the FTS tables, view and triggers (idempotent). `rebuild`
+    re-indexes existing messages, hot and archived.
+    """
+    for statement in FTS_DDL:
+        connection.exec_driver_sql(statement)
+    if rebuild:
+        connection.exec_driver_sql("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+        _reindex_archive(connection)
+
+
+def _reindex_archive(connection):
+    from app.services.history_archive import decompress, decode_messages # Avoid import cycle
+    connection.exec_driver_sql("DELETE FROM chat_archive_fts")
+    segments = connection.exec_driver_sql("SELECT id, user_id FROM chat_archive_segment ORDER BY id").all()
+    for segment_id, user_id in segments: # One payload in memory at a time
+        codec, payload = connection.exec_driver_sql(
+            "SELECT codec, payload FROM chat_archive_segment WHERE id = ?", (segment_id,)
+        ).one()
+        connection.execute(_ARCHIVE_INSERT, _archive_rows(user_id, decode_messages(decompress(codec, payload))))
+
+
+_ARCHIVE_INSERT = text(
+    "INSERT INTO chat_archive_fts(rowid, content, owner, session_id, sender, timestamp) "
+    "VALUES (:id, :content, :owner, :session_id, :sender, :timestamp)"
+)
+
+
+def _archive_rows(user_id, messages):
+    return [{"id": m.id, "content": m.content, "owner": f"u{int(user_id)}", "session_id": m.session_id,
+             "sender": m.sender, "timestamp": str(m.timestamp)} for m in messages]
+
+
+def index_archived_messages(user_id, messages):
+    """Adds messages being archived to the archive index, in the caller's transaction."""
+    if message_search.enabled and messages:
+        db.session.execute(_ARCHIVE_INSERT, _archive_rows(user_id, messages))
+
+
+def unindex_archived_messages(user_id, session_id=None):
+    """Removes a user's (or one session's) archived messages from the index, in the caller's transaction."""
+    if not message_search.enabled:
+        return
+    sql = "DELETE FROM chat_archive_fts WHERE chat_archive_fts MATCH :owner"
+    if session_id is not None:
+        sql += " AND session_id = :session_id"
+    db.session.execute(text(sql), {"owner": f'owner : "u{int(user_id)}"', "session_id": session_id})
+
+
+def fts_index_exists(connection):
+    found = connection.exec_driver_sql(
+        f"SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN {FTS_TABLES}"
+    ).scalar()
+    return found == len(FTS_TABLES)
+
+
+def build_fts_index(engine, rebuild=False):
+    """
+    Creates the index if it is missing and back-fills it from the existing
+    messages and archive segments; `rebuild` re-indexes everything. This is a
+    write-locking pass over the whole history, so it runs from `flask init-db`
+    / `flask build-search-index`, never at worker boot. Returns True if it indexed.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as connection:
+        rebuild = rebuild or not fts_index_exists(connection)
+        create_fts_index(connection, rebuild=rebuild)
+    return rebuild
+
+
+@event.listens_for(ChatMessage.__table__, 'after_create')
+def _create_fts_with_table(target, connection, **kw):
+    # Fresh databases (db.create_all()) get the index together with chat_message
+    if connection.dialect.name == 'sqlite':
+        create_fts_index(connection)
+
+
+def build_match_expression(user_id, query):
+    """
+    Turns free text into a safe FTS5 MATCH expression: every word must appear
+    (the last one as a prefix, for search-as-you-type) and only the user's own
+    messages match. User input never reaches FTS5 query syntax unquoted.
+    """
+    terms = _TERM_RE.findall(query or '')[:MAX_QUERY_TERMS]
+    if not terms:
+        raise InvalidSearchQuery("Search query must contain at least one word")
+    phrases = [f'"{term}"' for term in terms]
+    phrases[-1] += '*'
+    return f'owner : "u{int(user_id)}" AND content : ({" AND ".join(phrases)})'
+
+
+class MessageSearch:
+    """
+    Ranked full-text search over a user's chat messages. Results are ordered by
+    BM25 relevance and carry a highlighted snippet, never the whole message, so
+    a search costs a few index lookups and a small response however long the
+    history is. Archived messages (history_archive) are searched too. On
+    databases other than SQLite, or until the index has been built (`flask
+    init-db`), it falls back to a LIKE scan of the user's messages, newest
+    first, continuing into the archive segments.
+    """
+
+    def __init__(self):
+        self.sqlite = False
+        self._fts_ready = False
+
+    def init_app(self, app):
+        # Only look for the index here: building it is a migration step, not boot work
+        with app.app_context():
+            engine = db.engine
+            self.sqlite = engine.dialect.name == 'sqlite'
+            self._fts_ready = False
+            if self.sqlite:
+                with engine.connect() as connection:
+                    self._fts_ready = fts_index_exists(connection)
+                if not self._fts_ready:
+                    logger.warning("Full-text search index missing; searching with LIKE until "
+                                   "`flask init-db` (or `flask build-search-index`) has run.")
+
+    @property
+    def enabled(self):
+        """Whether FTS5 is used. Until the index exists, each search looks for it again (one catalog lookup)."""
+        if self.sqlite and not self._fts_ready:
+            self._fts_ready = fts_index_exists(db.session.connection())
+        return self._fts_ready
+
+    def search(self, user_id, query, session_id=None, limit=DEFAULT_SEARCH_PAGE_SIZE, offset=0):
+        """
+        Returns (results, has_more) for one page of matches, best first. Each
+        result is a dict with the message's id, session_id, sender, timestamp,
+        snippet and rank.
+        """
+        limit = max(1, min(int(limit), MAX_SEARCH_PAGE_SIZE))
+        offset = max(0, min(int(offset), MAX_SEARCH_OFFSET))
+        if self.enabled:
+            rows = self._search_fts(user_id, query, session_id, limit + 1, offset)
+        else:
+            rows = self._search_like(user_id, query, session_id, limit + 1, offset)
+        return rows[:limit], len(rows) > limit
+
+    def _search_fts(self, user_id, query, session_id, limit, offset):
+        # Hot and archived matches, ranked together
+        sql = f"""
+            SELECT m.id, m.session_id, m.sender, m.timestamp,
+                   snippet(chat_message_fts, 0, :mark_open, :mark_close, '…', {SNIPPET_TOKENS}) AS snippet,
+                   chat_message_fts.rank AS rank
+            FROM chat_message_fts
+            JOIN chat_message AS m ON m.id = chat_message_fts.rowid
+            WHERE chat_message_fts MATCH :match {'AND m.session_id = :session_id' if session_id is not None else ''}
+            UNION ALL
+            SELECT chat_archive_fts.rowid, session_id, sender, timestamp,
+                   snippet(chat_archive_fts, 0, :mark_open, :mark_close, '…', {SNIPPET_TOKENS}),
+                   chat_archive_fts.rank
+            FROM chat_archive_fts
+            WHERE chat_archive_fts MATCH :match {'AND session_id = :session_id' if session_id is not None else ''}
+            ORDER BY rank
+            LIMIT :limit OFFSET :offset"""
+        params = {
+            "match": build_match_expression(user_id, query), "session_id": session_id,
+            "mark_open": SNIPPET_MARKERS[0], "mark_close": SNIPPET_MARKERS[1],
+            "limit": limit, "offset": offset,
+        }
+        stmt = text(sql).columns(ChatMessage.id, ChatMessage.session_id, ChatMessage.sender, ChatMessage.timestamp,
+                                 db.column('snippet'), db.column('rank'))
+        result = db.session.execute(stmt, params, bind_arguments=read_bind())
+        return [self._result(row.id, row.session_id, row.sender, row.timestamp, row.snippet, row.rank)
+                for row in result]
+
+    def _search_like(self, user_id, query, session_id, limit, offset):
+        terms = _TERM_RE.findall(query or '')[:MAX_QUERY_TERMS]
+        if not terms:
+            raise InvalidSearchQuery("Search query must contain at least one word")
+        stmt = db.select(ChatMessage.id, ChatMessage.session_id, ChatMessage.sender,
+                         ChatMessage.timestamp, ChatMessage.content)\
+            .where(ChatMessage.user_id == user_id,
+                   *[ChatMessage.content.ilike(f'%{_escape_like(t)}%', escape='\\') for t in terms])
+        if session_id is not None:
+            stmt = stmt.where(ChatMessage.session_id == session_id)
+        stmt = stmt.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(offset + limit)
+        matches = list(db.session.execute(stmt, bind_arguments=read_bind()))
+        if len(matches) < offset + limit:
+            # Archived messages are older than the hot ones: continue into the archive
+            from app.services.history_archive import iter_archived # Avoid import cycle
+            lowered = [t.lower() for t in terms]
+            for msg in iter_archived(user_id, session_id, newest_first=True):
+                if all(t in msg.content.lower() for t in lowered):
+                    matches.append(msg)
+                    if len(matches) >= offset + limit:
+                        break
+        return [self._result(row.id, row.session_id, row.sender, row.timestamp,
+                             _plain_snippet(row.content, terms[0]), None)
+                for row in matches[offset:]]
+
+    def _result(self, message_id, session_id, sender, timestamp, snippet, rank):
+        return {
+            "message_id": message_id, "session_id": session_id, "sender": sender,
+            "timestamp": timestamp.isoformat() + 'Z', "snippet": snippet, "rank": rank,
+        }
+
+
+def _escape_like(term):
+    # Terms are \w+ runs, which include '_'; user input must not act as a wildcard
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _plain_snippet(content, term, width=80):
+    position = max(0, content.lower().find(term.lower()))
+    start = max(0, position - width // 2)
+    prefix = '…' if start else ''
+    suffix = '…' if start + width < len(content) else ''
+    return prefix + content[start:start + width] + suffix
+
+
+message_search = MessageSearch()
@@ -0,0 +1,132 @@
+# backend/app/services/session_service.py
+# Chat sessions (conversations): listing, denormalized counters and background titles.
+import logging
+import threading
+from collections import defaultdict
+from sqlalchemy import select, update, case, tuple_
+from app import db
+from app.database import read_bind
+from app.models import ChatSession, ConversationSummary
+from app.services.gemini_service import generate_chat_title
+from app.services.history_service import encode_position, decode_cursor
+from app.services.history_archive import purge_history
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_PAGE_SIZE = 20
+MAX_SESSION_PAGE_SIZE = 100
+
+
+def serialize_session(chat_session):
+    return {
+        "id": chat_session.id, "title": chat_session.title,
+        "created_at": chat_session.created_at.isoformat() + 'Z',
+        "last_message_at": chat_session.last_message_at.isoformat() + 'Z',
+        "message_count": chat_session.message_count
+    }
+
+
+def create_session(user_id, title=None):
+    chat_session = ChatSession(user_id=user_id, title=title)
+    db.session.add(chat_session)
+    db.session.flush() # Assigns created_at, so last_message_at can start from it
+    chat_session.last_message_at = chat_session.created_at
+    db.session.commit()
+    return chat_session
+
+
+def get_session(user_id, session_id):
+    """The user's session with this id, or None (also for other users' sessions)."""
+    return ChatSession.query.filter_by(id=session_id, user_id=user_id).first()
+
+
+def list_sessions(user_id, before=None, limit=DEFAULT_SESSION_PAGE_SIZE):
+    """
+    Returns (sessions, has_more): the user's sessions, most recently active
+    first. A single keyset range scan on ix_chat_session_user_id_last_message_at_id;
+    `before` is the cursor of the last session of the previous page.
+    """
+    limit = max(1, min(int(limit), MAX_SESSION_PAGE_SIZE))
+    stmt = select(ChatSession).where(ChatSession.user_id == user_id)
+    if before:
+        stmt = stmt.where(tuple_(ChatSession.last_message_at, ChatSession.id) < tuple_(*decode_cursor(before)))
+    stmt = stmt.order_by(ChatSession.last_message_at.desc(), ChatSession.id.desc()).limit(limit + 1)
+    rows = db.session.execute(stmt, bind_arguments=read_bind()).scalars().all()
+    return rows[:limit], len(rows) > limit
+
+
+def session_cursor(chat_session):
+    return encode_position(chat_session.last_message_at, chat_session.id)
+
+
+def delete_session(user_id, session_id, batch_size=1000):
+    """
+    Deletes a session with its messages (hot and archived, in bounded batches)
+    and summary, committing as it goes. Returns the deleted message count.
+    """
+    num_deleted = purge_history(user_id, session_id=session_id, batch_size=batch_size)
+    ConversationSummary.query.filter_by(user_id=user_id, session_id=session_id).delete()
+    ChatSession.query.filter_by(id=session_id, user_id=user_id).delete()
+    db.session.commit()
+    return num_deleted
+
+
+def bump_session_counters(messages):
+    """
+    Adds newly inserted messages to their sessions' message_count and
+    last_message_at, in the caller's transaction (no commit). One UPDATE per
+    session touched, so the counters commit atomically with the inserts.
+    """
+    per_session = defaultdict(list)
+    for msg in messages:
+        if msg.session_id is not None:
+            per_session[msg.session_id].append(msg.timestamp)
+    for session_id, timestamps in per_session.items():
+        newest = max(timestamps)
+        db.session.execute(
+            update(ChatSession).where(ChatSession.id == session_id).values(
+                message_count=ChatSession.message_count + len(timestamps),
+                last_message_at=case(
+                    (ChatSession.last_message_at < newest, newest), else_=ChatSession.last_message_at
+                )
+            )
+        )
+
+
+# --- Background title generation ---
+_titles_in_flight = set()
+_titles_lock = threading.Lock()
+
+def schedule_title_generation(app, session_id, user_text, ai_text):
+    """
+    Names a session from its first exchange on a background thread, so the
+    extra model call never delays the streamed reply. At most one per session
+    at a time; a title set meanwhile (e.g. renamed by the user) is never overwritten.
+    """
+    with _titles_lock:
+        if session_id in _titles_in_flight:
+            return
+        _titles_in_flight.add(session_id)
+
+    def run():
+        try:
+            with app.app_context():
+                chat_session = db.session.get(ChatSession, session_id)
+                if chat_session is None or chat_session.title:
+                    return
+                title = generate_chat_title(user_text, ai_text)
+                if not title:
+                    return
+                db.session.execute(
+                    update(ChatSession)
+                    .where(ChatSession.id == session_id, ChatSession.title.is_(None))
+                    .values(title=title.strip())
+                )
+                db.session.commit()
+        except Exception as e:
+            logger.error("Error generating title for chat session %s: %s", session_id, e)
+        finally:
+            with _titles_lock:
+                _titles_in_flight.discard(session_id)
+
+    threading.Thread(target=run, name=f"title-{session_id}", daemon=True).start()
@@ -0,0 +1,114 @@
+# backend/app/services/single_flight.py
+# Coalescing of identical concurrent model calls (see gemini_service).
+import asyncio
+import hashlib
+import threading
+from app.services.stream_buffer import ChatStream
+
+FOLLOW_POLL_SECONDS = 15 # Wake-up interval for blocked sync followers
+AFOLLOW_POLL_SECONDS = 0.02 # Poll interval for async followers
+
+
+class Flight(ChatStream):
+    """One in-flight generation: the leader appends chunks, followers replay them."""
+
+    def __init__(self, key):
+        super().__init__(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16], user_id=None,
+                         max_chunks=10 ** 9) # Followers may join late; keep every chunk
+        self.followers = 0
+
+
+class FlightRegistry:
+    """
+    Map of key -> Flight for streamed generations currently running. The first
+    caller for a key becomes the leader and drives the upstream call; callers
+    arriving while it runs attach as followers and receive the same chunks.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.led = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Returns (flight, is_leader)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+            self.led += 1
+            return flight, True
+
+    def land(self, key, flight):
+        """Called by the leader when the generation has ended (successfully or not)."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "led": self.led, "coalesced": self.coalesced}
+
+
+def follow(flight):
+    """Yields a flight's chunks from the start, blocking until the leader finishes."""
+    seq = 0
+    while True:
+        chunks, done = flight.read_from(seq, timeout=FOLLOW_POLL_SECONDS)
+        for chunk_seq, chunk in chunks:
+            seq = chunk_seq + 1
+            yield chunk
+        if done and not chunks:
+            return
+
+
+async def afollow(flight):
+    """Async follow(): polls instead of blocking the event loop."""
+    seq = 0
+    while True:
+        chunks, done = flight.read_from(seq, timeout=0)
+        for chunk_seq, chunk in chunks:
+            seq = chunk_seq + 1
+            yield chunk
+        if done and not chunks:
+            return
+        if not chunks:
+            await asyncio.sleep(AFOLLOW_POLL_SECONDS)
+
+
+class CallRegistry:
+    """Single-flight for plain (non-streamed) calls: concurrent callers with one key share one result."""
+
+    def __init__(self):
+        self._calls = {} # key -> [event, result, exception]
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+            else:
+                self.coalesced += 1
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fn()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
@@ -0,0 +1,114 @@
+# backend/app/services/stream_buffer.py
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class StreamGone(Exception):
+    """Raised when a resume asks for chunks that were already evicted from the buffer."""
+
+
+class ChatStream:
+    """
+    Sequence-numbered chunks of one generation. The producer (generation thread)
+    appends; any number of SSE connections read from a given sequence number and
+    block until more chunks arrive or the stream finishes.
+    Only the newest `max_chunks` chunks are retained.
+    """
+
+    def __init__(self, stream_id, user_id, max_chunks):
+        self.id = stream_id
+        self.user_id = str(user_id)
+        self.max_chunks = max_chunks
+        self.chunks = []
+        self.first_seq = 0 # Sequence number of self.chunks[0]
+        self.done = False
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            if len(self.chunks) > self.max_chunks:
+                del self.chunks[0]
+                self.first_seq += 1
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def read_from(self, seq, timeout):
+        """
+        Returns ([(seq, chunk), ...], done) for chunks at or after `seq`, waiting up
+        to `timeout` seconds for new ones. Raises StreamGone if `seq` was evicted.
+        """
+        with self._cond:
+            if seq < self.first_seq:
+                raise StreamGone(f"Chunks before {self.first_seq} are no longer buffered")
+            if seq >= self.first_seq + len(self.chunks) and not self.done:
+                self._cond.wait(timeout)
+                if seq < self.first_seq:
+                    raise StreamGone(f"Chunks before {self.first_seq} are no longer buffered")
+            start = seq - self.first_seq
+            return [(self.first_seq + i, c) for i, c in enumerate(self.chunks[start:], start)], self.done
+
+
+class StreamRegistry:
+    """
+    Process-wide map of stream id -> ChatStream. Finished streams are kept for
+    `ttl` seconds so a dropped client can reconnect; when `max_streams` is
+    exceeded the oldest (finished first) are evicted.
+
+    Streams live in this process only, so resumes must reach the same worker
+    (sticky sessions when running several).
+    """
+
+    def __init__(self, max_streams=1000, max_chunks=2000, ttl=300):
+        self.max_streams = max_streams
+        self.max_chunks = max_chunks
+        self.ttl = ttl
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_streams = app.config.get('CHAT_STREAM_MAX_STREAMS', self.max_streams)
+        self.max_chunks = app.config.get('CHAT_STREAM_MAX_CHUNKS', self.max_chunks)
+        self.ttl = app.config.get('CHAT_STREAM_TTL', self.ttl)
+        with self._lock:
+            self._streams.clear()
+
+    def create(self, user_id):
+        stream = ChatStream(uuid.uuid4().hex, user_id, self.max_chunks)
+        with self._lock:
+            self._streams[stream.id] = stream
+            self._evict()
+        return stream
+
+    def get(self, stream_id, user_id):
+        """Returns the stream if it exists and belongs to `user_id`, else None."""
+        with self._lock:
+            self._evict()
+            stream = self._streams.get(stream_id)
+        if stream is None or stream.user_id != str(user_id):
+            return None
+        return stream
+
+    def _evict(self):
+        now = time.time()
+        expired = [sid for sid, s in self._streams.items() if s.done and now - s.finished_at > self.ttl]
+        for sid in expired:
+            del self._streams[sid]
+        while len(self._streams) > self.max_streams:
+            finished = next((sid for sid, s in self._streams.items() if s.done), None)
+            # An evicted in-flight stream still completes and is persisted; it just can't be resumed
+            del self._streams[finished if finished is not None else next(iter(self._streams))]
+
+    def __len__(self):
+        return len(self._streams)
+
+
+stream_registry = StreamRegistry()
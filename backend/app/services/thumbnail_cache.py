@@ -0,0 +1,147 @@
+# backend/app/services/thumbnail_cache.py
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None # Thumbnails unavailable; the download route serves originals instead
+
+
+class ThumbnailCache:
+    """
+    Resized image previews, generated on demand and kept on disk under
+    THUMBNAIL_CACHE_DIR. Keyed by the source blob's sha256 and the target size,
+    so a thumbnail is built once no matter how many users uploaded the image.
+    Total size is bounded by THUMBNAIL_CACHE_MAX_BYTES with least-recently-used
+    eviction; the LRU order is rebuilt from file access times on startup.
+    """
+
+    def __init__(self, root=None, max_bytes=256 * 1024 * 1024, sizes=(128, 256, 512), quality=80):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sizes = tuple(sizes)
+        self.quality = quality
+        self._entries = OrderedDict() # path -> bytes, least recently used first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._building = {} # path -> Lock, so concurrent requests build a thumbnail once
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.root = app.config['THUMBNAIL_CACHE_DIR']
+        self.max_bytes = app.config.get('THUMBNAIL_CACHE_MAX_BYTES', self.max_bytes)
+        self.sizes = tuple(app.config.get('THUMBNAIL_SIZES', self.sizes))
+        self.quality = app.config.get('THUMBNAIL_QUALITY', self.quality)
+        os.makedirs(self.root, exist_ok=True)
+        self._load_index()
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def _load_index(self):
+        found = []
+        for directory, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(directory, name)
+                if name.endswith('.tmp'):
+                    os.remove(path) # Left over from an interrupted build
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_atime, path, stat.st_size))
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            for _, path, size in sorted(found):
+                self._entries[path] = size
+                self._total_bytes += size
+            self._evict_locked()
+
+    def nearest_size(self, requested):
+        """Snaps a requested size to the configured set, so arbitrary ?size= values can't flood the cache."""
+        for size in self.sizes:
+            if requested <= size:
+                return size
+        return self.sizes[-1]
+
+    def path_for(self, key, size):
+        return os.path.join(self.root, key[:2], f"{key}_{size}.jpg")
+
+    def get(self, key, size, source_path):
+        """Returns the path of the `size` thumbnail for `source_path`, building it if needed."""
+        path = self.path_for(key, size)
+        with self._lock:
+            if path in self._entries and os.path.exists(path):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return path
+            build_lock = self._building.setdefault(path, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                if path in self._entries and os.path.exists(path):
+                    self._entries.move_to_end(path) # Built by the request we waited on
+                    self.hits += 1
+                    return path
+            try:
+                size_bytes = self._build(source_path, path, size)
+            finally:
+                with self._lock:
+                    self._building.pop(path, None)
+            with self._lock:
+                self.misses += 1
+                self._total_bytes += size_bytes - self._entries.pop(path, 0)
+                self._entries[path] = size_bytes
+                self._evict_locked(keep=path)
+        return path
+
+    def _build(self, source_path, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Image.open(source_path) as img:
+            img = ImageOps.exif_transpose(img) # Phone photos carry their rotation in EXIF
+            img.thumbnail((size, size))
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    img.save(out, format='JPEG', quality=self.quality, optimize=True)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return os.path.getsize(path)
+
+    def _evict_locked(self, keep=None):
+        while self._total_bytes > self.max_bytes and self._entries:
+            path, size = next(iter(self._entries.items()))
+            if path == keep:
+                break # Never evict the thumbnail being returned
+            del self._entries[path]
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for path in self._entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+thumbnail_cache = ThumbnailCache()
@@ -0,0 +1,98 @@
+# backend/app/services/user_cache.py
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import jsonify
+from sqlalchemy import event, select
+from app import db, jwt
+from app.database import read_bind
+from app.models import User
+
+# What `current_user` resolves to: a read-only snapshot, safe to share between
+# requests and threads (unlike an ORM instance bound to one session).
+UserSnapshot = namedtuple('UserSnapshot', 'id username email created_at')
+
+
+class UserCache:
+    """
+    Process-wide cache of UserSnapshots for JWT-authenticated requests.
+
+    Registered as flask_jwt_extended's user loader, so every @jwt_required
+    route resolves its user the same way and `flask_jwt_extended.current_user`
+    works everywhere. flask_jwt_extended keeps the loaded user for the rest of
+    the request; this cache saves the DB round trip across requests. Entries
+    expire after USER_CACHE_TTL seconds (bounding staleness between worker
+    processes) and are dropped immediately when a User row is updated or
+    deleted in this process.
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # user_id -> (expires_at, UserSnapshot)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('USER_CACHE_MAX_ENTRIES', self.max_entries)
+        self.clear()
+        identity_claim = app.config['JWT_IDENTITY_CLAIM']
+
+        @jwt.user_lookup_loader
+        def load_user(jwt_header, jwt_data):
+            return self.get(jwt_data[identity_claim])
+
+        @jwt.user_lookup_error_loader
+        def user_not_found(jwt_header, jwt_data):
+            return jsonify({"msg": "User not found"}), 401
+
+    def get(self, user_id):
+        """Returns the UserSnapshot for `user_id`, or None if no such user exists."""
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is not None and item[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+
+        user = db.session.execute(
+            select(User.id, User.username, User.email, User.created_at).where(User.id == user_id),
+            bind_arguments=read_bind()
+        ).first()
+        if user is None:
+            return None # Not cached: a user created right after should resolve at once
+        snapshot = UserSnapshot(*user)
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(int(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache()
+
+
+# Profile changes made through the ORM drop the cached snapshot right away
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_changed_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
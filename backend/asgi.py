@@ -0,0 +1,13 @@
+# backend/asgi.py - asyncio serving mode (see app/asgi.py)
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port 5001
+import os
+from dotenv import load_dotenv
+
+# Load environment variables FIRST (same as run.py)
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,294 @@
+"""
+End-to-end load benchmark of the API against a stubbed model.
+
+Builds the app against a throwaway SQLite database with LLM_BACKEND=stub (the
+StubBackend streams canned tokens with configurable latency, through the same
+pool, cache and persistence path as the real model) and drives concurrent
+requests through the test client:
+
+  auth      POST /api/auth/signup, then POST /api/auth/login
+  chat      POST /api/chat/ (streamed reply; every prompt is unique, so no cache hits)
+  history   GET /api/chat/history for users with N stored messages, per --history-sizes
+  upload    POST /api/files/upload/stream with --upload-kb of random bytes
+
+Reports throughput, p50/p99 latency and p50/p99 time to first byte per
+scenario, and saves them as JSON together with the git commit and settings, so
+a run can be compared with one from another commit (--compare).
+
+Usage (from backend/):
+    python benchmarks/app_bench.py --output bench-$(git rev-parse --short HEAD).json
+    python benchmarks/app_bench.py --scenarios chat history --token-latency 0.01 --compare bench-old.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SCENARIOS = ('auth', 'chat', 'history', 'upload')
+PASSWORD = 'bench-password'
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def timed_request(client, method, path, **kwargs):
+    """
+    Issues one request and reads the body chunk by chunk. Returns
+    (status, latency, time to first byte), both in seconds. The response is
+    closed, so streamed handlers finish (and persist) exactly as on a server.
+    """
+    started = time.perf_counter()
+    response = client.open(path, method=method, buffered=False, **kwargs)
+    ttfb = None
+    try:
+        for chunk in response.response:
+            if chunk and ttfb is None:
+                ttfb = time.perf_counter() - started
+    finally:
+        response.close()
+    latency = time.perf_counter() - started
+    return response.status_code, latency, ttfb if ttfb is not None else latency
+
+
+def run_requests(name, app, make_request, requests, concurrency, ok_status=(200,), **extra):
+    """Runs `make_request(client, i)` `requests` times on `concurrency` threads and summarizes it."""
+    def one(i):
+        return make_request(app.test_client(), i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    ok = [(latency, ttfb) for status, latency, ttfb in results if status in ok_status]
+    latencies = [latency for latency, _ in ok]
+    ttfbs = [ttfb for _, ttfb in ok]
+
+    def ms(value):
+        return round(value * 1000, 1)
+    return dict({
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": len(ok),
+        "errors": {str(status): sum(1 for s, _, _ in results if s == status)
+                   for status in sorted({s for s, _, _ in results if s not in ok_status})},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "p50_ms": ms(statistics.median(latencies)) if latencies else None,
+        "p99_ms": ms(percentile(latencies, 99)) if latencies else None,
+        "ttfb_p50_ms": ms(statistics.median(ttfbs)) if ttfbs else None,
+        "ttfb_p99_ms": ms(percentile(ttfbs, 99)) if ttfbs else None,
+    }, **extra)
+
+
+# --- Fixtures ---
+def create_users(app, prefix, count):
+    """Signs up `count` users and returns their logins ({"access_token", "userId", ...})."""
+    client = app.test_client()
+    logins = []
+    for i in range(count):
+        username = f"{prefix}_{i}"
+        client.post('/api/auth/signup', json={'username': username, 'email': f"{username}@example.com",
+                                              'password': PASSWORD})
+        response = client.post('/api/auth/login', json={'username': username, 'password': PASSWORD})
+        logins.append(response.get_json())
+    return logins
+
+
+def seed_history(app, user_id, size):
+    """Bulk-inserts `size` alternating user/AI messages for the user, oldest first."""
+    from app import db
+    from app.models import ChatMessage
+    with app.app_context():
+        now = datetime.datetime.utcnow()
+        batch = []
+        for i in range(size):
+            batch.append({
+                "user_id": user_id,
+                "sender": 'user' if i % 2 == 0 else 'ai',
+                "content": f"Seeded message {i}: how long should I keep taking the medication I was prescribed?",
+                "content_type": 'text',
+                "timestamp": now - datetime.timedelta(seconds=size - i),
+            })
+            if len(batch) >= 5000:
+                db.session.execute(db.insert(ChatMessage), batch)
+                batch = []
+        if batch:
+            db.session.execute(db.insert(ChatMessage), batch)
+        db.session.commit()
+
+
+def auth_header(token):
+    return {'Authorization': f"Bearer {token}"}
+
+
+# --- Scenarios ---
+def bench_auth(app, args):
+    run_id = uuid.uuid4().hex[:8]
+
+    def signup(client, i):
+        username = f"auth_{run_id}_{i}"
+        return timed_request(client, 'POST', '/api/auth/signup', json={
+            'username': username, 'email': f"{username}@example.com", 'password': PASSWORD})
+
+    def login(client, i):
+        return timed_request(client, 'POST', '/api/auth/login', json={
+            'username': f"auth_{run_id}_{i}", 'password': PASSWORD})
+
+    return [
+        run_requests('signup', app, signup, args.requests, args.concurrency, ok_status=(201,)),
+        run_requests('login', app, login, args.requests, args.concurrency),
+    ]
+
+
+def bench_chat(app, args):
+    # One user per worker, so turns in a conversation don't queue behind each other
+    tokens = [login['access_token'] for login in create_users(app, f"chat_{uuid.uuid4().hex[:8]}", args.concurrency)]
+    run_id = uuid.uuid4().hex
+
+    def chat(client, i):
+        return timed_request(client, 'POST', '/api/chat/', headers=auth_header(tokens[i % len(tokens)]),
+                             json={'message': f"Benchmark question {run_id} #{i}: is this dose safe?"})
+
+    return [run_requests('chat', app, chat, args.requests, args.concurrency)]
+
+
+def bench_history(app, args):
+    results = []
+    for size in args.history_sizes:
+        login = create_users(app, f"history_{size}_{uuid.uuid4().hex[:8]}", 1)[0]
+        seed_history(app, login['userId'], size)
+        token = login['access_token']
+
+        def history(client, i):
+            return timed_request(client, 'GET', f"/api/chat/history?limit={args.history_page_size}",
+                                 headers=auth_header(token))
+
+        results.append(run_requests('history', app, history, args.requests, args.concurrency,
+                                    history_size=size, page_size=args.history_page_size))
+    return results
+
+
+def bench_upload(app, args):
+    tokens = [login['access_token'] for login in create_users(app, f"upload_{uuid.uuid4().hex[:8]}", args.concurrency)]
+    payload_size = args.upload_kb * 1024
+
+    def upload(client, i):
+        # Random bytes: every upload is a new blob, not a deduplicated one
+        return timed_request(client, 'POST', f"/api/files/upload/stream?filename=bench_{i}.pdf",
+                             headers=auth_header(tokens[i % len(tokens)]), data=os.urandom(payload_size),
+                             content_type='application/pdf')
+
+    return [run_requests('upload', app, upload, args.requests, args.concurrency, ok_status=(201,),
+                         upload_kb=args.upload_kb)]
+
+
+BENCHMARKS = {'auth': bench_auth, 'chat': bench_chat, 'history': bench_history, 'upload': bench_upload}
+
+
+# --- Reporting ---
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return (result['scenario'], result.get('history_size'))
+
+
+def result_label(result):
+    if result.get('history_size') is not None:
+        return f"{result['scenario']}[{result['history_size']}]"
+    return result['scenario']
+
+
+def print_result(result, baseline=None):
+    line = (f"{result_label(result):<16} {result['throughput_rps']:>9} req/s  "
+            f"p50={result['p50_ms']}ms  p99={result['p99_ms']}ms  "
+            f"ttfb p50={result['ttfb_p50_ms']}ms p99={result['ttfb_p99_ms']}ms  ok={result['ok']}")
+    if result['errors']:
+        line += f"  errors={result['errors']}"
+    if baseline and baseline.get('throughput_rps') and result['throughput_rps'] is not None:
+        change = (result['throughput_rps'] - baseline['throughput_rps']) / baseline['throughput_rps'] * 100
+        line += f"  [{change:+.1f}% req/s, p99 was {baseline['p99_ms']}ms]"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=100, help="Requests per scenario (and per history size)")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--token-latency', type=float, default=0.01, help="Stub model: seconds between tokens")
+    parser.add_argument('--first-token-latency', type=float, default=0.1, help="Stub model: seconds to first token")
+    parser.add_argument('--history-sizes', type=int, nargs='+', default=[0, 1000, 10000])
+    parser.add_argument('--history-page-size', type=int, default=50)
+    parser.add_argument('--upload-kb', type=int, default=256)
+    parser.add_argument('--bcrypt-cost', type=int, default=10, help="BCRYPT_LOG_ROUNDS (production default: 12)")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="A previous --output file to print changes against")
+    args = parser.parse_args()
+
+    started_at = datetime.datetime.utcnow().isoformat() + 'Z'
+    tmp_dir = tempfile.mkdtemp(prefix='medai-app-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+    os.environ['LLM_BACKEND'] = 'stub'
+    os.environ['STUB_LLM_TOKEN_LATENCY'] = str(args.token_latency)
+    os.environ['STUB_LLM_FIRST_TOKEN_LATENCY'] = str(args.first_token_latency)
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.bcrypt_cost)
+    # Measure the request paths, not the per-user limits in front of them
+    os.environ['RATE_LIMIT_BACKEND'] = 'none'
+    os.environ.setdefault('LLM_MAX_IN_FLIGHT', str(max(8, args.concurrency)))
+    os.environ.setdefault('ANALYSIS_WORKER_IN_PROCESS', '0')
+    os.environ.setdefault('BLOB_STORAGE_ROOT', os.path.join(tmp_dir, 'blobs'))
+    os.environ.setdefault('THUMBNAIL_CACHE_DIR', os.path.join(tmp_dir, 'thumbnails'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    from app import create_app, db
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result_key(r): r for r in json.load(f)['results']}
+
+    results = []
+    for scenario in args.scenarios:
+        for result in BENCHMARKS[scenario](app, args):
+            results.append(result)
+            print_result(result, baseline.get(result_key(result)))
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            "results": results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
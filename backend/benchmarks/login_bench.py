@@ -0,0 +1,95 @@
+"""
+Login throughput at different bcrypt cost factors.
+
+Builds the app against a throwaway SQLite database, creates one user per cost
+factor and fires concurrent POST /api/auth/login requests through the test
+client. Reports logins/second and latency percentiles, so the price of raising
+BCRYPT_LOG_ROUNDS (and the effect of PASSWORD_HASH_THREADS) is visible before
+it ships.
+
+Usage (from backend/):
+    python benchmarks/login_bench.py --costs 10 11 12 --requests 200 --concurrency 16
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run_cost(cost, requests, concurrency, hash_threads):
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(cost)
+    if hash_threads:
+        os.environ['PASSWORD_HASH_THREADS'] = str(hash_threads)
+    from app import create_app, db
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    username = f"bench_{cost}"
+    client.post('/api/auth/signup', json={'username': username, 'email': f"{username}@example.com", 'password': 'pw'})
+
+    def login(_):
+        started = time.perf_counter()
+        response = app.test_client().post('/api/auth/login', json={'username': username, 'password': 'pw'})
+        return response.status_code, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(login, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for status, latency in results if status == 200]
+    return {
+        "cost": cost,
+        "requests": requests,
+        "concurrency": concurrency,
+        "hash_threads": app.config['PASSWORD_HASH_THREADS'],
+        "ok": len(latencies),
+        "rejected": sum(1 for status, _ in results if status == 503),
+        "logins_per_second": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--costs', type=int, nargs='+', default=[10, 11, 12])
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--hash-threads', type=int, default=None, help="PASSWORD_HASH_THREADS (default: app default)")
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='medai-login-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+    os.environ.setdefault('LLM_BACKEND', 'stub')
+    os.environ.setdefault('ANALYSIS_WORKER_IN_PROCESS', '0')
+    os.environ.setdefault('BLOB_STORAGE_ROOT', os.path.join(tmp_dir, 'blobs'))
+    os.environ.setdefault('THUMBNAIL_CACHE_DIR', os.path.join(tmp_dir, 'thumbnails'))
+
+    results = []
+    for cost in args.costs:
+        result = run_cost(cost, args.requests, args.concurrency, args.hash_threads)
+        results.append(result)
+        print(f"cost={result['cost']:>2}  {result['logins_per_second']:>8} logins/s  "
+              f"p50={result['p50_ms']}ms  p99={result['p99_ms']}ms  ok={result['ok']}  503={result['rejected']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Cold-start cost of a backend process.
+
+Starts fresh interpreters against a throwaway SQLite database (schema created
+once up front, as `flask init-db` would) and times each phase of boot:
+`import app`, create_app() and the first request (GET /health), plus the
+whole process from spawn to exit. Reports the median and p90 of each phase
+over --runs processes, optionally the slowest imports (python -X importtime),
+and saves JSON that can be compared with a run from another commit (--compare).
+
+Usage (from backend/):
+    python benchmarks/startup_bench.py --runs 10 --importtime 15 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PHASES = ('import_s', 'create_app_s', 'first_request_s', 'process_s')
+
+PROBE = r'''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+status = application.test_client().get('/health').status_code
+served = time.perf_counter()
+print(json.dumps({"import_s": imported - started, "create_app_s": created - imported,
+                  "first_request_s": served - created, "status": status}))
+'''
+
+INIT_DB = r'''
+from app import create_app, db
+application = create_app()
+with application.app_context():
+    db.create_all()
+'''
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run_python(code, env, extra_args=()):
+    return subprocess.run([sys.executable, *extra_args, '-c', code], cwd=BACKEND_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def probe(env):
+    started = time.perf_counter()
+    result = run_python(PROBE, env)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_s'] = time.perf_counter() - started
+    return timings
+
+
+def slowest_imports(env, count):
+    """The `count` modules with the largest cumulative import time, from python -X importtime."""
+    stderr = run_python(PROBE, env, ['-X', 'importtime']).stderr
+    modules = []
+    for line in stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append({"module": name.strip(), "cumulative_ms": round(int(cumulative) / 1000, 1)})
+    return sorted(modules, key=lambda m: m['cumulative_ms'], reverse=True)[:count]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=BACKEND_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help="Also list the N slowest imports")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="A previous --output file to print changes against")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='medai-startup-bench-')
+    env = dict(os.environ)
+    env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+    env.setdefault('ANALYSIS_WORKER_IN_PROCESS', '0')
+    env.setdefault('BLOB_STORAGE_ROOT', os.path.join(tmp_dir, 'blobs'))
+    env.setdefault('THUMBNAIL_CACHE_DIR', os.path.join(tmp_dir, 'thumbnails'))
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    run_python(INIT_DB, env)
+
+    samples = [probe(env) for _ in range(args.runs)]
+    phases = {}
+    for phase in PHASES:
+        values = [sample[phase] for sample in samples]
+        phases[phase] = {
+            "median_ms": round(statistics.median(values) * 1000, 1),
+            "p90_ms": round(percentile(values, 90) * 1000, 1),
+            "min_ms": round(min(values) * 1000, 1),
+        }
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['phases']
+    for phase, stats in phases.items():
+        line = f"{phase:<16} median={stats['median_ms']}ms  p90={stats['p90_ms']}ms  min={stats['min_ms']}ms"
+        if baseline.get(phase, {}).get('median_ms'):
+            before = baseline[phase]['median_ms']
+            line += f"  [{(stats['median_ms'] - before) / before * 100:+.1f}% vs {before}ms]"
+        print(line)
+
+    imports = slowest_imports(env, args.importtime) if args.importtime else []
+    for entry in imports:
+        print(f"  {entry['cumulative_ms']:>8}ms  {entry['module']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "runs": args.runs,
+                "llm_backend": env.get('LLM_BACKEND', 'gemini'),
+                "phases": phases,
+                "slowest_imports": imports,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,15 +27,7 @@ if __name__ == '__main__':
         os.makedirs(instance_path)
         print(f"Created instance folder at {instance_path}")
 
-    # Optionally create DB tables if they don't exist
-    with app.app_context():
-        from app import db
-        try:
-            print("Attempting to create database tables...")
-            db.create_all()
-            print("Database tables checked/created.")
-        except Exception as e:
-            print(f"Error creating database tables: {e}")
-
+    # The schema is not created here: run `flask --app run init-db` once (and after
+    # upgrades), so starting a server never blocks on DDL.
     print("Starting Flask development server...")
     app.run(host='0.0.0.0', port=5001) # Run on port 5001 to avoid conflict with React dev server
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app on a fresh SQLite database, with the stub model and no background workers."""
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///' + str(tmp_path / 'test.db'))
+    monkeypatch.setenv('LLM_BACKEND', 'stub')
+    monkeypatch.setenv('RATE_LIMIT_BACKEND', 'none')
+    monkeypatch.setenv('CHAT_WRITE_BEHIND', '0')
+    monkeypatch.setenv('ANALYSIS_WORKER_IN_PROCESS', '0')
+    monkeypatch.setenv('BLOB_STORAGE_ROOT', str(tmp_path / 'blobs'))
+    monkeypatch.setenv('THUMBNAIL_CACHE_DIR', str(tmp_path / 'thumbnails'))
+    from app import create_app, db
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
@@ -0,0 +1,55 @@
+import datetime
+import time
+
+import pytest
+
+from app import db
+from app.models import User, UploadedFile
+from app.services.analysis_worker import analysis_worker, claim_next_job
+
+
+@pytest.fixture
+def pending_file(app, tmp_path):
+    user = User(username='patient', email='patient@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(b'%PDF-1.4 /Type /Page')
+    uploaded = UploadedFile(user_id=user.id, filename='report.pdf', filepath=str(path), mime_type='application/pdf')
+    db.session.add(uploaded)
+    db.session.commit()
+    return uploaded.id
+
+
+def _status(file_id):
+    db.session.expire_all()
+    return db.session.get(UploadedFile, file_id).ai_analysis_status
+
+
+def test_in_process_worker_picks_up_jobs_left_from_before_a_restart(app, pending_file):
+    app.config.update(ANALYSIS_WORKER_IN_PROCESS=True, ANALYSIS_POLL_INTERVAL=0.1)
+    analysis_worker.init_app(app)
+    try:
+        app.test_client().get('/health') # Any request; no upload (and so no notify()) needed
+        deadline = time.monotonic() + 30
+        while _status(pending_file) != 'complete' and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert _status(pending_file) == 'complete'
+    finally:
+        analysis_worker.stop()
+
+
+def test_running_jobs_keep_their_claim(app, pending_file):
+    analysis_worker.lease_seconds = 60
+    job = claim_next_job(analysis_worker.lease_seconds)
+    # The job has been running for longer than the lease...
+    job.analysis_claimed_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=120)
+    db.session.commit()
+    # ...but the dispatcher renews the claims of jobs in its pool
+    analysis_worker._running.add(job.id)
+    analysis_worker._renew_at = 0.0
+    try:
+        analysis_worker._renew_claims()
+    finally:
+        analysis_worker._running.clear()
+    assert claim_next_job(analysis_worker.lease_seconds) is None
@@ -0,0 +1,19 @@
+import builtins
+
+from app.services.attachment_cache import prepare_payload
+
+
+def test_small_file_is_sent_inline(tmp_path):
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(b'%PDF-1.4 small')
+    assert prepare_payload(str(path), 'application/pdf', 1536, 1024) == ('application/pdf', b'%PDF-1.4 small')
+
+
+def test_large_file_is_not_read(tmp_path, monkeypatch):
+    path = tmp_path / 'recording.wav'
+    path.write_bytes(b'\0' * 4096)
+    opened = []
+    real_open = builtins.open
+    monkeypatch.setattr(builtins, 'open', lambda file, *args, **kwargs: opened.append(file) or real_open(file, *args, **kwargs))
+    assert prepare_payload(str(path), 'audio/wav', 1536, 1024) is None
+    assert str(path) not in opened
@@ -0,0 +1,65 @@
+import io
+import os
+
+import pytest
+
+from app import db
+from app.models import FileBlob
+from app.services.blob_store import blob_store
+
+BODY = b"%PDF-1.4 lab results"
+
+
+def _upload(body=BODY):
+    """write_stream + acquire + place + commit, as _register_upload does."""
+    sha256, size, tmp_path = blob_store.write_stream(io.BytesIO(body))
+    blob = blob_store.acquire(sha256, size)
+    blob_store.place(tmp_path, blob)
+    db.session.commit()
+    blob_store.discard(tmp_path)
+    return blob
+
+
+def test_identical_uploads_share_one_body(app):
+    first, second = _upload(), _upload()
+    assert first.id == second.id
+    assert db.session.get(FileBlob, first.id).ref_count == 2
+    assert os.listdir(blob_store.tmp_dir) == ['parts']
+
+
+def test_upload_racing_the_last_release_keeps_its_body(app):
+    blob = _upload()
+    path = blob_store.absolute_path(blob.storage_path)
+
+    # The last reference is released and committed, but the body is not removed yet...
+    deleted_path = blob_store.release(blob)
+    db.session.commit()
+    # ...when an identical upload registers the content again
+    again = _upload()
+    blob_store.discard(deleted_path)
+
+    assert os.path.exists(path)
+    assert db.session.get(FileBlob, again.id).ref_count == 1
+
+
+def test_failed_release_restores_the_body(app):
+    blob = _upload()
+    path = blob_store.absolute_path(blob.storage_path)
+    deleted_path = blob_store.release(blob)
+    assert not os.path.exists(path)
+    blob_store.restore(deleted_path)
+    db.session.rollback()
+    assert os.path.exists(path)
+    assert FileBlob.query.filter_by(sha256=blob.sha256).one().ref_count == 1
+
+
+def test_failed_registration_leaves_no_orphan_body(app):
+    sha256, size, tmp_path = blob_store.write_stream(io.BytesIO(BODY))
+    blob = blob_store.acquire(sha256, size)
+    assert blob_store.place(tmp_path, blob)
+    path = blob_store.absolute_path(blob.storage_path)
+    blob_store.unplace(tmp_path, blob)
+    db.session.rollback()
+    blob_store.discard(tmp_path)
+    assert not os.path.exists(path)
+    assert FileBlob.query.filter_by(sha256=sha256).first() is None
@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+from app import db
+from app.models import User, ChatSession, ChatMessage
+from app.services import chat_service
+from app.services.chat_persister import chat_persister
+from app.services.chat_service import new_user_message, persist_chat_turn
+
+
+@pytest.fixture
+def write_behind(app):
+    app.config['CHAT_WRITE_BEHIND'] = True
+    chat_persister.init_app(app)
+    yield chat_persister
+    chat_persister.shutdown()
+
+
+@pytest.fixture
+def chat_session(app):
+    user = User(username='patient', email='patient@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    chat_session = ChatSession(user_id=user.id)
+    db.session.add(chat_session)
+    db.session.commit()
+    return user.id, chat_session.id
+
+
+def test_turn_is_used_after_the_writer_committed_it(app, write_behind, chat_session, monkeypatch):
+    user_id, session_id = chat_session
+    submit = write_behind.submit
+
+    def submit_and_write(*args):
+        # The writer thread wins the race: the turn is committed (and its objects
+        # detached) before the request thread continues
+        accepted = submit(*args)
+        write_behind.flush()
+        return accepted
+    monkeypatch.setattr(write_behind, 'submit', submit_and_write)
+    titles = []
+    monkeypatch.setattr(chat_service, 'schedule_title_generation', lambda app, *args: titles.append(args))
+
+    user_message = new_user_message(user_id, "Is it safe to take ibuprofen daily?", session_id=session_id)
+    assert persist_chat_turn(app, user_id, user_message, "Talk to your doctor first.", False, generate_title=True)
+
+    assert titles == [(session_id, "Is it safe to take ibuprofen daily?", "Talk to your doctor first.")]
+    assert [m.sender for m in ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id)] == ['user', 'ai']
+
+
+def _turn(user_id, session_id, content):
+    return [ChatMessage(user_id=user_id, session_id=session_id, sender='user', content=content,
+                        content_type='text', timestamp=datetime.datetime.utcnow())]
+
+
+def test_turns_arriving_together_are_written_in_one_batch(app, write_behind, chat_session):
+    user_id, session_id = chat_session
+    write_behind.flush_interval = 1.0 # Long enough for both submits to land in the same batch
+    assert write_behind.submit(user_id, _turn(user_id, session_id, "first"))
+    assert write_behind.submit(user_id, _turn(user_id, session_id, "second"))
+    write_behind.flush()
+
+    stats = write_behind.stats()
+    assert (stats["batches"], stats["written"], stats["max_batch_size"]) == (1, 2, 2)
+    assert db.session.get(ChatSession, session_id).message_count == 2
+
+
+def test_failed_batch_is_retried_turn_by_turn(app, write_behind, chat_session):
+    user_id, session_id = chat_session
+    write_behind.flush_interval = 1.0
+    assert write_behind.submit(user_id, _turn(user_id, session_id, "kept"))
+    assert write_behind.submit(user_id, _turn(user_id, session_id, None)) # Violates NOT NULL on its own
+    write_behind.flush()
+
+    stats = write_behind.stats()
+    assert (stats["failed_batches"], stats["written"], stats["dropped_turns"]) == (1, 1, 1)
+    assert [m.content for m in ChatMessage.query.filter_by(session_id=session_id)] == ["kept"]
+
+
+def test_full_queue_falls_back_to_a_synchronous_commit(app, write_behind, chat_session, monkeypatch):
+    user_id, session_id = chat_session
+    write_behind.shutdown()
+    app.config['CHAT_WRITE_BEHIND_MAX_QUEUE'] = 1
+    write_behind.init_app(app)
+    monkeypatch.setattr(write_behind, '_ensure_started', lambda: None) # Nothing drains the queue
+    assert write_behind.submit(user_id, _turn(user_id, session_id, "queued"))
+
+    user_message = new_user_message(user_id, "And the dosage?", session_id=session_id)
+    assert persist_chat_turn(app, user_id, user_message, "Follow the label.", False)
+    assert write_behind.stats()["sync_fallbacks"] == 1
+    assert [m.content for m in ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id)] == \
+        ["And the dosage?", "Follow the label."]
+
+
+def test_disabled_persister_refuses_turns(app, chat_session):
+    user_id, session_id = chat_session
+    chat_persister.init_app(app) # CHAT_WRITE_BEHIND=0 in the test config
+    assert not chat_persister.submit(user_id, _turn(user_id, session_id, "hello"))
@@ -0,0 +1,83 @@
+import datetime
+
+import pytest
+
+from app import db
+from app.models import User, ChatSession, ChatMessage, ChatArchiveSegment
+from app.services.history_archive import history_archive
+from app.services.history_service import InvalidCursor, encode_cursor, fetch_history_page
+
+
+@pytest.fixture
+def history(app, monkeypatch):
+    """A session of 8 messages: the first 5 compacted into two archive segments, the last 3 hot."""
+    monkeypatch.setattr(history_archive, 'segment_messages', 3)
+    user = User(username='patient', email='patient@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    chat_session = ChatSession(user_id=user.id)
+    db.session.add(chat_session)
+    db.session.flush()
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=history_archive.after_days + 30)
+    recent = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    timestamps = [start + datetime.timedelta(minutes=i) for i in range(5)]
+    timestamps += [recent + datetime.timedelta(minutes=i) for i in range(3)]
+    db.session.add_all([
+        ChatMessage(user_id=user.id, session_id=chat_session.id, sender='user' if i % 2 == 0 else 'ai',
+                    content=f"message {i}", timestamp=ts)
+        for i, ts in enumerate(timestamps)
+    ])
+    db.session.commit()
+    assert history_archive.compact_user(user.id) == 5
+    assert ChatArchiveSegment.query.filter_by(user_id=user.id).count() == 2
+    return user.id, chat_session.id
+
+
+def _contents(rows):
+    return [row.content for row in rows]
+
+
+def test_walking_back_crosses_into_the_archive(history):
+    user_id, session_id = history
+    rows, has_more = fetch_history_page(user_id, limit=3, session_id=session_id)
+    assert _contents(rows) == ["message 5", "message 6", "message 7"]
+    assert has_more
+
+    rows, has_more = fetch_history_page(user_id, before=encode_cursor(rows[0]), limit=3, session_id=session_id)
+    assert _contents(rows) == ["message 2", "message 3", "message 4"]
+    assert has_more
+
+    rows, has_more = fetch_history_page(user_id, before=encode_cursor(rows[0]), limit=3, session_id=session_id)
+    assert _contents(rows) == ["message 0", "message 1"]
+    assert not has_more
+
+
+def test_walking_forward_crosses_into_the_hot_table(history):
+    user_id, session_id = history
+    oldest, _ = fetch_history_page(user_id, limit=8, session_id=session_id)
+    rows, has_more = fetch_history_page(user_id, after=encode_cursor(oldest[1]), limit=4, session_id=session_id)
+    assert _contents(rows) == ["message 2", "message 3", "message 4", "message 5"]
+    assert has_more
+
+    rows, has_more = fetch_history_page(user_id, after=encode_cursor(rows[-1]), limit=4, session_id=session_id)
+    assert _contents(rows) == ["message 6", "message 7"]
+    assert not has_more
+
+
+def test_exact_page_boundary_has_no_more(history):
+    user_id, session_id = history
+    rows, has_more = fetch_history_page(user_id, limit=8, session_id=session_id)
+    assert _contents(rows) == [f"message {i}" for i in range(8)]
+    assert not has_more
+    # Other users' history is never merged in
+    assert fetch_history_page(user_id + 1, limit=8) == ([], False)
+
+
+def test_invalid_cursors_are_rejected(history):
+    user_id, session_id = history
+    with pytest.raises(InvalidCursor):
+        fetch_history_page(user_id, before='not-a-cursor', session_id=session_id)
+    rows, _ = fetch_history_page(user_id, limit=1, session_id=session_id)
+    cursor = encode_cursor(rows[0])
+    with pytest.raises(InvalidCursor):
+        fetch_history_page(user_id, before=cursor, after=cursor, session_id=session_id)
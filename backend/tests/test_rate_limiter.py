@@ -0,0 +1,127 @@
+import types
+
+import pytest
+from flask import Response
+
+from app.services import rate_limiter as rate_limiter_module
+from app.services.rate_limiter import (
+    MemoryRateLimitStore, SQLiteRateLimitStore, RateLimiter, RateLimited, rate_limited, rate_limiter, take_lease
+)
+
+
+@pytest.fixture
+def limiter():
+    limiter = RateLimiter()
+    limiter.rate_limits = {'chat': {'per_minute': 60, 'burst': 2}}
+    limiter.concurrency_limits = {'chat': 1}
+    return limiter
+
+
+def test_concurrency_rejection_spends_no_rate_token(limiter):
+    lease = limiter.admit('chat', 1)
+    for _ in range(5):
+        with pytest.raises(RateLimited):
+            limiter.admit('chat', 1) # Refused for concurrency
+    lease.release()
+    limiter.admit('chat', 1).release() # The second token of the burst is still there
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteRateLimitStore(str(tmp_path / 'rate_limits.db'))
+    return MemoryRateLimitStore()
+
+
+def test_leases_cap_open_requests_until_released_or_expired(store):
+    first = store.acquire('chat:1', 2, 60, now=0)
+    second = store.acquire('chat:1', 2, 60, now=0)
+    assert first and second
+    assert store.acquire('chat:1', 2, 60, now=1) is None
+    assert store.acquire('chat:2', 2, 60, now=1) # Other users have their own leases
+
+    store.release('chat:1', first)
+    third = store.acquire('chat:1', 2, 60, now=1)
+    assert third
+    assert store.acquire('chat:1', 2, 60, now=1) is None
+    # A lease its worker never released expires on its own
+    assert store.acquire('chat:1', 2, 60, now=61)
+
+
+@pytest.fixture
+def limited_app(app, monkeypatch):
+    """The app with a chat concurrency cap of 1, and a few views behind @rate_limited('chat')."""
+    app.config.update(RATE_LIMIT_BACKEND='memory', CONCURRENCY_LIMITS={'chat': 1},
+                      RATE_LIMITS={'chat': {'per_minute': 600, 'burst': 100}})
+    rate_limiter.init_app(app)
+    monkeypatch.setattr(rate_limiter_module, 'current_user', types.SimpleNamespace(id=1))
+    taken = []
+
+    @rate_limited('chat')
+    def buffered():
+        return 'ok'
+
+    @rate_limited('chat')
+    def streamed():
+        return Response(iter(['a', 'b']))
+
+    @rate_limited('chat', unless=lambda: True)
+    def resumed():
+        return 'ok'
+
+    @rate_limited('chat')
+    def handed_off():
+        taken.append(take_lease())
+        return 'ok'
+
+    @rate_limited('chat')
+    def failing():
+        raise RuntimeError('boom')
+
+    for view in (buffered, streamed, resumed, handed_off, failing):
+        app.add_url_rule(f'/limited/{view.__name__}', view.__name__, view)
+    yield app, taken
+    rate_limiter.clear()
+
+
+def test_buffered_response_releases_its_lease(limited_app):
+    app, _ = limited_app
+    client = app.test_client()
+    assert client.get('/limited/buffered').status_code == 200
+    assert client.get('/limited/buffered').status_code == 200
+
+
+def test_streamed_response_holds_its_lease_until_closed(limited_app):
+    app, _ = limited_app
+    client = app.test_client()
+    response = client.get('/limited/streamed', buffered=False)
+    assert response.status_code == 200
+    refused = client.get('/limited/buffered')
+    assert refused.status_code == 429 and refused.headers['Retry-After'] == '1'
+    response.close()
+    assert client.get('/limited/buffered').status_code == 200
+
+
+def test_unless_skips_the_limits(limited_app):
+    app, _ = limited_app
+    client = app.test_client()
+    response = client.get('/limited/streamed', buffered=False)
+    assert client.get('/limited/resumed').status_code == 200
+    response.close()
+
+
+def test_taken_lease_outlives_the_response(limited_app):
+    app, taken = limited_app
+    client = app.test_client()
+    assert client.get('/limited/handed_off').status_code == 200
+    assert client.get('/limited/buffered').status_code == 429
+    taken[0].release()
+    assert client.get('/limited/buffered').status_code == 200
+
+
+def test_failing_view_releases_its_lease(limited_app):
+    app, _ = limited_app
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    client = app.test_client()
+    assert client.get('/limited/failing').status_code == 500
+    assert client.get('/limited/buffered').status_code == 200
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from app.services import gemini_service
+from app.services.gemini_service import chat_flights, get_gemini_response_stream
+from app.services.response_cache import make_cache_key, response_cache
+
+HISTORY = [{'role': 'user', 'parts': [{'text': 'I have a headache.'}]},
+           {'role': 'model', 'parts': [{'text': 'How long has it lasted?'}]}]
+
+
+def test_trivially_different_prompts_share_a_key():
+    key = make_cache_key('stub', {}, HISTORY, 'Is aspirin OK?')
+    assert make_cache_key('stub', {}, HISTORY, '  is ASPIRIN   ok ') == key
+    assert make_cache_key('stub', {}, HISTORY, 'Is ibuprofen OK?') != key
+    assert make_cache_key('other-model', {}, HISTORY, 'Is aspirin OK?') != key
+    assert make_cache_key('stub', {'temperature': 0.9}, HISTORY, 'Is aspirin OK?') != key
+    assert make_cache_key('stub', {}, HISTORY[:1], 'Is aspirin OK?') != key
+    assert make_cache_key('stub', {}, HISTORY, 'Is aspirin OK?', attachment_keys=['abc']) != key
+    assert make_cache_key('stub', {}, HISTORY, 'Is aspirin OK?', attachment_keys=['abc']) == \
+        make_cache_key('stub', {}, HISTORY, 'Is aspirin OK?', attachment_keys=['abc'])
+
+
+class GatedBackend:
+    """Streams two chunks, pausing between them until `resume` is set."""
+    model_name = 'gated'
+
+    def __init__(self, reply=('Rest ', 'and hydrate.')):
+        self.reply = reply
+        self.calls = 0
+        self.resume = threading.Event()
+
+    def stream(self, formatted_history, new_prompt, attachments=None):
+        self.calls += 1
+        yield self.reply[0]
+        self.resume.wait(5)
+        yield from self.reply[1:]
+
+
+@pytest.fixture
+def backend(app, monkeypatch):
+    backend = GatedBackend()
+    monkeypatch.setattr(gemini_service, '_active_backend', lambda: backend)
+    response_cache.clear()
+    yield backend
+    backend.resume.set()
+
+
+def test_identical_in_flight_requests_share_one_generation(backend):
+    coalesced = chat_flights.stats()['coalesced']
+    leader = iter(get_gemini_response_stream(HISTORY, 'What helps?', user_id=1, session_id=7))
+    assert next(leader) == 'Rest '
+
+    follower = get_gemini_response_stream(HISTORY, 'What helps?', user_id=1, session_id=7)
+    followed = []
+    thread = threading.Thread(target=lambda: followed.extend(follower))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while chat_flights.stats()['coalesced'] == coalesced and time.monotonic() < deadline:
+        time.sleep(0.01)
+    backend.resume.set()
+    assert list(leader) == ['and hydrate.']
+    thread.join(5)
+
+    assert follower.follower
+    assert followed == ['Rest ', 'and hydrate.']
+    assert backend.calls == 1
+    assert chat_flights.stats()['in_flight'] == 0
+
+
+def test_completed_reply_is_replayed_from_the_cache(backend):
+    backend.resume.set()
+    first = list(get_gemini_response_stream(HISTORY, 'What helps?', user_id=1))
+    again = get_gemini_response_stream(HISTORY, 'what helps', user_id=2)
+    assert list(again) == first
+    assert not again.follower
+    assert backend.calls == 1
+
+
+def test_system_outcomes_are_not_cached(backend):
+    backend.reply = ('[SYSTEM: The response was blocked.]',)
+    assert list(get_gemini_response_stream(HISTORY, 'What helps?')) == ['[SYSTEM: The response was blocked.]']
+    list(get_gemini_response_stream(HISTORY, 'What helps?'))
+    assert backend.calls == 2
@@ -0,0 +1,73 @@
+import datetime
+
+import pytest
+
+from app import db
+from app.models import User, ChatSession, ChatMessage, ChatArchiveSegment
+from app.services.history_archive import history_archive, purge_history
+from app.services.search_service import message_search, build_fts_index
+
+
+@pytest.fixture
+def conversation(app):
+    """A user with one session: two messages older than the archive cutoff, one recent."""
+    user = User(username='patient', email='patient@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    chat_session = ChatSession(user_id=user.id)
+    db.session.add(chat_session)
+    db.session.flush()
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=history_archive.after_days + 30)
+    db.session.add_all([
+        ChatMessage(user_id=user.id, session_id=chat_session.id, sender='user',
+                    content="Can I take metformin with my evening meal?", timestamp=old),
+        ChatMessage(user_id=user.id, session_id=chat_session.id, sender='ai',
+                    content="Metformin is usually taken with meals to reduce stomach upset.",
+                    timestamp=old + datetime.timedelta(seconds=5)),
+        ChatMessage(user_id=user.id, session_id=chat_session.id, sender='user',
+                    content="Thanks, and what about ibuprofen?", timestamp=datetime.datetime.utcnow()),
+    ])
+    db.session.commit()
+    return user.id, chat_session.id
+
+
+def _search(user_id, query, session_id=None):
+    results, _ = message_search.search(user_id, query, session_id=session_id)
+    return results
+
+
+def test_compacted_session_stays_searchable(conversation):
+    user_id, session_id = conversation
+    assert history_archive.compact_user(user_id) == 2
+    assert ChatMessage.query.filter_by(user_id=user_id).count() == 1
+    assert ChatArchiveSegment.query.filter_by(user_id=user_id).count() == 1
+
+    results = _search(user_id, 'metformin', session_id=session_id)
+    assert len(results) == 2
+    assert {r['sender'] for r in results} == {'user', 'ai'}
+    assert all('[' in r['snippet'] and r['session_id'] == session_id for r in results)
+    # Hot and archived messages are ranked together
+    assert [r['sender'] for r in _search(user_id, 'ibuprofen')] == ['user']
+    # Other users never see them
+    assert _search(user_id + 1, 'metformin') == []
+    # A full rebuild (flask build-search-index --rebuild) re-indexes the archive segments
+    db.session.commit()
+    assert build_fts_index(db.engine, rebuild=True)
+    assert len(_search(user_id, 'metformin', session_id=session_id)) == 2
+
+
+def test_compacted_session_searchable_without_fts(conversation, monkeypatch):
+    user_id, session_id = conversation
+    history_archive.compact_user(user_id)
+    monkeypatch.setattr(message_search, 'sqlite', False)
+    monkeypatch.setattr(message_search, '_fts_ready', False)
+
+    results = _search(user_id, 'metformin', session_id=session_id)
+    assert sorted(r['sender'] for r in results) == ['ai', 'user']
+
+
+def test_purged_archive_is_not_searchable(conversation):
+    user_id, session_id = conversation
+    history_archive.compact_user(user_id)
+    assert purge_history(user_id, session_id) == 3
+    assert _search(user_id, 'metformin') == []
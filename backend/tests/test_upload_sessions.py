@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from app import db
+from app.models import User, UploadSession
+from app.routes.files import _get_upload_session
+from app.services.blob_store import UploadTooLarge, blob_store
+
+
+class DroppedConnection(io.BytesIO):
+    """A request body whose client disconnects after the first read."""
+
+    def read(self, size=-1):
+        if self.tell():
+            raise OSError("client disconnected")
+        return super().read(4)
+
+
+@pytest.fixture
+def upload(app):
+    user = User(username='patient', email='patient@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    session = UploadSession(id=blob_store.new_upload_id(), user_id=user.id, filename='scan.pdf')
+    db.session.add(session)
+    db.session.commit()
+    return user.id, session.id
+
+
+def test_parts_append_at_the_stored_offset(upload):
+    _, upload_id = upload
+    assert blob_store.append_part(upload_id, io.BytesIO(b'%PDF-'), 0) == 5
+    assert blob_store.append_part(upload_id, io.BytesIO(b'1.4'), 5) == 8
+    with pytest.raises(ValueError):
+        blob_store.append_part(upload_id, io.BytesIO(b'again'), 5) # A part the server already has
+    assert blob_store.part_size(upload_id) == 8
+
+
+def test_interrupted_part_is_dropped(upload):
+    _, upload_id = upload
+    blob_store.append_part(upload_id, io.BytesIO(b'%PDF-'), 0)
+    with pytest.raises(OSError):
+        blob_store.append_part(upload_id, DroppedConnection(b'1.4 lab results'), 5)
+    assert blob_store.part_size(upload_id) == 5
+    # The client resumes from the same offset
+    assert blob_store.append_part(upload_id, io.BytesIO(b'1.4'), 5) == 8
+
+
+def test_oversized_part_is_dropped(upload, monkeypatch):
+    _, upload_id = upload
+    monkeypatch.setattr(blob_store, 'max_bytes', 8)
+    blob_store.append_part(upload_id, io.BytesIO(b'%PDF-'), 0)
+    with pytest.raises(UploadTooLarge):
+        blob_store.append_part(upload_id, io.BytesIO(b'1.4 lab results'), 5)
+    assert blob_store.part_size(upload_id) == 5
+
+
+def test_session_offset_follows_the_part_file(upload):
+    user_id, upload_id = upload
+    # A worker wrote a part but died before committing the new offset
+    blob_store.append_part(upload_id, io.BytesIO(b'%PDF-1.4'), 0)
+    assert db.session.get(UploadSession, upload_id).received_bytes == 0
+
+    session = _get_upload_session(upload_id, user_id)
+    assert session.received_bytes == 8
+    db.session.expire_all()
+    assert db.session.get(UploadSession, upload_id).received_bytes == 8
+    assert _get_upload_session(upload_id, user_id + 1) is None
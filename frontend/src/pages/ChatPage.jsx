@@ -25,8 +25,8 @@ const ChatPage = () => {
          console.log("ChatPage: Fetching initial chat history...");
          try {
             const response = await apiClient.get('/chat/history');
-            setMessages(response.data || []);
-            console.log("ChatPage: Initial history loaded:", response.data?.length || 0, "messages");
+            setMessages(response.data?.messages || []);
+            console.log("ChatPage: Initial history loaded:", response.data?.messages?.length || 0, "messages");
          } catch (error) {
             // ... (error handling) ...
             console.error("ChatPage: Failed to fetch chat history:", error);